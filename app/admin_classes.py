@@ -6,31 +6,31 @@ from flask_admin.babel import lazy_gettext
 from flask_admin.form import Select2Widget
 from bson.datetime_ms import DatetimeMS
 from bson.objectid import ObjectId
-from flask_admin import expose
-from markupsafe import Markup
+from flask_admin import BaseView, expose
+from markupsafe import Markup, escape
 from datetime import datetime
 from wtforms import form, fields, validators
-from flask import flash, request
+from flask import flash, redirect, request
 
 import flask_login as login
-import threading
-import os
 
 from .mongodb_connection import MongoDBConnection
+from .subject_directory import SubjectDirectory
+from .openai_key_pool import OpenAIKeyPool
+from .information_import import InformationImport
+from .information_headlines import InformationHeadlines
+from .usage_statistics import UsageStatistics
+from .prompt_registry import PromptRegistry
+from .lease_lock import LeaseLock
 
 
-mongodb_lock = threading.Lock()
+# NOTE: Serializes changes of the information tags across all workers (see LeaseLock)
+information_lock = LeaseLock("information")
 
 
 def write_log(msg: str):
-    path = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
     print(msg)
-    # with open(
-    #     os.path.join(path, "log.txt"), "a", encoding="utf-8", newline="\n"
-    # ) as file:
-    #     log_msg = f"""{datetime.now().strftime("%Y-%m-%d, %H:%M:%S")}: {msg}\n"""
-    #     file.write(log_msg)
-    #     file.close()
+    MongoDBConnection.add_log(msg)
 
 
 # ============================================= Filter ==========================================================
@@ -129,39 +129,27 @@ class Chat_HistoryView(ModelView):
         return model[name].date()
 
     def subjects_formatter(self, content, model, name):
-        # Grab subjects
-        sub_query = {"_id": {"$in": [sub for sub in model[name]]}}
-        sub_cursor = self.sub_coll.find(sub_query)
-        subjects = [x for x in sub_cursor]
-
-        # Grab user from subjects
-        users_query = {"_id": {"$in": [sub["teacher_id"] for sub in subjects]}}
-        users = self.user_coll.find(users_query, {"username": 1})
-        users_map = dict((x["_id"], x["username"]) for x in users)
-
-        # generate names
-        sub_names = [
-            f"{sub['subject']} - {sub['course']} - {users_map.get(sub['teacher_id'])}"
-            for sub in subjects
-        ]
-        return ", ".join(sub_names)
+        return ", ".join(SubjectDirectory.get_labels(model[name]))
 
     def message_formatter(self, content, model, name):
         # http://192.168.1.156:1337/admin/informationview/details/?id=
         info_detail_base_url = f"{request.host_url}admin/informationview/details/?id="
-        value: str = "<div>"
-        for item in model[name]:
-            info_query = {
-                "_id": {"$in": [ObjectId(src_id) for src_id in item["source_ids"]]}
-            }
-            info_cursor = self.info_coll.find(info_query, {"headline": 1})
-            source_ids = [
-                f'<a href="{info_detail_base_url}{str(info["_id"])}">{info["headline"]}</a>'
-                for info in info_cursor
-            ]
-            ids = ", ".join(source_ids)
-
-            message = f"""<table class="table" border="1" bordercolor="#ddd">
+        messages = model[name]
+
+        # NOTE: Resolve the sources of all messages at once, only headlines missing in the cache are queried
+        headlines = InformationHeadlines.get(
+            [src_id for item in messages for src_id in item["source_ids"]]
+        )
+
+        value = ["<div>"]
+        for item in messages:
+            ids = ", ".join(
+                f'<a href="{info_detail_base_url}{src_id}">{headlines[src_id]}</a>'
+                for src_id in item["source_ids"]
+                if src_id in headlines
+            )
+            value.append(
+                f"""<table class="table" border="1" bordercolor="#ddd">
                 <tr><td><b>Message</b></td>
                 <td>{item['message']}</td></tr>
                 <tr><td><b>Response</b></td>
@@ -170,10 +158,9 @@ class Chat_HistoryView(ModelView):
                 <td>{item['tag']}</td></tr>
                 <tr><td><b>Source_ids</b></td>
                 <td>{ids}</td></tr></table>"""
-            value += message
-
-        value += "</div>"
-        return Markup(value)
+            )
+        value.append("</div>")
+        return Markup("".join(value))
 
     column_formatters = {
         "date": date_formatter,
@@ -190,12 +177,6 @@ class Chat_HistoryView(ModelView):
 
     form = Chat_HistoryForm
 
-    def __init__(self, info_coll, sub_coll, user_coll, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.info_coll = info_coll
-        self.sub_coll = sub_coll
-        self.user_coll = user_coll
-
     def get_list(self, *args, **kwargs):
         count, data = super(Chat_HistoryView, self).get_list(*args, **kwargs)
 
@@ -204,11 +185,12 @@ class Chat_HistoryView(ModelView):
             user_id = ObjectId(login.current_user.id)
 
             for chat_history in data:
-                # Get Subjects
-                sub_query = {"_id": {"$in": chat_history["subjects"]}}
-                sub_cursor = self.sub_coll.find(sub_query, {"teacher_id": 1})
-                subjects = [item["teacher_id"] for item in sub_cursor]
-                if user_id in subjects:
+                # Get teachers of the subjects
+                teachers = [
+                    SubjectDirectory.get_teacher_id(sub)
+                    for sub in chat_history["subjects"]
+                ]
+                if user_id in teachers:
                     new_data.append(chat_history)
 
             data = new_data
@@ -226,26 +208,57 @@ class Chat_HistoryView(ModelView):
 
 class ExceptionForm(form.Form):
     endpoint = fields.StringField("Endpoint")
-    time = fields.DateTimeField("Time")
+    exception_type = fields.StringField("Exception Type")
+    count = fields.IntegerField("Count")
+    first_seen = fields.DateTimeField("First Seen")
+    last_seen = fields.DateTimeField("Last Seen")
     exception = fields.TextAreaField("Exception")
 
 
 class ExceptionView(ModelView):
-    column_list = ("endpoint", "time")
-    column_sortable_list = ("endpoint", "time")
+    column_list = ("endpoint", "exception_type", "count", "last_seen")
+    column_sortable_list = ("endpoint", "count", "first_seen", "last_seen")
+    column_default_sort = ("last_seen", True)
 
     column_filters = (
         filters.FilterLike("endpoint", "Endpoint"),
         filters.FilterNotLike("endpoint", "Endpoint"),
+        filters.FilterLike("exception_type", "Exception Type"),
+        filters.FilterNotLike("exception_type", "Exception Type"),
+    )
+
+    column_details_list = (
+        "endpoint",
+        "exception_type",
+        "count",
+        "first_seen",
+        "last_seen",
+        "message",
+        "samples",
     )
 
-    column_details_list = ("endpoint", "time", "exception")
+    def samples_formatter(self, content, model, name):
+        value = ["<div>"]
+        for sample in reversed(model.get(name) or []):
+            value.append(
+                f"""<table class="table" border="1" bordercolor="#ddd">
+                <tr><td><b>Time</b></td>
+                <td>{escape(sample['time'])}</td></tr>
+                <tr><td><b>Exception</b></td>
+                <td><pre>{escape(sample['exception'])}</pre></td></tr></table>"""
+            )
+        value.append("</div>")
+        return Markup("".join(value))
+
+    column_formatters = {"samples": samples_formatter}
 
     page_size = 10_000
     can_view_details = True
     can_create = False
     can_edit = False
 
+    details_template = "custom_details.html"
+
     form = ExceptionForm
 
     def is_accessible(self):
@@ -287,13 +300,7 @@ class InformationView(ModelView):
 
     def subject_formatter(self, content, model, name):
         if not name in model:
-            # Get subject
-            subject = self.sub_coll.find_one({"_id": model["subject_id"]})
-            # Get user from subject
-            user = self.user_coll.find_one(
-                {"_id": subject["teacher_id"]}, {"username": 1}
-            )
-            return f"{subject['subject']} - {subject['course']} - {user['username']}"
+            return SubjectDirectory.get_label(model["subject_id"])
         else:
             return model[name]
 
@@ -309,40 +316,16 @@ class InformationView(ModelView):
 
     form = InformationForm
 
-    def __init__(self, sub_coll, user_coll, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.sub_coll = sub_coll
-        self.user_coll = user_coll
-
     def get_list(self, *args, **kwargs):
         count, data = super(InformationView, self).get_list(*args, **kwargs)
 
         # Grab subjects
         if login.current_user.is_admin:
-            sub_query = {"_id": {"$in": [x["subject_id"] for x in data]}}
+            subjects_map = dict(SubjectDirectory.get_subject_choices())
         else:
-            sub_query = {
-                "$and": [
-                    {"_id": {"$in": [x["subject_id"] for x in data]}},
-                    {"teacher_id": ObjectId(login.current_user.id)},
-                ]
-            }
-
-        sub_cursor = self.sub_coll.find(sub_query)
-        subjects = [x for x in sub_cursor]
-
-        # Grab user from subjects
-        query = {"_id": {"$in": [x["teacher_id"] for x in subjects]}}
-        users = self.user_coll.find(query, {"username": 1})
-        users_map = dict((x["_id"], x["username"]) for x in users)
-
-        subjects_map = dict(
-            (
-                x["_id"],
-                f"{x['subject']} - {x['course']} - {users_map.get(x['teacher_id'])}",
+            subjects_map = dict(
+                SubjectDirectory.get_subject_choices(ObjectId(login.current_user.id))
             )
-            for x in subjects
-        )
 
         new_data = []
         for item in data:
@@ -362,24 +345,13 @@ class InformationView(ModelView):
     # Contribute list of user choices to the forms
     def _feed_subject_choices(self, form):
         if login.current_user.is_admin:
-            sub_query = {}
+            subjects = SubjectDirectory.get_subject_choices()
         else:
-            sub_query = {"teacher_id": ObjectId(login.current_user.id)}
-
-        query_result = self.sub_coll.find(sub_query)
-        subjects = [x for x in query_result]
-
-        users_query = {"_id": {"$in": [x["teacher_id"] for x in subjects]}}
-        users = self.user_coll.find(users_query, {"username": 1})
-        users_map = dict((x["_id"], x["username"]) for x in users)
-
-        form.subject_id.choices = [
-            (
-                str(x["_id"]),
-                f"{x['subject']} - {x['course']} - {users_map.get(x['teacher_id'])}",
+            subjects = SubjectDirectory.get_subject_choices(
+                ObjectId(login.current_user.id)
             )
-            for x in subjects
-        ]
+
+        form.subject_id.choices = [(str(x), label) for x, label in subjects]
 
         return form
 
@@ -404,6 +376,9 @@ class InformationView(ModelView):
 
         return model
 
+    def after_model_change(self, form, model, is_created):
+        InformationHeadlines.invalidate([model["_id"]])
+
     def is_accessible(self):
         return login.current_user.is_authenticated and super().is_accessible()
 
@@ -414,18 +389,15 @@ class InformationView(ModelView):
     )
     def action_set_live(self, ids):
         try:
-            mongodb_lock.acquire(blocking=True)
-
-            query = {"_id": {"$in": [ObjectId(id) for id in ids]}}
-            MongoDBConnection.update_information_tag(
-                query, MongoDBConnection.PRE_LIVE_INFO_TAG
-            )
+            with information_lock.hold():
+                query = {"_id": {"$in": [ObjectId(id) for id in ids]}}
+                MongoDBConnection.update_information_tag(
+                    query, MongoDBConnection.PRE_LIVE_INFO_TAG
+                )
 
             msg = f"Successfully set '{len(ids)}' information items live."
             write_log(msg)
             flash(msg)
-
-            mongodb_lock.release()
         except Exception as ex:
             if not self.handle_view_exception(ex):
                 raise
@@ -439,16 +411,14 @@ class InformationView(ModelView):
     )
     def action_remove(self, ids):
         try:
-            mongodb_lock.acquire(blocking=True)
-
-            for id in ids:
-                MongoDBConnection.delete_information(id)
+            with information_lock.hold():
+                for id in ids:
+                    MongoDBConnection.delete_information(id)
+            InformationHeadlines.invalidate(ids)
 
             msg = f"Successfully removed '{len(ids)}' information items."
             write_log(msg)
             flash(msg)
-
-            mongodb_lock.release()
         except Exception as ex:
             if not self.handle_view_exception(ex):
                 raise
@@ -468,18 +438,210 @@ class InformationView(ModelView):
             self._template_args["has_admin_authorization"] = login.current_user.is_admin
         return self.index_view()
 
+    # Imports a JSONL, CSV or Markdown file of informations (see InformationImport)
+    @expose("/import/", methods=("GET", "POST"))
+    def import_view(self):
+        if login.current_user.is_admin:
+            subjects = SubjectDirectory.get_subject_choices()
+        else:
+            subjects = SubjectDirectory.get_subject_choices(ObjectId(login.current_user.id))
+        subject_choices = [(str(x), label) for x, label in subjects]
+
+        result = None
+        if request.method == "POST":
+            upload = request.files.get("file")
+            try:
+                if upload is None or upload.filename == "":
+                    raise Exception("Please select a file to import.")
+
+                result = InformationImport.run(
+                    upload,
+                    InformationForm,
+                    subject_choices,
+                    request.form.get("subject_id"),
+                )
+
+                msg = f"Imported '{result.inserted}' of '{result.rows}' information items from '{upload.filename}'."
+                write_log(msg)
+                flash(msg, "error" if result.failed > 0 else "success")
+            except Exception as ex:
+                MongoDBConnection.add_exception("import_informations", ex)
+                flash(f"Failed to import informations: '{str(ex)}'", "error")
+
+        return self.render(
+            "info_import.html",
+            subject_choices=subject_choices,
+            formats=", ".join(InformationImport.EXTENSIONS),
+            result=result,
+            return_url=self.get_url(".index_view"),
+        )
+
 
 class OpenAI_KeyForm(form.Form):
     api_key = fields.StringField("API Key", validators=[validators.InputRequired()])
+    active = fields.BooleanField("Active", default=True)
 
 
+# NOTE: All active keys of OPEN_AI_UID form the key pool. Headroom and cooldown are the view of the current worker.
 class OpenAI_KeyView(ModelView):
-    column_list = ("api_key",)
-
-    can_create = False
+    column_list = ("api_key", "active", "headroom", "cooldown")
 
     form = OpenAI_KeyForm
 
+    def api_key_formatter(self, content, model, name):
+        return OpenAIKeyPool.mask(model.get("api_key", ""))
+
+    def active_formatter(self, content, model, name):
+        return "No" if model.get("active") is False else "Yes"
+
+    def headroom_formatter(self, content, model, name):
+        state = OpenAIKeyPool.get_state(model.get("api_key", ""))
+        return "-" if state is None else f"{state['headroom']:.0%}"
+
+    def cooldown_formatter(self, content, model, name):
+        state = OpenAIKeyPool.get_state(model.get("api_key", ""))
+        return "-" if state is None else f"{state['cooldown']:.0f}s"
+
+    column_formatters = {
+        "api_key": api_key_formatter,
+        "active": active_formatter,
+        "headroom": headroom_formatter,
+        "cooldown": cooldown_formatter,
+    }
+
+    def on_model_change(self, form, model, is_created):
+        if is_created:
+            model["uid"] = OpenAIKeyPool.uid
+
+        return model
+
+    def after_model_change(self, form, model, is_created):
+        OpenAIKeyPool.invalidate()
+
+    def after_model_delete(self, model):
+        OpenAIKeyPool.invalidate()
+
+    def is_accessible(self):
+        return (
+            login.current_user.is_authenticated
+            and login.current_user.is_admin
+            and super().is_accessible()
+        )
+
+
+class PromptForm(form.Form):
+    name = fields.SelectField(
+        "Prompt",
+        choices=[(x, x) for x in PromptRegistry.get_names()],
+        validators=[validators.InputRequired()],
+    )
+    template = fields.TextAreaField(
+        "Template", validators=[validators.InputRequired()], render_kw={"rows": 16}
+    )
+    active = fields.BooleanField("Active", default=True)
+
+    def validate_template(self, field):
+        try:
+            PromptRegistry.validate(self.name.data, field.data)
+        except ValueError as ex:
+            raise validators.ValidationError(str(ex))
+
+
+# NOTE: Prompts aren't edited in place, every save adds a new version. Older versions can be activated again.
+class PromptView(ModelView):
+    column_list = ("name", "version", "active", "static_tokens", "template", "date", "author")
+    column_details_list = ("name", "version", "active", "static_tokens", "template", "date", "author")
+    column_sortable_list = ("name", "version", "date")
+    column_default_sort = ("date", True)
+
+    column_filters = (filters.FilterEqual("name", "Prompt"),)
+
+    def name_formatter(self, content, model, name):
+        url = self.get_url(".create_view", name=model["name"], url=self.get_url(".index_view"))
+        return Markup(f'{escape(model["name"])} <a href="{escape(url)}">(new version)</a>')
+
+    def active_formatter(self, content, model, name):
+        return "Yes" if model.get("active") else "No"
+
+    def static_tokens_formatter(self, content, model, name):
+        return "-" if model.get(name) is None else model[name]
+
+    def template_formatter(self, content, model, name):
+        template = model.get("template", "")
+        return template if len(template) <= 80 else template[:80] + " ..."
+
+    def template_detail_formatter(self, content, model, name):
+        return Markup(f'<pre style="white-space: pre-wrap;">{escape(model.get("template", ""))}</pre>')
+
+    def date_formatter(self, content, model, name):
+        return model[name].strftime("%d.%m.%Y %H:%M")
+
+    column_formatters = {
+        "name": name_formatter,
+        "active": active_formatter,
+        "static_tokens": static_tokens_formatter,
+        "template": template_formatter,
+        "date": date_formatter,
+    }
+    column_formatters_detail = dict(column_formatters, name=None, template=template_detail_formatter)
+
+    can_view_details = True
+    can_edit = False
+
+    form = PromptForm
+
+    # NOTE: Starts the new version with the template of the active version
+    def create_form(self):
+        form = super(PromptView, self).create_form()
+        if request.method == "GET":
+            name = request.args.get("name", PromptRegistry.GREETING)
+            if name in PromptRegistry.DEFAULTS:
+                form.name.data = name
+                form.template.data = PromptRegistry.get_template(name)
+        return form
+
+    def on_model_change(self, form, model, is_created):
+        model["version"] = MongoDBConnection.get_next_prompt_version(model["name"])
+        model["date"] = DatetimeMS(datetime.now())
+        model["author"] = login.current_user.username
+        model["static_tokens"] = PromptRegistry.count_static_tokens(model["template"])
+
+        return model
+
+    def after_model_change(self, form, model, is_created):
+        if model.get("active"):
+            MongoDBConnection.activate_prompt(model["_id"])
+        PromptRegistry.invalidate()
+        write_log(f"Added version '{model['version']}' of the prompt '{model['name']}'.")
+
+    def after_model_delete(self, model):
+        PromptRegistry.invalidate()
+
+    @action("activate", "Activate", "Are you sure you want to activate the selected version?")
+    def action_activate(self, ids):
+        if len(ids) != 1:
+            flash("Please select exactly one version to activate.", "error")
+            return
+
+        name = MongoDBConnection.activate_prompt(ObjectId(ids[0]))
+        PromptRegistry.invalidate()
+        if name is not None:
+            msg = f"Activated another version of the prompt '{name}'."
+            write_log(msg)
+            flash(msg)
+
+    @action(
+        "deactivate",
+        "Deactivate",
+        "Are you sure you want to deactivate the selected versions? Prompts without an active version use their default.",
+    )
+    def action_deactivate(self, ids):
+        MongoDBConnection.deactivate_prompts([ObjectId(id) for id in ids])
+        PromptRegistry.invalidate()
+        msg = f"Deactivated '{len(ids)}' prompt versions."
+        write_log(msg)
+        flash(msg)
+
     def is_accessible(self):
         return (
             login.current_user.is_authenticated
@@ -515,20 +677,12 @@ class SubjectView(ModelView):
 
     form = SubjectForm
 
-    def __init__(self, user_coll, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.user_coll = user_coll
-
     def get_list(self, *args, **kwargs):
         count, data = super(SubjectView, self).get_list(*args, **kwargs)
 
         if login.current_user.is_admin:
-            # Grab user names
-            query = {"_id": {"$in": [x["teacher_id"] for x in data]}}
-            users = self.user_coll.find(query, {"username": 1})
-
             # Contribute user names to the models
-            users_map = dict((x["_id"], x["username"]) for x in users)
+            users_map = SubjectDirectory.get_usernames()
         else:
             users_map = {ObjectId(login.current_user.id): login.current_user.username}
 
@@ -545,9 +699,9 @@ class SubjectView(ModelView):
 
     # Contribute list of user choices to the forms
     def _feed_user_choices(self, form):
-        users = self.user_coll.find({}, {"username": 1})
+        users = SubjectDirectory.get_usernames()
         form.teacher_id.choices = [
-            (str(user["_id"]), user["username"]) for user in users
+            (str(user_id), username) for user_id, username in users.items()
         ]
         return form
 
@@ -596,10 +750,57 @@ class SubjectView(ModelView):
 
         return model
 
+    # NOTE: Invalidate after the write, so no other request reloads the old state in between
+    def after_model_change(self, form, model, is_created):
+        SubjectDirectory.invalidate()
+
+    def after_model_delete(self, model):
+        SubjectDirectory.invalidate()
+
     def is_accessible(self):
         return login.current_user.is_authenticated and super().is_accessible()
 
 
+# NOTE: Reads only the precomputed rollups (see UsageStatistics), so opening the dashboard doesn't scan the histories
+class UsageView(BaseView):
+    DEFAULT_DAYS: int = 30
+    MAX_DAYS: int = 366
+
+    @expose("/")
+    def index(self):
+        days = request.args.get("days", self.DEFAULT_DAYS, type=int)
+        days = min(max(days, 1), self.MAX_DAYS)
+        return self.render(
+            "usage_dashboard.html",
+            days=days,
+            counters=UsageStatistics.COUNTERS,
+            teacher_counters=UsageStatistics.TEACHER_COUNTERS,
+            **UsageStatistics.get_dashboard(days),
+        )
+
+    @expose("/rebuild/", methods=("POST",))
+    def rebuild_view(self):
+        try:
+            job_id = UsageStatistics.start_rebuild()
+            if job_id is None:
+                flash("The usage statistics are already being rebuilt.", "error")
+            else:
+                write_log(f"Started rebuilding the usage statistics (job '{job_id}').")
+                flash("Started rebuilding the usage statistics. Reload the page in a moment.")
+        except Exception as ex:
+            MongoDBConnection.add_exception("rebuild_usage_statistics", ex)
+            flash(f"Failed to rebuild the usage statistics: '{str(ex)}'", "error")
+
+        return redirect(self.get_url(".index"))
+
+    def is_accessible(self):
+        return (
+            login.current_user.is_authenticated
+            and login.current_user.is_admin
+            and super().is_accessible()
+        )
+
+
 class UserForm(form.Form):
     username = fields.StringField("Username", validators=[validators.InputRequired()])
     password = fields.StringField("Password", validators=[validators.InputRequired()])
@@ -617,6 +818,12 @@ class UserView(ModelView):
 
     form = UserForm
 
+    def after_model_change(self, form, model, is_created):
+        SubjectDirectory.invalidate()
+
+    def after_model_delete(self, model):
+        SubjectDirectory.invalidate()
+
     def is_accessible(self):
         return (
             login.current_user.is_authenticated
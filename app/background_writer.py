@@ -0,0 +1,229 @@
+from pymongo.errors import BulkWriteError
+from pymongo.collection import Collection
+from pymongo import UpdateOne
+from typing import Any, Callable, Dict, List, Tuple
+
+import threading
+import atexit
+import os
+
+
+# NOTE: Merges two update documents of the same upsert. Only the operators used by the writer are supported.
+def merge_updates(current: Dict[str, Any], update: Dict[str, Any]):
+    for operator, fields in update.items():
+        target = current.setdefault(operator, {})
+        for key, value in fields.items():
+            if operator == "$setOnInsert":
+                target.setdefault(key, value)
+            elif operator == "$inc":
+                target[key] = target.get(key, 0) + value
+            elif operator == "$push":
+                if key in target:
+                    each = target[key]["$each"] + value["$each"]
+                    if "$slice" in value:
+                        each = each[value["$slice"] :]
+                    target[key] = dict(value, **{"$each": each})
+                else:
+                    target[key] = value
+            elif operator == "$max":
+                target[key] = max(target[key], value) if key in target else value
+            elif operator == "$min":
+                target[key] = min(target[key], value) if key in target else value
+            else:
+                target[key] = value
+    return current
+
+
+class BackgroundWriter:
+    # Amount of pending operations which triggers an early flush
+    BATCH_SIZE: int = 100
+    # Upper bound of pending operations. Further operations get dropped until the next flush.
+    MAX_PENDING: int = 5_000
+    # Seconds between two flushes
+    FLUSH_INTERVAL: float = 2.0
+    # Error code of mongodb for a duplicate key
+    DUPLICATE_KEY: int = 11000
+
+    _lock = threading.Lock()
+    _wakeup = threading.Event()
+    _thread: threading.Thread | None = None
+    _pid: int | None = None
+
+    _collections: Dict[str, Collection] = {}
+    _inserts: Dict[str, List[dict]] = {}
+    _upserts: Dict[str, Dict[Any, Tuple[dict, dict]]] = {}
+    _pending: int = 0
+    _dropped: Dict[str, int] = {}
+
+    # Receives a message whenever records were lost, e.g. the admin log (see write_log)
+    report: Callable[[str], None] | None = None
+    # Receive the amount of lost records per collection, e.g. to repair counters (see on_lost)
+    _lost_callbacks: Dict[str, Callable[[int], None]] = {}
+
+    @classmethod
+    def setup(cls, report: Callable[[str], None]):
+        cls.report = report
+
+    # NOTE: Runs in the writer thread after every flush that lost records of the collection
+    @classmethod
+    def on_lost(cls, collection: Collection, callback: Callable[[int], None]):
+        cls._lost_callbacks[collection.full_name] = callback
+
+    # ----- Producer -----------------------------------------------------------------------------------------------------
+    @classmethod
+    def insert(cls, collection: Collection, document: dict):
+        name = collection.full_name
+        with cls._lock:
+            if not cls._reserve(name):
+                return False
+            cls._collections[name] = collection
+            cls._inserts.setdefault(name, []).append(document)
+        cls._notify()
+        return True
+
+    # NOTE: Upserts with the same filter are merged in memory, so repeated writes to one document cost a single write
+    @classmethod
+    def upsert(cls, collection: Collection, filter: dict, update: dict):
+        name = collection.full_name
+        key = repr(filter)
+        with cls._lock:
+            upserts = cls._upserts.setdefault(name, {})
+            if key in upserts:
+                merge_updates(upserts[key][1], update)
+                return True
+
+            if not cls._reserve(name):
+                return False
+            cls._collections[name] = collection
+            upserts[key] = (filter, merge_updates({}, update))
+        cls._notify()
+        return True
+
+    # Takes a slot for a new pending operation. Only called while holding the lock.
+    @classmethod
+    def _reserve(cls, name: str) -> bool:
+        if cls._pending >= cls.MAX_PENDING:
+            cls._dropped[name] = cls._dropped.get(name, 0) + 1
+            return False
+        cls._pending += 1
+        return True
+
+    @classmethod
+    def _notify(cls):
+        cls._ensure_thread()
+        if cls._pending >= cls.BATCH_SIZE:
+            cls._wakeup.set()
+
+    # ----- Consumer -----------------------------------------------------------------------------------------------------
+    # NOTE: uWSGI forks its workers, so every process has to start its own thread
+    @classmethod
+    def _ensure_thread(cls):
+        if cls._pid == os.getpid() and cls._thread is not None:
+            return
+        with cls._lock:
+            if cls._pid == os.getpid() and cls._thread is not None:
+                return
+            cls._pid = os.getpid()
+            cls._thread = threading.Thread(
+                target=cls._run, name="background-writer", daemon=True
+            )
+            cls._thread.start()
+
+    @classmethod
+    def _run(cls):
+        while True:
+            cls._wakeup.wait(cls.FLUSH_INTERVAL)
+            cls._wakeup.clear()
+            cls.flush()
+
+    # NOTE: Operations failing because of the connection (or a duplicate key of an upsert, which another worker
+    # inserted at the same time) are queued again and retried with the next flush, as long as there is room below
+    # MAX_PENDING. Documents rejected by mongodb itself would fail again and are lost. A retried batch may have
+    # been written partly, so records are written at least once.
+    @classmethod
+    def flush(cls):
+        from .metrics import Metrics
+
+        with cls._lock:
+            inserts, cls._inserts = cls._inserts, {}
+            upserts, cls._upserts = cls._upserts, {}
+            lost, cls._dropped = {"full": cls._dropped}, {}
+            cls._pending = 0
+        lost["failed"] = {}
+
+        for name, documents in inserts.items():
+            try:
+                cls._collections[name].insert_many(documents, ordered=False)
+            except BulkWriteError as ex:
+                errors = ex.details.get("writeErrors", [])
+                lost["failed"][name] = lost["failed"].get(name, 0) + len(errors)
+            except Exception:
+                cls._retry(name, documents, {}, lost)
+
+        for name, operations in upserts.items():
+            operations = list(operations.items())
+            requests = [
+                UpdateOne(filter, update, upsert=True)
+                for _, (filter, update) in operations
+            ]
+            try:
+                cls._collections[name].bulk_write(requests, ordered=False)
+            except BulkWriteError as ex:
+                retry = {}
+                for error in ex.details.get("writeErrors", []):
+                    if error.get("code") == cls.DUPLICATE_KEY:
+                        key, operation = operations[error["index"]]
+                        retry[key] = operation
+                    else:
+                        lost["failed"][name] = lost["failed"].get(name, 0) + 1
+                cls._retry(name, [], retry, lost)
+            except Exception:
+                cls._retry(name, [], dict(operations), lost)
+
+        messages = []
+        for reason, amounts in lost.items():
+            for name, amount in amounts.items():
+                if amount > 0:
+                    labels = {"collection": name, "reason": reason}
+                    Metrics.increment(Metrics.BACKGROUND_WRITES_LOST, labels, amount)
+                    messages.append(f"'{amount}' {reason} ({name})")
+        if messages and cls.report is not None:
+            cls.report(f"Background writer lost records: {', '.join(messages)}.")
+
+        for name, callback in cls._lost_callbacks.items():
+            amount = sum(amounts.get(name, 0) for amounts in lost.values())
+            if amount == 0:
+                continue
+            try:
+                callback(amount)
+            except Exception as ex:
+                print(f"Failed to handle the lost records of '{name}': {ex}", flush=True)
+
+    # Queues failed operations again. Newer upserts of the same document are merged into the failed ones.
+    @classmethod
+    def _retry(cls, name: str, documents: List[dict], operations: Dict[Any, Tuple[dict, dict]], lost: dict):
+        from .metrics import Metrics
+
+        retried = 0
+        with cls._lock:
+            for document in documents:
+                if cls._reserve(name):
+                    cls._inserts.setdefault(name, []).append(document)
+                    retried += 1
+
+            upserts = cls._upserts.setdefault(name, {})
+            for key, (filter, update) in operations.items():
+                if key in upserts:
+                    upserts[key] = (filter, merge_updates(update, upserts[key][1]))
+                    retried += 1
+                elif cls._reserve(name):
+                    upserts[key] = (filter, update)
+                    retried += 1
+
+            lost["full"][name] = lost["full"].get(name, 0) + cls._dropped.pop(name, 0)
+
+        if retried > 0:
+            Metrics.increment(Metrics.BACKGROUND_WRITES_RETRIED, {"collection": name}, retried)
+
+
+atexit.register(BackgroundWriter.flush)
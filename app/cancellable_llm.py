@@ -0,0 +1,68 @@
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.chat_models.openai import _convert_dict_to_message
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import BaseMessage, ChatGeneration, ChatResult
+from typing import List, Optional
+
+from .streaming_handler import StreamingHandler
+from .openai_key_pool import OpenAIKeyPool
+
+
+# NOTE: Stops streaming the answer as soon as every student waiting for it disconnected (see StreamingHandler.cancel).
+# The partial answer is returned like a finished one, with llm_output["cancelled"] set.
+class CancellableChatOpenAI(ChatOpenAI):
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+    ) -> ChatResult:
+        if not self.streaming or run_manager is None:
+            return super()._generate(messages, stop, run_manager)
+
+        # NOTE: The student may have left during the retrieval already
+        if StreamingHandler.is_run_cancelled(run_manager.handlers):
+            return self.create_result("", "assistant", cancelled=True)
+
+        message_dicts, params = self._create_message_dicts(messages, stop)
+        params["stream"] = True
+
+        inner_completion = ""
+        role = "assistant"
+        cancelled = False
+        # NOTE: The response is recorded by the session hook of the key pool, while the request runs on this thread
+        OpenAIKeyPool.take_stream_response()
+        stream = self.completion_with_retry(messages=message_dicts, **params)
+        response = OpenAIKeyPool.take_stream_response()
+        try:
+            for stream_resp in stream:
+                role = stream_resp["choices"][0]["delta"].get("role", role)
+                token = stream_resp["choices"][0]["delta"].get("content", "")
+                inner_completion += token
+                run_manager.on_llm_new_token(token)
+                if StreamingHandler.is_run_cancelled(run_manager.handlers):
+                    cancelled = True
+                    break
+        finally:
+            # NOTE: Closing the response without reading it to the end drops the connection to OpenAI, which stops
+            # the generation of the remaining tokens. Closing the stream alone would only end the generator.
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+            if response is not None:
+                response.close()
+
+        return self.create_result(inner_completion, role, cancelled)
+
+    def create_result(self, content: str, role: str, cancelled: bool) -> ChatResult:
+        message = _convert_dict_to_message({"content": content, "role": role})
+        return ChatResult(
+            generations=[ChatGeneration(message=message)],
+            llm_output={"token_usage": {}, "model_name": self.model_name, "cancelled": cancelled},
+        )
+
+    # NOTE: The base class only keeps the token usage, the tracing handler reads the flag (see TracingHandler)
+    def _combine_llm_outputs(self, llm_outputs: List[Optional[dict]]) -> dict:
+        combined = super()._combine_llm_outputs(llm_outputs)
+        combined["cancelled"] = any(x is not None and x.get("cancelled", False) for x in llm_outputs)
+        return combined
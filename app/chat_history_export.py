@@ -0,0 +1,130 @@
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List
+
+import json
+import zlib
+import csv
+import io
+
+from .mongodb_connection import MongoDBConnection
+from .metrics import Metrics
+from . import fast_json
+
+
+# NOTE: Streams chat histories for offline analysis. The histories are read from a mongodb cursor in batches of
+# BATCH_SIZE and written out one by one, so the memory used doesn't grow with the size of the export.
+# NDJSON writes one history per line. CSV writes one history per row (lists are JSON encoded) and is gzip compressed.
+class ChatHistoryExport:
+    NDJSON: str = "ndjson"
+    CSV: str = "csv"
+
+    FIELDS = ("_id", "date", "description", "subjects", "start_message", "messages")
+    BATCH_SIZE: int = 500
+    # Bytes of CSV collected before they are compressed and sent
+    CHUNK_SIZE: int = 64 * 1024
+
+    # Builds the query from the request arguments: from, to (ISO dates, both inclusive), subject and tag
+    @classmethod
+    def get_query(cls, args: Dict[str, str]) -> dict:
+        query = {}
+
+        date_range = {}
+        if args.get("from"):
+            date_range["$gte"] = datetime.fromisoformat(args["from"])
+        if args.get("to"):
+            to = datetime.fromisoformat(args["to"])
+            if len(args["to"]) <= len("YYYY-MM-DD"):
+                date_range["$lt"] = to + timedelta(days=1)
+            else:
+                date_range["$lte"] = to
+        if date_range:
+            query["date"] = date_range
+
+        if args.get("subject"):
+            if not ObjectId.is_valid(args["subject"]):
+                raise ValueError(f"'{args['subject']}' is no valid subject id.")
+            query["subjects"] = ObjectId(args["subject"])
+
+        if args.get("tag"):
+            query["messages.tag"] = args["tag"]
+
+        return query
+
+    # Returns the requested fields (comma separated) in the order of FIELDS, all fields if none are requested
+    @classmethod
+    def get_fields(cls, value: str | None) -> List[str]:
+        if not value:
+            return list(cls.FIELDS)
+
+        requested = {x.strip() for x in value.split(",") if x.strip()}
+        unknown = requested.difference(cls.FIELDS)
+        if unknown:
+            raise ValueError(
+                f"Unknown fields: {', '.join(sorted(unknown))}. Allowed are: {', '.join(cls.FIELDS)}."
+            )
+        return [x for x in cls.FIELDS if x in requested]
+
+    @classmethod
+    def to_value(cls, value):
+        if isinstance(value, ObjectId):
+            return str(value)
+        # NOTE: DatetimeMS is returned for dates out of the range of datetime
+        if hasattr(value, "as_datetime"):
+            value = value.as_datetime()
+        if isinstance(value, datetime):
+            return value.isoformat()
+        if isinstance(value, list):
+            return [cls.to_value(x) for x in value]
+        if isinstance(value, dict):
+            return {key: cls.to_value(x) for key, x in value.items()}
+        return value
+
+    @classmethod
+    def generate(cls, format: str, query: dict, fields: List[str]) -> Iterator[bytes]:
+        cursor = MongoDBConnection.export_chat_histories(query, fields, cls.BATCH_SIZE)
+        try:
+            if format == cls.CSV:
+                yield from cls.generate_csv(cursor, fields)
+            else:
+                yield from cls.generate_ndjson(cursor, fields)
+        except Exception as ex:
+            # NOTE: The response already started, so the stream is only cut off. The client sees a truncated export.
+            MongoDBConnection.add_exception("export_chat_histories", ex)
+            raise
+        finally:
+            cursor.close()
+
+    @classmethod
+    def generate_ndjson(cls, cursor, fields: List[str]) -> Iterator[bytes]:
+        exported = 0
+        for document in cursor:
+            yield fast_json.dumps({key: document.get(key) for key in fields}) + b"\n"
+            exported += 1
+        Metrics.increment(Metrics.EXPORTED_HISTORIES, {"format": cls.NDJSON}, exported)
+
+    @classmethod
+    def generate_csv(cls, cursor, fields: List[str]) -> Iterator[bytes]:
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+
+        exported = 0
+        for document in cursor:
+            row = []
+            for key in fields:
+                value = cls.to_value(document.get(key))
+                row.append(json.dumps(value, ensure_ascii=False) if isinstance(value, (list, dict)) else value)
+            writer.writerow(row)
+            exported += 1
+
+            if buffer.tell() >= cls.CHUNK_SIZE:
+                chunk = compressor.compress(buffer.getvalue().encode("utf-8"))
+                buffer.seek(0)
+                buffer.truncate()
+                if chunk:
+                    yield chunk
+
+        yield compressor.compress(buffer.getvalue().encode("utf-8")) + compressor.flush()
+        Metrics.increment(Metrics.EXPORTED_HISTORIES, {"format": cls.CSV}, exported)
@@ -24,6 +24,8 @@ from langchain.prompts.base import BasePromptTemplate
 from langchain.schema import BaseMessage, BaseRetriever, Document
 from langchain.vectorstores.base import VectorStore
 
+from .metrics import Metrics
+
 # Depending on the memory type and configuration, the chat history format may differ.
 # This needs to be consolidated.
 CHAT_TURN_TYPE = Union[Tuple[str, str], BaseMessage]
@@ -108,8 +110,13 @@ class BaseConversationalRetrievalChain(Chain):
             #)
         #else:
         new_question = question
-        docs = self._get_docs(new_question, inputs)
+        # NOTE: Documents retrieved by the caller beforehand (see SingleFlight) are not fetched again
+        if "input_documents" in inputs:
+            docs = inputs["input_documents"]
+        else:
+            docs = self._get_docs(new_question, inputs)
         new_inputs = inputs.copy()
+        new_inputs.pop("input_documents", None)
         new_inputs["question"] = new_question
         new_inputs["chat_history"] = chat_history_str
         answer = self.combine_docs_chain.run(
@@ -143,8 +150,12 @@ class BaseConversationalRetrievalChain(Chain):
             #)
         #else:
         new_question = question
-        docs = await self._aget_docs(new_question, inputs)
+        if "input_documents" in inputs:
+            docs = inputs["input_documents"]
+        else:
+            docs = await self._aget_docs(new_question, inputs)
         new_inputs = inputs.copy()
+        new_inputs.pop("input_documents", None)
         new_inputs["question"] = new_question
         new_inputs["chat_history"] = chat_history_str
         answer = await self.combine_docs_chain.arun(
@@ -190,7 +201,8 @@ class ConversationalRetrievalChain(BaseConversationalRetrievalChain):
         return docs[:num_docs]
 
     def _get_docs(self, question: str, inputs: Dict[str, Any]) -> List[Document]:
-        docs = self.retriever.get_relevant_documents(question)
+        with Metrics.timer("retrieval"):
+            docs = self.retriever.get_relevant_documents(question)
         return self._reduce_tokens_below_limit(docs)
 
     async def _aget_docs(self, question: str, inputs: Dict[str, Any]) -> List[Document]:
@@ -0,0 +1,119 @@
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+from langchain.schema import BaseRetriever, Document
+from pymongo.collection import Collection
+from collections import OrderedDict
+from datetime import datetime
+from typing import List
+
+import threading
+import asyncio
+import hashlib
+import os
+
+from .background_writer import BackgroundWriter
+from .single_flight import SingleFlight
+from .resilience import Resilience
+from .metrics import Metrics
+
+
+# NOTE: Maps normalized questions to their embedding, so repeated questions of a lesson skip the embedding request.
+# Every worker keeps its own LRU. With EMBEDDING_CACHE_SHARED=1 misses are looked up in mongodb as well, which lets
+# the workers share their vectors. Shared entries expire SHARED_MAX_AGE seconds after they were stored.
+class EmbeddingCache:
+    MAX_SIZE: int = 2048
+    SHARED: bool = os.environ.get("EMBEDDING_CACHE_SHARED", "0") == "1"
+    SHARED_MAX_AGE: int = 7 * 24 * 60 * 60
+
+    _lock = threading.Lock()
+    _entries: "OrderedDict[str, List[float]]" = OrderedDict()
+    _collection: Collection | None = None
+
+    @classmethod
+    def setup(cls, collection: Collection):
+        cls._collection = collection
+        if cls.SHARED:
+            collection.create_index("stored", expireAfterSeconds=cls.SHARED_MAX_AGE)
+
+    @classmethod
+    def get_key(cls, model: str, text: str) -> str:
+        key = f"{model}\n{SingleFlight.normalize_question(text)}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def get(cls, key: str) -> List[float] | None:
+        with cls._lock:
+            vector = cls._entries.get(key)
+            if vector is not None:
+                cls._entries.move_to_end(key)
+                return vector
+
+        if not cls.SHARED or cls._collection is None:
+            return None
+
+        with Metrics.timer("mongo.get_embedding"):
+            document = cls._collection.find_one({"_id": key}, {"vector": 1})
+        if document is None:
+            return None
+
+        cls._remember(key, document["vector"])
+        return document["vector"]
+
+    @classmethod
+    def put(cls, key: str, vector: List[float]):
+        cls._remember(key, vector)
+        if cls.SHARED and cls._collection is not None:
+            BackgroundWriter.upsert(
+                cls._collection,
+                {"_id": key},
+                {"$set": {"vector": vector, "stored": datetime.now()}},
+            )
+
+    @classmethod
+    def _remember(cls, key: str, vector: List[float]):
+        with cls._lock:
+            cls._entries[key] = vector
+            cls._entries.move_to_end(key)
+            while len(cls._entries) > cls.MAX_SIZE:
+                cls._entries.popitem(last=False)
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embedding: Embeddings):
+        self.embedding = embedding
+        self.model = getattr(embedding, "model", type(embedding).__name__)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embedding.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = EmbeddingCache.get_key(self.model, text)
+        vector = EmbeddingCache.get(key)
+        if vector is not None:
+            Metrics.increment(Metrics.EMBEDDING_CACHE, {"result": "hit"})
+            return vector
+
+        Metrics.increment(Metrics.EMBEDDING_CACHE, {"result": "miss"})
+        with Metrics.timer("embed_query"):
+            vector = self.embedding.embed_query(text)
+        EmbeddingCache.put(key, vector)
+        return vector
+
+
+# Embeds the question itself (through the cache) and searches the vector store by vector
+class VectorRetriever(BaseRetriever):
+    def __init__(self, vector_store: VectorStore, embedding: Embeddings, k: int = 4):
+        self.vector_store = vector_store
+        self.embedding = CachedEmbeddings(embedding)
+        self.k = k
+
+    # NOTE: The question is embedded by OpenAI and searched in weaviate, each step counts against its own breaker
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        vector = Resilience.call_with_retry(Resilience.OPENAI, self.embedding.embed_query, query)
+        return Resilience.call_with_retry(
+            Resilience.WEAVIATE, self.vector_store.similarity_search_by_vector, vector, k=self.k
+        )
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get_relevant_documents, query)
@@ -0,0 +1,174 @@
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.chat_models.base import BaseChatModel
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult, Document
+from typing import Any, Iterable, List, Optional, Tuple, Union
+
+import hashlib
+import math
+import time
+import os
+
+from .streaming_handler import StreamingHandler
+
+
+# NOTE: Offline stand-ins for OpenAI and Weaviate. They are used when the server is started with FAKE_LLM=1,
+# e.g. by the benchmarks. Results are deterministic, so runs can be compared with each other.
+def env_float(key: str, default: float) -> float:
+    return float(os.environ.get(key, default))
+
+
+def env_int(key: str, default: int) -> int:
+    return int(os.environ.get(key, default))
+
+
+FAKE_WORDS: Tuple[str, ...] = (
+    "Moin", "!", " Ich", " bin", " Hugo", " Eckener", " und", " helfe", " dir", " gerne",
+    " weiter", ".", " Die", " Antwort", " steht", " in", " deinen", " Unterlagen", " 🎈",
+)
+
+
+class FakeChatOpenAI(BaseChatModel):
+    model_name: str = "fake-gpt"
+    temperature: float = 0.7
+    max_tokens: Optional[int] = None
+    openai_api_key: Optional[str] = None
+    streaming: bool = False
+    request_timeout: Optional[Union[float, Tuple[float, float]]] = None
+    max_retries: int = 1
+
+    # Tokens per second of a streamed answer
+    tokens_per_second: float = env_float("FAKE_LLM_TOKENS_PER_SECOND", 50.0)
+    # Seconds until the first token arrives
+    first_token_latency: float = env_float("FAKE_LLM_FIRST_TOKEN_LATENCY", 0.3)
+    # Amount of tokens of every answer
+    response_tokens: int = env_int("FAKE_LLM_RESPONSE_TOKENS", 80)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-openai"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"model_name": self.model_name, "temperature": self.temperature}
+
+    def get_tokens(self, messages: List[BaseMessage]) -> List[str]:
+        prompt = "".join(message.content for message in messages)
+        offset = int(hashlib.sha1(prompt.encode("utf-8")).hexdigest(), 16)
+        amount = self.response_tokens
+        if self.max_tokens is not None:
+            amount = min(amount, self.max_tokens)
+        return [FAKE_WORDS[(offset + idx) % len(FAKE_WORDS)] for idx in range(amount)]
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+    ) -> ChatResult:
+        tokens = self.get_tokens(messages)
+        time.sleep(self.first_token_latency)
+        # NOTE: Stops like CancellableChatOpenAI once every student waiting for the answer disconnected
+        cancelled = False
+        if self.streaming:
+            for idx, token in enumerate(tokens):
+                if run_manager:
+                    run_manager.on_llm_new_token(token)
+                    if StreamingHandler.is_run_cancelled(run_manager.handlers):
+                        tokens = tokens[: idx + 1]
+                        cancelled = True
+                        break
+                time.sleep(1 / self.tokens_per_second)
+        else:
+            time.sleep(len(tokens) / self.tokens_per_second)
+
+        message = AIMessage(content="".join(tokens))
+        return ChatResult(generations=[ChatGeneration(message=message)], llm_output={"cancelled": cancelled})
+
+    def _combine_llm_outputs(self, llm_outputs: List[Optional[dict]]) -> dict:
+        return {"cancelled": any(x is not None and x.get("cancelled", False) for x in llm_outputs)}
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+    ) -> ChatResult:
+        raise NotImplementedError("FakeChatOpenAI does not support async")
+
+
+# Deterministic bag of words embedding
+class FakeEmbeddings(Embeddings):
+    DIMENSION: int = 256
+
+    def __init__(self, latency: float = env_float("FAKE_EMBEDDING_LATENCY", 0.05)):
+        self.latency = latency
+
+    def embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.DIMENSION
+        for word in text.lower().split():
+            digest = hashlib.sha1(word.encode("utf-8")).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.DIMENSION] += 1.0
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [self.embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return self.embed(text)
+
+
+# In memory replacement of the weaviate vector store
+class FakeVectorStore(VectorStore):
+    def __init__(self, embedding: Embeddings):
+        self.embedding = embedding
+        self.vectors: List[List[float]] = []
+        self.documents: List[Document] = []
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        self.vectors.extend(self.embedding.embed_documents(texts))
+        self.documents.extend(
+            Document(page_content=text, metadata=metadata)
+            for text, metadata in zip(texts, metadatas)
+        )
+        return [str(idx) for idx in range(len(self.documents) - len(texts), len(self.documents))]
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        scores = [
+            (sum(a * b for a, b in zip(embedding, vector)), idx)
+            for idx, vector in enumerate(self.vectors)
+        ]
+        scores.sort(reverse=True)
+        return [self.documents[idx] for _, idx in scores[:k]]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k)
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> "FakeVectorStore":
+        store = cls(embedding)
+        if len(texts) > 0:
+            store.add_texts(texts, metadatas)
+        return store
@@ -0,0 +1,36 @@
+from bson.objectid import ObjectId
+from datetime import datetime
+from typing import Any
+
+import json
+
+# NOTE: orjson serializes several times faster than the json module. Without it the json module is used.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Converts the values json can't serialize by itself
+def default(value: Any):
+    if hasattr(value, "to_bson"):
+        return value.to_bson()
+    if isinstance(value, ObjectId):
+        return str(value)
+    if hasattr(value, "as_datetime"):
+        value = value.as_datetime()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value, default=default)
+    return json.dumps(value, default=default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
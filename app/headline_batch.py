@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List
+
+from .langchain_connection import LangChainConnection
+from .mongodb_connection import MongoDBConnection
+from .tracing import Tracer
+from . import fast_json
+
+
+# NOTE: Generates the headlines of many chunks of information at once. Identical contents are only generated once,
+# at most MAX_PARALLEL completions run at the same time. Every headline is yielded as a NDJSON line as soon as it is
+# finished, so the order of the lines doesn't match the order of the contents (use "index").
+class HeadlineBatch:
+    MAX_CONTENTS: int = 200
+    MAX_PARALLEL: int = 4
+
+    @classmethod
+    def generate(cls, model: str, contents: List[str]) -> Iterator[bytes]:
+        indexes: Dict[str, List[int]] = {}
+        for index, content in enumerate(contents):
+            indexes.setdefault(content, []).append(index)
+        if len(indexes) == 0:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=min(cls.MAX_PARALLEL, len(indexes)))
+        try:
+            # NOTE: Every task gets its own copy of the context, so its spans belong to the current trace
+            futures = {
+                executor.submit(Tracer.wrap(LangChainConnection.generate_headline), model, content): content
+                for content in indexes
+            }
+            for future in as_completed(futures):
+                try:
+                    headline, cached = future.result()
+                    result = {"headline": headline, "cached": cached}
+                except Exception as ex:
+                    MongoDBConnection.add_exception("generate_headlines", ex)
+                    result = {"error": str(ex)}
+
+                for index in indexes[futures[future]]:
+                    yield fast_json.dumps({"index": index, **result}) + b"\n"
+        finally:
+            # NOTE: Stops pending completions if the client disconnects
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,59 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Dict, List, Tuple
+
+import threading
+
+from .mongodb_connection import MongoDBConnection
+
+
+# NOTE: Keeps the headlines of the informations cited in chat histories, so the chat history views don't query the
+# information collection on every page. Informations changed in the admin are invalidated right away, entries older
+# than MAX_AGE are read again, so changes of other workers show up too. Deleted informations are cached as None.
+class InformationHeadlines:
+    MAX_SIZE: int = 4096
+    MAX_AGE: float = 5 * 60
+
+    _lock = threading.Lock()
+    _entries: "OrderedDict[str, Tuple[float, str | None]]" = OrderedDict()
+
+    # Maps every given information id to its headline. Unknown or deleted informations are left out.
+    @classmethod
+    def get(cls, info_ids: List[str]) -> Dict[str, str]:
+        now = monotonic()
+        headlines = {}
+        missing = []
+        with cls._lock:
+            for info_id in dict.fromkeys(info_ids):
+                entry = cls._entries.get(info_id)
+                if entry is None or now - entry[0] >= cls.MAX_AGE:
+                    missing.append(info_id)
+                    continue
+                cls._entries.move_to_end(info_id)
+                if entry[1] is not None:
+                    headlines[info_id] = entry[1]
+
+        if len(missing) == 0:
+            return headlines
+
+        # NOTE: All misses are resolved with a single query
+        found = MongoDBConnection.get_information_headlines(missing)
+        headlines.update(found)
+        with cls._lock:
+            for info_id in missing:
+                cls._entries[info_id] = (now, found.get(info_id))
+                cls._entries.move_to_end(info_id)
+            while len(cls._entries) > cls.MAX_SIZE:
+                cls._entries.popitem(last=False)
+
+        return headlines
+
+    # Forgets the given informations, or every information if no ids are given
+    @classmethod
+    def invalidate(cls, info_ids: List[str] | None = None):
+        with cls._lock:
+            if info_ids is None:
+                cls._entries.clear()
+                return
+            for info_id in info_ids:
+                cls._entries.pop(str(info_id), None)
@@ -0,0 +1,231 @@
+from pymongo.operations import InsertOne
+from werkzeug.datastructures import FileStorage, MultiDict
+from bson.objectid import ObjectId
+from typing import Iterator, List, Tuple
+from wtforms import form
+
+import json
+import uuid
+import csv
+import io
+import os
+
+from .mongodb_connection import MongoDBConnection
+from .metrics import Metrics
+
+
+class ImportResult:
+    def __init__(self):
+        self.rows = 0
+        self.inserted = 0
+        self.failed = 0
+        self.errors: List[dict] = []
+
+    def add_error(self, row: int, errors: dict):
+        self.failed += 1
+        if len(self.errors) < InformationImport.MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "errors": errors})
+
+
+# NOTE: Imports many informations from one upload. The upload is stored in UPLOAD_DIR and parsed line by line, so the
+# whole file is never held in memory. Every row is validated with the rules of the InformationForm and the valid rows
+# are inserted in batches of BATCH_SIZE. Imported informations are tagged like informations created in the admin ui.
+#
+# Formats:
+#   - JSONL: One object per line, e.g. {"headline": "...", "content": "...", "source": "...", "subject_id": "..."}
+#   - CSV: A header row with the same columns
+#   - Markdown: Every heading starts a new information and has to be followed by a "Source: ..." line.
+# Rows without a subject_id are added to the subject selected for the upload.
+class InformationImport:
+    UPLOAD_DIR: str = os.environ.get(
+        "UPLOAD_DIR",
+        os.path.join(os.path.dirname(os.path.dirname(__file__)), "instance", "uploads"),
+    )
+    BATCH_SIZE: int = 500
+    MAX_REPORTED_ERRORS: int = 100
+    MAX_FIELD_SIZE: int = 10 * 1024 * 1024
+
+    JSONL: str = "jsonl"
+    CSV: str = "csv"
+    MARKDOWN: str = "markdown"
+    EXTENSIONS = {
+        ".jsonl": JSONL,
+        ".ndjson": JSONL,
+        ".csv": CSV,
+        ".md": MARKDOWN,
+        ".markdown": MARKDOWN,
+    }
+    FIELDS = ("headline", "content", "source", "subject_id")
+
+    @classmethod
+    def get_format(cls, filename: str) -> str | None:
+        return cls.EXTENSIONS.get(os.path.splitext(filename or "")[1].lower())
+
+    @classmethod
+    @Metrics.timer("information_import")
+    def run(
+        cls,
+        upload: FileStorage,
+        form_class: type[form.Form],
+        subject_choices: List[Tuple[str, str]],
+        default_subject_id: str | None = None,
+    ) -> ImportResult:
+        format = cls.get_format(upload.filename)
+        if format is None:
+            raise Exception(
+                f"Unsupported file '{upload.filename}'. Please upload a {', '.join(cls.EXTENSIONS)} file."
+            )
+
+        os.makedirs(cls.UPLOAD_DIR, exist_ok=True)
+        path = os.path.join(cls.UPLOAD_DIR, f"{uuid.uuid4().hex}.{format}")
+        upload.save(path)
+
+        try:
+            with open(path, "r", encoding="utf-8-sig", newline="") as file:
+                return cls.insert(cls.parse(file, format), form_class, subject_choices, default_subject_id)
+        finally:
+            os.remove(path)
+
+    @classmethod
+    def insert(
+        cls,
+        rows: Iterator[Tuple[int, dict | None, str | None]],
+        form_class: type[form.Form],
+        subject_choices: List[Tuple[str, str]],
+        default_subject_id: str | None,
+    ) -> ImportResult:
+        result = ImportResult()
+        batch = []
+        batch_rows = []
+
+        def _flush():
+            inserted, write_errors = MongoDBConnection.insert_informations(batch)
+            result.inserted += inserted
+            for write_error in write_errors:
+                result.add_error(batch_rows[write_error["index"]], {"database": [write_error["errmsg"]]})
+            batch.clear()
+            batch_rows.clear()
+
+        for row, data, error in rows:
+            result.rows += 1
+            if error is not None:
+                result.add_error(row, {"row": [error]})
+                continue
+
+            document, errors = cls.validate(data, form_class, subject_choices, default_subject_id)
+            if errors:
+                result.add_error(row, errors)
+                continue
+
+            batch.append(InsertOne(document))
+            batch_rows.append(row)
+            if len(batch) >= cls.BATCH_SIZE:
+                _flush()
+
+        if len(batch) > 0:
+            _flush()
+        return result
+
+    # Returns the document to insert, or the errors of the form fields
+    @classmethod
+    def validate(
+        cls,
+        data: dict,
+        form_class: type[form.Form],
+        subject_choices: List[Tuple[str, str]],
+        default_subject_id: str | None,
+    ) -> Tuple[dict | None, dict]:
+        values = MultiDict()
+        for key in cls.FIELDS:
+            value = data.get(key)
+            if value is None or value == "":
+                continue
+            if not isinstance(value, str):
+                return None, {key: ["Should be a string."]}
+            values[key] = value
+        if "subject_id" not in values and default_subject_id:
+            values["subject_id"] = default_subject_id
+
+        row_form = form_class(formdata=values)
+        row_form.subject_id.choices = subject_choices
+        if not row_form.validate():
+            return None, row_form.errors
+
+        document = {
+            "headline": row_form.headline.data,
+            "content": row_form.content.data,
+            "source": row_form.source.data,
+            "subject_id": ObjectId(row_form.subject_id.data),
+            "tag": MongoDBConnection.ADD_INFO_TAG,
+        }
+        return document, {}
+
+    # ----- Parser -----------------------------------------------------------------------------------------------------
+    # Yields the line number, the parsed row and a parse error (if the row couldn't be read)
+    @classmethod
+    def parse(cls, file: io.TextIOBase, format: str) -> Iterator[Tuple[int, dict | None, str | None]]:
+        if format == cls.JSONL:
+            return cls.parse_jsonl(file)
+        elif format == cls.CSV:
+            return cls.parse_csv(file)
+        else:
+            return cls.parse_markdown(file)
+
+    @classmethod
+    def parse_jsonl(cls, file: io.TextIOBase) -> Iterator[Tuple[int, dict | None, str | None]]:
+        for number, line in enumerate(file, start=1):
+            if line.strip() == "":
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError as ex:
+                yield number, None, f"Invalid JSON: {ex}"
+                continue
+
+            if isinstance(data, dict):
+                yield number, data, None
+            else:
+                yield number, None, "Should be a JSON object."
+
+    @classmethod
+    def parse_csv(cls, file: io.TextIOBase) -> Iterator[Tuple[int, dict | None, str | None]]:
+        csv.field_size_limit(cls.MAX_FIELD_SIZE)
+        reader = csv.DictReader(file)
+        while True:
+            try:
+                data = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as ex:
+                yield reader.line_num, None, f"Invalid CSV: {ex}"
+                continue
+            yield reader.line_num, data, None
+
+    @classmethod
+    def parse_markdown(cls, file: io.TextIOBase) -> Iterator[Tuple[int, dict | None, str | None]]:
+        number = 0
+        data = None
+        lines: List[str] = []
+        for line_number, line in enumerate(file, start=1):
+            line = line.rstrip("\r\n")
+            if line.startswith("#"):
+                if data is not None:
+                    yield cls.finish_markdown_section(number, data, lines)
+                number = line_number
+                data = {"headline": line.lstrip("#").strip()}
+                lines = []
+            elif data is not None:
+                if len(lines) == 0 and "source" not in data and line.lower().startswith("source:"):
+                    data["source"] = line[len("source:"):].strip()
+                elif len(lines) > 0 or line.strip() != "":
+                    lines.append(line)
+
+        if data is not None:
+            yield cls.finish_markdown_section(number, data, lines)
+
+    @classmethod
+    def finish_markdown_section(cls, number: int, data: dict, lines: List[str]) -> Tuple[int, dict | None, str | None]:
+        if "source" not in data:
+            return number, None, "Missing 'Source: ...' line after the heading."
+        data["content"] = "\n".join(lines).strip()
+        return number, data, None
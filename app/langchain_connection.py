@@ -1,125 +1,181 @@
 import weaviate
 from langchain.vectorstores.weaviate import Weaviate
 from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.chat_models import ChatOpenAI
 
 from langchain.memory import ConversationBufferWindowMemory
 from langchain.chains import LLMChain
-from langchain import PromptTemplate
-from typing import Dict, Any
+from typing import Callable, Dict, List, Tuple, Any
 
-from .streaming_handler import StreamingHandler
+import hashlib
+import uuid
+import os
+
+from .streaming_handler import StreamingHandler, TracingHandler
+from .cancellable_llm import CancellableChatOpenAI
 from .mongodb_connection import MongoDBConnection
+from .metrics import Metrics
+from .tracing import Tracer
+from .single_flight import SingleFlight
+from .resilience import Resilience
+from .openai_key_pool import OpenAIKeyPool
+from .vector_index import VectorIndex
+from .embedding_cache import VectorRetriever
 from .conversationalRetrievalChain import ConversationalRetrievalChain
+from .prompt_registry import CompiledPrompt, PromptRegistry
 
 
 class LangChainConnection:
     URL: str = "http://weaviate:8080/"
     # URL: str = "http://localhost:8080/"
     INDEX_NAME: str = "Information_Vectorstore"
+    # Informations embedded and uploaded at once while rebuilding the vector store
+    EMBED_BATCH_SIZE: int = 100
 
-    START_CHAT_MSG: str = """Du heißt Hugo Eckener und bist ein Luftschiffführer der sehr gerne anderen bei ihren Problemen hilft. 
-    Begrüße einen Schüler und stelle dich vor. 
-    Dutze deinen gegenüber immer. 
-    Du darfst Emoticons benutzen. 
-    Stelle bei der Begrüßung keine Fragen."""
-
-    DESCRIPTION_INSTRUCTION = """Fasse folgende Konversation in weniger als 5 Worten zusammen. Benutze dabei keine Anführungszeichen '"'.
-    Konversation:
-    Frage: {message}
-    Antwort: {result}"""
+    # NOTE: Replaces OpenAI and Weaviate with the offline stand-ins of fake_llm.py (used by the benchmarks)
+    FAKE_LLM: bool = os.environ.get("FAKE_LLM", "0") == "1"
+    fake_vector_store = None
 
-    HEADLINE_INSTRUCTION = """Erstelle einen Titel für den folgenden Text. Benutze dabei keine Anführungszeichen '"'.
-    Tex: {content}"""
+    # Models whose tokenizer tables are loaded by preload()
+    TOKENIZER_MODELS = ("gpt-3.5-turbo", "text-embedding-ada-002")
 
     @classmethod
     def setup_langchain(cls, openai_uid: str):
         cls.openai_uid = openai_uid
+        OpenAIKeyPool.setup(openai_uid)
         result = MongoDBConnection.openai.find_one({"uid": cls.openai_uid})
         if result is None:
             MongoDBConnection.openai.insert_one(
                 {
                     "uid": cls.openai_uid,
                     "api_key": "Please add your openai api key and update the weaviate vector store befor activating the chat bot.",
+                    "active": False,
                 }
             )
 
+    # ----- Warm-up ------------------------------------------------------------------------------------------------------
+    # NOTE: Runs before the workers are forked, so it must not open any connection
+    @classmethod
+    def preload(cls):
+        # NOTE: tiktoken downloads its tables on first use. The fake llm doesn't count tokens, so it's skipped offline.
+        encoding = None
+        if not cls.FAKE_LLM:
+            try:
+                import tiktoken
+
+                for model in cls.TOKENIZER_MODELS:
+                    tiktoken.encoding_for_model(model)
+                encoding = tiktoken.encoding_for_model(cls.TOKENIZER_MODELS[0])
+            except Exception as ex:
+                print(f"Failed to preload the tokenizer tables: {ex}", flush=True)
+
+        PromptRegistry.preload(encoding)
+
+    # Fills the caches of the current worker, so its first student doesn't wait for them
+    @classmethod
+    def warm_up(cls):
+        try:
+            OpenAIKeyPool.get_key()
+            VectorIndex.get_active_name(cls.INDEX_NAME)
+            if cls.FAKE_LLM:
+                cls.get_fake_vector_store()
+        except Exception as ex:
+            print(f"Failed to warm up the langchain connection: {ex}", flush=True)
+
+    # NOTE: Every call may return another key of the pool, so don't keep the key longer than a single request
     @classmethod
     def get_openai_api_key(cls) -> str:
-        if cls.openai_uid:
-            result = MongoDBConnection.openai.find_one({"uid": cls.openai_uid})
-            openai_key = result["api_key"]
-            if openai_key:
-                return openai_key
-            else:
-                raise Exception(
-                    "Missing OpenAI API Key. Please contact your admin or add the api key."
-                )
-        else:
-            raise Exception(
-                "Missing OpenAI UID. Please provide a openai uid and restart the server."
-            )
+        return OpenAIKeyPool.get_key()
 
+    # ----- Model Factories ----------------------------------------------------------------------------------------------
+    # NOTE: Retries are done by Resilience (max_retries=1 means a single attempt), so they are bounded and jittered
     @classmethod
+    def create_chat_model(cls, **kwargs):
+        kwargs.setdefault("request_timeout", Resilience.get_timeout())
+        kwargs.setdefault("max_retries", 1)
+        if cls.FAKE_LLM:
+            from .fake_llm import FakeChatOpenAI
+
+            return FakeChatOpenAI(**kwargs)
+        return CancellableChatOpenAI(**kwargs)
+
+    @classmethod
+    def create_embedding(cls, openai_key: str):
+        if cls.FAKE_LLM:
+            from .fake_llm import FakeEmbeddings
+
+            return FakeEmbeddings()
+        return OpenAIEmbeddings(
+            openai_api_key=openai_key,
+            request_timeout=Resilience.get_timeout(),
+            max_retries=1,
+        )
+
+    @classmethod
+    def create_weaviate_client(cls, openai_key: str) -> weaviate.Client:
+        return Resilience.call(
+            Resilience.WEAVIATE,
+            weaviate.Client,
+            url=cls.URL,
+            additional_headers={"X-OpenAI-Api-Key": openai_key},
+            timeout_config=Resilience.get_timeout(),
+        )
+
+    # NOTE: The fake vector store lives in memory, so every worker builds its own copy on first use
+    @classmethod
+    def get_fake_vector_store(cls):
+        if cls.fake_vector_store is None:
+            cls.create_weaviate()
+        return cls.fake_vector_store
+
+    # ----- Chains -------------------------------------------------------------------------------------------------------
+    @classmethod
+    @Metrics.timer("chain_build")
     def get_qa_chain(
             cls,
             model: str,
             memory: ConversationBufferWindowMemory,
             callbackStream: StreamingHandler,
+            qa_prompt: CompiledPrompt | None = None,
     ) -> ConversationalRetrievalChain:
+        if qa_prompt is None:
+            qa_prompt = PromptRegistry.get(PromptRegistry.QA)
         openai_key = cls.get_openai_api_key()
 
-        client = weaviate.Client(
-            url=cls.URL,
-            additional_headers={"X-OpenAI-Api-Key": openai_key},
-        )
-        embedding = OpenAIEmbeddings(openai_api_key=openai_key)
-        vector_store = Weaviate(
-            client=client,
-            index_name=cls.INDEX_NAME,
-            text_key="text",
-            embedding=embedding,
-            attributes=["source"],
-        )
-
-        template = """Du heißt Hugo Eckener und ein freundlicher älterer Herr der sehr gerne anderen bei ihren Problemen hilft. Dutze deinen gegenüber immer.
-        
-        Falls die Antwort nicht in den in diesem Prompt übergebenen Informationen vorkommt, antworte immer mit "Keine Ahnung" und gib niemals eine andere Antwort. 
-        Ansonsten beantworte die Frage ausschließlich mit den übergebenen Informationen. 
-
-        Regel: Benutze immer Emoticons in deinen Antworten!
-
-        Informationen:
-        {context}
-
-        Erinnerung:
-        {chat_history}
-        Human: {question}
-        Hugo Eckener:"""
-
-        combine_docs_custom_prompt = PromptTemplate(
-            input_variables=["chat_history", "question", "context"], template=template
-        )
+        # NOTE: The question is embedded here instead of by weaviate, so repeated questions hit the EmbeddingCache
+        if cls.FAKE_LLM:
+            vector_store = cls.get_fake_vector_store()
+            embedding = vector_store.embedding
+        else:
+            client = cls.create_weaviate_client(openai_key)
+            embedding = cls.create_embedding(openai_key)
+            vector_store = Weaviate(
+                client=client,
+                index_name=VectorIndex.get_active_name(cls.INDEX_NAME),
+                text_key="text",
+                embedding=embedding,
+                attributes=["source"],
+            )
 
-        llm = ChatOpenAI(
+        llm = cls.create_chat_model(
             model_name=model,
             temperature=0.7,
             max_tokens=1024,
             openai_api_key=openai_key,
             streaming=True,
-            callbacks=[callbackStream],
+            callbacks=[callbackStream, TracingHandler()],
         )
 
         return ConversationalRetrievalChain.from_llm(
             llm=llm,
             memory=memory,
-            combine_docs_chain_kwargs=dict(prompt=combine_docs_custom_prompt),
-            retriever=vector_store.as_retriever(),
+            combine_docs_chain_kwargs=dict(prompt=qa_prompt.prompt),
+            retriever=VectorRetriever(vector_store, embedding),
             verbose=False,  # greed debug stuff,
             return_source_documents=True,
         )
 
     @classmethod
+    @Metrics.timer("qa_completion")
     def generate_qa_completion(
             cls,
             model: str,
@@ -127,51 +183,95 @@ class LangChainConnection:
             callbackStream: StreamingHandler,
             question: str,
     ):
-        chain = LangChainConnection.get_qa_chain(model, memory, callbackStream)
-        return chain({"question": question}, return_only_outputs=True)
+        qa_prompt = PromptRegistry.get(PromptRegistry.QA)
+        chain = LangChainConnection.get_qa_chain(model, memory, callbackStream, qa_prompt)
+
+        # NOTE: Retrieval runs for every request, identical questions on the same sources share one llm stream
+        docs = chain._get_docs(question, {})
+        key = SingleFlight.get_key(
+            model,
+            question,
+            [str(doc.metadata.get("source")) for doc in docs],
+            memory.buffer,
+            f"{qa_prompt.name}:{qa_prompt.version}",
+        )
+        flight, is_leader = SingleFlight.join(key, callbackStream)
+
+        if not is_leader:
+            Metrics.increment(Metrics.COALESCED_REQUESTS)
+            span = Tracer.current_span()
+            if span is not None:
+                span.set_attribute("coalesced", True)
+            return flight.wait()
+
+        try:
+            # NOTE: Not retried, tokens of a failed attempt were already streamed to the students
+            result = Resilience.call(
+                Resilience.OPENAI,
+                chain,
+                {"question": question, "input_documents": docs},
+                return_only_outputs=True,
+                callbacks=[flight],
+            )
+            flight.finish(result)
+            return result
+        except BaseException as ex:
+            flight.finish(error=ex)
+            raise
+        finally:
+            SingleFlight.leave(flight)
 
     @classmethod
-    def get_simple_chain(
-            cls, model: str, message: str, prompt_kwargs: Dict[str, Any] = None
-    ) -> LLMChain:
+    def get_simple_chain(cls, model: str, prompt: CompiledPrompt) -> LLMChain:
         openai_key = cls.get_openai_api_key()
 
-        if prompt_kwargs != None:
-            if "message" in prompt_kwargs and "result" in prompt_kwargs:
-                message = message.replace("{message}", prompt_kwargs["message"])
-                message = message.replace("{result}", prompt_kwargs["result"])
-            elif "content" in prompt_kwargs:
-                message = message.replace("{content}", prompt_kwargs["content"])
-
-        prompt = PromptTemplate(input_variables=[], template=message)
-
-        llm = ChatOpenAI(model_name=model, openai_api_key=openai_key)
+        llm = cls.create_chat_model(
+            model_name=model, openai_api_key=openai_key, callbacks=[TracingHandler()]
+        )
 
-        return LLMChain(llm=llm, prompt=prompt)
+        return LLMChain(llm=llm, prompt=prompt.prompt)
 
+    # Runs the prompt of the registry (see PromptRegistry) with the given variables
     @classmethod
+    @Metrics.timer("simple_completion")
     def generate_simple_completion(
-            cls, model: str, message: str, prompt_kwargs: Dict[str, Any] = None
+            cls, model: str, name: str, prompt_kwargs: Dict[str, Any] = None
     ):
-        chain = LangChainConnection.get_simple_chain(model, message, prompt_kwargs)
+        prompt = PromptRegistry.get(name)
+
+        # NOTE: The chain is built per attempt, so a retry can pick another key of the pool
+        def _run():
+            chain = LangChainConnection.get_simple_chain(model, prompt)
+            return chain.run(prompt_kwargs or {})
 
-        description = chain.run({})
+        description = Resilience.call_with_retry(Resilience.OPENAI, _run)
         return description
 
+    # Returns the headline of the content and whether it was taken from the headline cache
+    # NOTE: The key contains the version of the prompt, so a new version doesn't return the old headlines
     @classmethod
-    def create_weaviate(cls):
-        openai_key = cls.get_openai_api_key()
+    def generate_headline(cls, model: str, content: str) -> Tuple[str, bool]:
+        prompt = PromptRegistry.get(PromptRegistry.HEADLINE)
+        key = "\n".join([model, prompt.name, str(prompt.version), prompt.template, content])
+        key = hashlib.sha1(key.encode("utf-8")).hexdigest()
 
-        client = weaviate.Client(
-            url=cls.URL,
-            additional_headers={"X-OpenAI-Api-Key": openai_key},
-        )
-        client.schema.delete_all()
+        headline = MongoDBConnection.get_cached_headline(key)
+        if headline is not None:
+            return headline, True
 
-        embedding = OpenAIEmbeddings(openai_api_key=openai_key)
+        headline = cls.generate_simple_completion(model, PromptRegistry.HEADLINE, {"content": content})
+        MongoDBConnection.add_cached_headline(key, headline)
+        return headline, False
+
+    @classmethod
+    @Metrics.timer("vector_store_rebuild")
+    def create_weaviate(cls, progress: Callable[[int, int], None] = None):
+        openai_key = cls.get_openai_api_key()
+        embedding = cls.create_embedding(openai_key)
 
         texts = []
         metadatas = []
+        uuids = []
 
         information = MongoDBConnection.get_live_information()
 
@@ -179,11 +279,84 @@ class LangChainConnection:
             content = f"{info['headline']}\n\n{info['content']}"
             texts.append(content)
             metadatas.append({"source": f"{info['_id']}"})
+            uuids.append(str(uuid.uuid5(uuid.NAMESPACE_OID, info["_id"])))
+
+        if progress is not None:
+            progress(0, len(texts))
+
+        if cls.FAKE_LLM:
+            from .fake_llm import FakeVectorStore
+
+            # NOTE: The new store replaces the old one only once it is complete
+            vector_store = FakeVectorStore(embedding)
+            for start in range(0, len(texts), cls.EMBED_BATCH_SIZE):
+                end = min(start + cls.EMBED_BATCH_SIZE, len(texts))
+                vector_store.add_texts(texts[start:end], metadatas[start:end])
+                if progress is not None:
+                    progress(end, len(texts))
+
+            cls.fake_vector_store = vector_store
+            return vector_store
+
+        # NOTE: Built into a new version while the active index keeps serving the students (see VectorIndex)
+        client = cls.create_weaviate_client(openai_key)
+        version, index_name = VectorIndex.create(cls.INDEX_NAME)
+        try:
+            vector_store = cls.fill_index(client, index_name, embedding, texts, metadatas, uuids, progress)
+            cls.verify_index(client, index_name, len(texts))
+        except BaseException:
+            VectorIndex.fail(version)
+            raise
+
+        VectorIndex.activate(version, len(texts), cls.INDEX_NAME)
+
+        try:
+            VectorIndex.collect_garbage(client)
+        except Exception as ex:
+            print(f"Failed to delete retired vector indexes: {ex}", flush=True)
+
+        return vector_store
+
+    # NOTE: Embedded in batches to report progress. Retrying a batch is idempotent, because the object uuids are
+    # derived from the information ids. At least one batch is sent, so an empty index is created as well.
+    @classmethod
+    def fill_index(
+            cls,
+            client: weaviate.Client,
+            index_name: str,
+            embedding,
+            texts: List[str],
+            metadatas: List[dict],
+            uuids: List[str],
+            progress: Callable[[int, int], None] = None,
+    ) -> Weaviate:
+        vector_store = None
+        for start in range(0, max(len(texts), 1), cls.EMBED_BATCH_SIZE):
+            end = min(start + cls.EMBED_BATCH_SIZE, len(texts))
+            vector_store = Resilience.call_with_retry(
+                Resilience.WEAVIATE,
+                Weaviate.from_texts,
+                texts=texts[start:end],
+                client=client,
+                embedding=embedding,
+                metadatas=metadatas[start:end],
+                uuids=uuids[start:end],
+                index_name=index_name,
+            )
+            if progress is not None:
+                progress(end, len(texts))
+
+        return vector_store
 
-        return Weaviate.from_texts(
-            texts=texts,
-            client=client,
-            embedding=embedding,
-            metadatas=metadatas,
-            index_name=cls.INDEX_NAME,
+    @classmethod
+    def verify_index(cls, client: weaviate.Client, index_name: str, expected: int):
+        result = Resilience.call_with_retry(
+            Resilience.WEAVIATE,
+            lambda: client.query.aggregate(index_name).with_meta_count().do(),
         )
+        rows = result.get("data", {}).get("Aggregate", {}).get(index_name) or [{"meta": {"count": 0}}]
+        count = rows[0]["meta"]["count"]
+        if count != expected:
+            raise Exception(
+                f"The new vector index '{index_name}' contains {count} instead of {expected} informations."
+            )
@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timedelta
+from time import monotonic, sleep
+
+import threading
+import uuid
+
+from .mongodb_connection import MongoDBConnection
+from .metrics import Metrics
+
+
+# A held lease. A heartbeat thread extends the expiry until the lease is released.
+class Lease:
+    def __init__(self, lock: "LeaseLock", owner: str):
+        self.lock = lock
+        self.owner = owner
+        self.lost = False
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self.run_heartbeat, daemon=True)
+        self.heartbeat.start()
+
+    def run_heartbeat(self):
+        while not self.stopped.wait(self.lock.heartbeat_interval):
+            try:
+                extended = self.lock.extend(self.owner)
+            except Exception as ex:
+                print(f"Failed to extend the lease of '{self.lock.name}': {ex}", flush=True)
+                continue
+            if not extended:
+                self.lost = True
+                return
+
+    # Raises if another owner took over the lease after it expired (e.g. this worker was paused too long)
+    def check(self):
+        if self.lost:
+            raise Exception(f"Lost the lock '{self.lock.name}' while holding it.")
+
+    def release(self):
+        self.stopped.set()
+        self.lock.release(self.owner)
+
+
+# NOTE: Lock shared by all workers and containers through the Lock collection. The holder is stored with an expiry,
+# so the lock is freed even if its worker dies. Expiries are compared with the local clock of the workers.
+class LeaseLock:
+    def __init__(self, name: str, ttl: float = 30.0, heartbeat_interval: float = 10.0):
+        self.name = name
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+
+    def try_acquire(self, **data) -> Lease | None:
+        owner = f"{Metrics.get_worker_id()}:{uuid.uuid4().hex}"
+        now = datetime.now()
+        try:
+            MongoDBConnection.lock.update_one(
+                {"_id": self.name, "expires_at": {"$lt": now}},
+                {
+                    "$set": {
+                        "owner": owner,
+                        "acquired_at": now,
+                        "expires_at": now + timedelta(seconds=self.ttl),
+                        "data": data,
+                    }
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return None
+        return Lease(self, owner)
+
+    def acquire(self, timeout: float = 30.0, **data) -> Lease:
+        deadline = monotonic() + timeout
+        while True:
+            lease = self.try_acquire(**data)
+            if lease is not None:
+                return lease
+            if monotonic() >= deadline:
+                raise Exception(
+                    f"'{self.name}' is locked by another update. Please try again later."
+                )
+            sleep(0.1)
+
+    @contextmanager
+    def hold(self, timeout: float = 30.0, **data):
+        lease = self.acquire(timeout, **data)
+        try:
+            yield lease
+        finally:
+            lease.release()
+
+    def extend(self, owner: str) -> bool:
+        result = MongoDBConnection.lock.update_one(
+            {"_id": self.name, "owner": owner},
+            {"$set": {"expires_at": datetime.now() + timedelta(seconds=self.ttl)}},
+        )
+        return result.matched_count == 1
+
+    def release(self, owner: str):
+        MongoDBConnection.lock.delete_one({"_id": self.name, "owner": owner})
+
+    # Returns the lock document of the current holder, or None if the lock is free
+    def get_holder(self) -> dict | None:
+        return MongoDBConnection.lock.find_one(
+            {"_id": self.name, "expires_at": {"$gte": datetime.now()}}
+        )
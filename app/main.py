@@ -1,24 +1,31 @@
-from langchain.memory import ConversationBufferWindowMemory
 from bson.objectid import ObjectId
 from flask_admin import Admin, AdminIndexView, helpers, expose
 from flask_cors import CORS
 from wtforms import form, fields, validators
 from typing import Callable
-from flask import Flask, Response, url_for, redirect, stream_with_context, request
-from queue import Queue
+from flask import Flask, Response, url_for, redirect, stream_with_context, request, g
+from queue import Empty, Queue
 
-from .langchain_connection import LangChainConnection
 from .mongodb_connection import MongoDBConnection
-from .streaming_handler import StreamingHandler
+from .background_writer import BackgroundWriter
+from .resilience import Resilience
+from .metrics import Metrics
+from .chat_history_export import ChatHistoryExport
+from .tracing import Tracer
 from . import admin_classes as ad_cls
+from . import fast_json
 
 import flask_login as login
 
 import traceback
 import threading
-import json
+import uuid
+import time
 import os
 
+# NOTE: LangChain, weaviate and openai take seconds to import. They are only imported by the request handlers
+# or by preload()/warm_up() at the bottom of this file, so importing the app itself stays fast.
+
 INSTRUCT_MODEL: str = "gpt-3.5-turbo"  # NOTE: Limitiert auf 4096 Tokens!
 CHAT_MODEL: str = "gpt-3.5-turbo"
 MEMORY_SIZE: int = 4
@@ -31,6 +38,8 @@ app.config["OPEN_AI_UID"] = os.environ.get("OPEN_AI_UID")
 app.config["MASTER_ID"] = os.environ.get("MASTER_ID")
 app.config["MASTER_NAME"] = os.environ.get("MASTER_NAME")
 app.config["MASTER_PASS"] = os.environ.get("MASTER_PASS")
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+app.config["FAKE_LLM"] = os.environ.get("FAKE_LLM", "0") == "1"
 cors = CORS(app)
 
 
@@ -46,12 +55,19 @@ def verify_header_in_config(key: str):
     return value == value_config
 
 
+# NOTE: Prometheus sends its credentials as "Authorization: Bearer <token>"
+def verify_metrics_token():
+    token = app.config.get("METRICS_TOKEN", None)
+    return token is not None and request.headers.get("Authorization") == f"Bearer {token}"
+
+
 def exception_wrapper(function: Callable[..., Response], *args, **kwargs) -> Response:
     try:
         return function(*args, **kwargs)
     except Exception as ex:
+        Metrics.increment(Metrics.EXCEPTIONS, {"endpoint": function.__name__})
         error = traceback.format_exc()
-        MongoDBConnection.add_exception(function.__name__, error)
+        MongoDBConnection.add_exception(function.__name__, ex)
         print(error, flush=True)
         return Response(str(ex), 500, mimetype="text/plain")
 
@@ -128,16 +144,19 @@ def init_login():
 
 # Create customized index view class that handles login & registration
 class MyAdminIndexView(AdminIndexView):
+    LOG_SIZE: int = 100
+
     def add_log(self):
-        pass
-        # path = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
-        # text = None
-        # with open(os.path.join(path, "log.txt"), "r", encoding="utf-8") as file:
-        #     text = file.read()
-        #     file.close()
-        #
-        # if text is not None:
-        #     self._template_args["log"] = text
+        if not getattr(login.current_user, "is_admin", False):
+            return
+
+        logs = MongoDBConnection.get_logs(self.LOG_SIZE)
+        text = "\n".join(
+            f"""{log['time'].strftime("%Y-%m-%d, %H:%M:%S")}: {log['message']}"""
+            for log in logs
+        )
+        if text:
+            self._template_args["log"] = text
 
     def add_admin_info(self):
         if hasattr(login.current_user, "is_admin"):
@@ -173,6 +192,22 @@ class MyAdminIndexView(AdminIndexView):
         return redirect(url_for(".index"))
 
 
+# NOTE: Lets the load generator attribute every stream to its uWSGI worker and measure how long the request
+# waited for a free worker. Only exposed in fake llm mode.
+@app.before_request
+def add_request_start():
+    g.request_start = time.time()
+    warm_up()
+
+
+@app.after_request
+def add_worker_id(response: Response):
+    if app.config["FAKE_LLM"]:
+        response.headers["X-Worker-Id"] = str(os.getpid())
+        response.headers["X-Request-Start"] = str(g.request_start)
+    return response
+
+
 # ============================================= Student Endpoints =============================================
 @app.route("/")
 def index():
@@ -188,7 +223,7 @@ def get_token():
             return Response(status=401)
 
         token = MongoDBConnection.get_bearer_token()
-        response = json.dumps(token, default=lambda o: o.__dict__)
+        response = fast_json.dumps(token)
         return Response(response, 200, mimetype="application/json")
 
     return exception_wrapper(_get_token)
@@ -198,6 +233,10 @@ def get_token():
 # OR
 # Return the complete data for a specific chat history
 # JsonData: {"history_id":"649d455a00e6409df6ee9f92"}
+# OR
+# Return a page of a specific chat history (see MongoDBConnection.get_chat_history)
+# JsonData: {"history_id":"649d455a00e6409df6ee9f92", "before_idx":120, "limit":20}
+# JsonData: {"history_id":"649d455a00e6409df6ee9f92", "since":118}
 @app.route("/start_session", methods=["POST", "GET"])
 @app.route("/start_session/", methods=["POST", "GET"])
 def start_session():
@@ -206,20 +245,41 @@ def start_session():
 
     # Generate greeting msg
     def _start_session():
+        from .langchain_connection import LangChainConnection
+        from .prompt_registry import PromptRegistry
+
         result = LangChainConnection.generate_simple_completion(
-            INSTRUCT_MODEL, LangChainConnection.START_CHAT_MSG
+            INSTRUCT_MODEL, PromptRegistry.GREETING
         )
 
         history_id = MongoDBConnection.create_chat_history(result)
         data = {"history_id": str(history_id), "message": result}
-        response = json.dumps(data, default=lambda o: o.__dict__)
+        response = fast_json.dumps(data)
         return Response(response, 200, mimetype="application/json")
 
+    def get_history_page(data: dict) -> dict:
+        page = {}
+        for key in ["before_idx", "limit", "since"]:
+            value = data.get(key)
+            if value is None:
+                continue
+            if type(value) != int or value < (1 if key == "limit" else 0):
+                raise ValueError(f"'{key}' should be a {'positive' if key == 'limit' else 'non-negative'} integer.")
+            page[key] = value
+        if "before_idx" in page and "since" in page:
+            raise ValueError("Use either 'before_idx' or 'since', not both.")
+        return page
+
     # Get chat history
     def _get_history_data(data: dict):
         if "history_id" in data:
-            result = MongoDBConnection.get_chat_history(data["history_id"])
-            response = json.dumps(result, default=lambda o: o.__dict__)
+            try:
+                page = get_history_page(data)
+            except ValueError as ex:
+                return Response(str(ex), 400, mimetype="text/plain")
+
+            result = MongoDBConnection.get_chat_history(data["history_id"], **page)
+            response = fast_json.dumps(result)
             return Response(response, 200, mimetype="application/json")
         else:
             raise KeyError(
@@ -240,30 +300,49 @@ def start_session():
 @app.route("/get_response/", methods=["POST", "GET"])
 def get_response():
     def _get_response(data: dict) -> Response:
+        from langchain.memory import ConversationBufferWindowMemory
+        from .langchain_connection import LangChainConnection
+        from .prompt_registry import PromptRegistry
+        from .streaming_handler import StreamingHandler
+
         if verify_bearer_token() == False:
             return Response(status=401)
 
         queue = Queue()
         callback_fn = StreamingHandler(queue)
 
+        # NOTE: Frees the worker when the llm doesn't answer in time. Later tokens are bounded by the read timeout
+        # of the llm request itself, which reports its error through the queue.
+        # If the stream isn't read to the end (the client disconnected or timed out), the llm call is cancelled.
         def generate_token_stream(token_queue: Queue):
+            timeout = Resilience.FIRST_TOKEN_TIMEOUT
+            reason = "disconnect"
             is_reading_tokens = True
-            while is_reading_tokens:
-                token = token_queue.get()
-                if token == StreamingHandler.STOP_ITEM:
-                    is_reading_tokens = False
-                else:
-                    yield token
-
+            try:
+                while is_reading_tokens:
+                    try:
+                        token = token_queue.get(timeout=timeout)
+                    except Empty:
+                        Metrics.increment(Metrics.FIRST_TOKEN_TIMEOUTS)
+                        reason = "timeout"
+                        yield "OpenAI didn't answer in time. Please try again."
+                        return
+                    timeout = None
+                    if token == StreamingHandler.STOP_ITEM:
+                        is_reading_tokens = False
+                    else:
+                        yield token
+            finally:
+                if is_reading_tokens:
+                    callback_fn.cancel()
+                    Metrics.increment(Metrics.CANCELLED_ANSWERS, {"reason": reason})
+
+        @Metrics.timer("get_response")
         def get_api_response(
                 data_history_id: str, data_message: str, callback_fn: StreamingHandler
         ):
             try:
-                last_messages = MongoDBConnection.get_last_messages(
-                    data_history_id, MEMORY_SIZE
-                )
-
-                MongoDBConnection.add_chat_history_message(
+                message_idx = MongoDBConnection.add_chat_history_message(
                     data_history_id,
                     data_message,
                     "",
@@ -271,9 +350,15 @@ def get_response():
                     [],
                 )
 
+                # NOTE: Read after adding the message, which reloads the history if another worker changed it
+                last_messages = MongoDBConnection.get_last_messages(
+                    data_history_id, MEMORY_SIZE, before_idx=message_idx
+                )
+
                 memory = ConversationBufferWindowMemory(
                     k=MEMORY_SIZE,
                     memory_key="chat_history",
+                    input_key="question",
                     output_key="answer",
                     return_messages=True,
                 )
@@ -289,18 +374,21 @@ def get_response():
                     for sources in result["source_documents"]
                 ]
 
+                # NOTE: A cancelled answer is stored as far as it was streamed, without spending tokens on a description
                 description = None
-                if len(last_messages) == 0:
-                    description = LangChainConnection.generate_simple_completion(
-                        INSTRUCT_MODEL,
-                        LangChainConnection.DESCRIPTION_INSTRUCTION,
-                        {"message": data_message, "result": result["answer"]},
-                    )
+                if len(last_messages) == 0 and not callback_fn.is_cancelled():
+                    with Metrics.timer("description"):
+                        description = LangChainConnection.generate_simple_completion(
+                            INSTRUCT_MODEL,
+                            PromptRegistry.DESCRIPTION,
+                            {"message": data_message, "result": result["answer"]},
+                        )
 
                 subject_ids = MongoDBConnection.get_information_subject_ids(source_ids)
 
                 MongoDBConnection.update_chat_history(
                     data_history_id,
+                    message_idx,
                     description,
                     subject_ids,
                     result["answer"],
@@ -308,12 +396,22 @@ def get_response():
                 )
 
             except Exception as ex:
+                Tracer.current_span().set_error(ex)
+                Metrics.increment(Metrics.EXCEPTIONS, {"endpoint": get_response.__name__})
+                MongoDBConnection.add_exception(get_response.__name__, ex)
                 callback_fn.queue.put(str(ex))
                 callback_fn.queue.put(StreamingHandler.STOP_ITEM)
 
+        # NOTE: The root span ends together with the worker thread, not with this request handler
+        request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
         if "history_id" in data and "message" in data:
+            root_span = Tracer.start_span(
+                f"/{get_response.__name__}",
+                trace_id=request_id,
+                history_id=data["history_id"],
+            )
             thread = threading.Thread(
-                target=get_api_response,
+                target=Tracer.wrap(get_api_response, root_span),
                 args=(data["history_id"], data["message"], callback_fn),
             )
             thread.start()
@@ -322,7 +420,11 @@ def get_response():
                 f"Data should contain 'history_id' and 'message' but didn't. Received: {data.keys()}"
             )
 
-        return Response(stream_with_context(generate_token_stream(queue)), 200)
+        return Response(
+            stream_with_context(generate_token_stream(queue)),
+            200,
+            headers={"X-Request-ID": request_id},
+        )
 
     if request.is_json:
         json_data = request.json
@@ -371,11 +473,9 @@ def generate_headline():
             return Response(status=401)
 
         if "content" in data:
-            result = LangChainConnection.generate_simple_completion(
-                INSTRUCT_MODEL,
-                LangChainConnection.HEADLINE_INSTRUCTION,
-                {"content": data["content"]},
-            )
+            from .langchain_connection import LangChainConnection
+
+            result, _ = LangChainConnection.generate_headline(INSTRUCT_MODEL, data["content"])
             return Response(result, 200, mimetype="text/plain")
         else:
             raise KeyError(
@@ -389,11 +489,50 @@ def generate_headline():
         return request_not_acceptable(generate_headline)
 
 
-# ============================================= Admin Endpoints =============================================
-weaviate_lock = threading.Lock()
+# Generates the headlines of many chunks of information at once.
+# The headlines are streamed as NDJSON lines in the order they are finished:
+# {"index":0,"headline":"Any headline","cached":false} or {"index":1,"error":"Any error"}
+# JsonData: {"contents":["Any content","Another content"]}
+@app.route("/generate_headlines", methods=["POST"])
+@app.route("/generate_headlines/", methods=["POST"])
+def generate_headlines():
+    def _generate_headlines(data: dict):
+        from .headline_batch import HeadlineBatch
 
+        if verify_bearer_token() == False:
+            return Response(status=401)
+
+        if "contents" in data and isinstance(data["contents"], list):
+            contents = data["contents"]
+            if len(contents) > HeadlineBatch.MAX_CONTENTS:
+                return Response(
+                    f"Too many contents. At most {HeadlineBatch.MAX_CONTENTS} are allowed per request.",
+                    413,
+                    mimetype="text/plain",
+                )
+            if not all(isinstance(x, str) for x in contents):
+                raise TypeError("Every element of 'contents' should be a string.")
 
-# Updates the vector-store with the current informations in the database
+            return Response(
+                stream_with_context(HeadlineBatch.generate(INSTRUCT_MODEL, contents)),
+                200,
+                mimetype="application/x-ndjson",
+            )
+        else:
+            raise KeyError(
+                f"Data should contain a list 'contents' but didn't. Received: {data.keys()}"
+            )
+
+    if request.is_json:
+        json_data = request.json
+        return exception_wrapper(_generate_headlines, json_data)
+    else:
+        return request_not_acceptable(generate_headlines)
+
+
+# ============================================= Admin Endpoints =============================================
+# Starts a background job updating the vector-store with the current informations in the database.
+# The progress can be requested from '/vector_store_job/<job_id>'.
 @app.route("/update_vector_store", methods=["POST", "GET"])
 @app.route("/update_vector_store/", methods=["POST", "GET"])
 def update_vector_store():
@@ -401,52 +540,144 @@ def update_vector_store():
     if verify_header_in_config("CREF_TOKEN") == False:
         return Response(status=401)
 
-    ad_cls.mongodb_lock.acquire(blocking=True)
+    def _update_vector_store():
+        from .vector_store_job import VectorStoreJob
+
+        job_id, started = VectorStoreJob.start()
+        if started:
+            type = "info"
+            msg = "Started the weaviate vector store update."
+            ad_cls.write_log(msg)
+        else:
+            type = "warning"
+            msg = "Weaviate vector store update allready in progress."
 
-    if weaviate_lock.acquire(blocking=False):
+        data = {"type": type, "msg": msg, "job_id": str(job_id) if job_id is not None else None}
+        return Response(fast_json.dumps(data), status=202, mimetype="application/json")
+
+    return exception_wrapper(_update_vector_store)
+
+
+@app.route("/vector_store_job/<job_id>", methods=["GET"])
+def vector_store_job(job_id: str):
+    # Check CREF_TOKEN
+    if verify_header_in_config("CREF_TOKEN") == False:
+        return Response(status=401)
+
+    def _vector_store_job():
+        from .vector_store_job import VectorStoreJob
+
+        status = VectorStoreJob.get_status(job_id)
+        if status is None:
+            return Response(status=404)
+        return Response(fast_json.dumps(status), status=200, mimetype="application/json")
+
+    return exception_wrapper(_vector_store_job)
+
+
+# Streams the chat histories for offline analysis, as NDJSON (default) or gzip compressed CSV.
+# Query: format=ndjson|csv, from=2023-09-01, to=2023-09-30, subject=<subject_id>, tag=<message tag>,
+# fields=date,messages (default: all fields)
+@app.route("/export_chat_histories", methods=["GET"])
+@app.route("/export_chat_histories/", methods=["GET"])
+def export_chat_histories():
+    # Check CREF_TOKEN
+    if verify_header_in_config("CREF_TOKEN") == False:
+        return Response(status=401)
+
+    def _export_chat_histories():
+        format = request.args.get("format", ChatHistoryExport.NDJSON)
         try:
-            weaviate = LangChainConnection.create_weaviate()
-            if weaviate is not None:
-                query = {"tag": MongoDBConnection.PRE_LIVE_INFO_TAG}
-                MongoDBConnection.update_information_tag(
-                    query, MongoDBConnection.LIVE_INFO_TAG
-                )
-                type = "info"
-                msg = "Successfully updated weaviate vector store."
-            else:
-                type = "warning"
-                msg = "Something went wrong during the weaviate vector store update. Please try again later."
-        except Exception as ex:
-            type = "error"
-            msg = f"Failed to update weaviate vector store: '{str(ex)}'"
+            if format not in (ChatHistoryExport.NDJSON, ChatHistoryExport.CSV):
+                raise ValueError(f"Unknown format '{format}'. Allowed are: ndjson, csv.")
+            query = ChatHistoryExport.get_query(request.args)
+            fields = ChatHistoryExport.get_fields(request.args.get("fields"))
+        except ValueError as ex:
+            return Response(str(ex), 400, mimetype="text/plain")
+
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        if format == ChatHistoryExport.CSV:
+            mimetype = "application/gzip"
+            filename = f"chat_histories_{stamp}.csv.gz"
+        else:
+            mimetype = "application/x-ndjson"
+            filename = f"chat_histories_{stamp}.ndjson"
+
+        return Response(
+            ChatHistoryExport.generate(format, query, fields),
+            200,
+            mimetype=mimetype,
+            headers={"Content-Disposition": f"attachment; filename={filename}"},
+        )
 
-        weaviate_lock.release()
-    else:
-        type = "warning"
-        msg = "Weaviate vector store update allready in progress."
+    return exception_wrapper(_export_chat_histories)
 
-    # Update admin log
-    ad_cls.write_log(msg)
 
-    ad_cls.mongodb_lock.release()
+# Exposes the latency metrics of all workers in the prometheus text format
+@app.route("/metrics", methods=["GET"])
+@app.route("/metrics/", methods=["GET"])
+def metrics():
+    if verify_metrics_token() == False:
+        return Response(status=401)
 
-    data = {"type": type, "msg": msg}
-    return Response(
-        json.dumps(data),
-        status=200,
-        mimetype="application/json",
-    )
+    def _metrics():
+        return Response(
+            Metrics.render(), 200, mimetype="text/plain; version=0.0.4"
+        )
+
+    return exception_wrapper(_metrics)
 
 
 # ============================================= Runtime =====================================================
 # Initialize flask-login
 init_login()
 
-# Setup mongodb connection
+# Setup mongodb connection (connects on first use, see connect_to_database)
 MongoDBConnection.connect_to_database()
 
-# Setup langchain connection
-LangChainConnection.setup_langchain(app.config["OPEN_AI_UID"])
+_warm_up_lock = threading.Lock()
+_warmed_up_pid: int | None = None
+
+
+# Imports the heavy modules and builds everything which doesn't need a connection (tokenizer tables, prompts).
+# uwsgi.py calls it in the master process, so every forked worker starts with it already done.
+def preload():
+    from .langchain_connection import LangChainConnection
+    from . import headline_batch, vector_store_job
+
+    LangChainConnection.preload()
+
+
+# Connects the current worker and fills its caches. uwsgi.py calls it after every fork, before the worker accepts
+# requests. Otherwise it runs on the first request.
+def warm_up():
+    global _warmed_up_pid
+    if _warmed_up_pid == os.getpid():
+        return
+
+    with _warm_up_lock:
+        if _warmed_up_pid == os.getpid():
+            return
+
+        from .embedding_cache import EmbeddingCache
+        from .usage_statistics import UsageStatistics
+        from .langchain_connection import LangChainConnection
+
+        preload()
+
+        # Setup metrics aggregation across workers
+        Metrics.setup(MongoDBConnection.metrics)
+        BackgroundWriter.setup(ad_cls.write_log)
+        BackgroundWriter.on_lost(MongoDBConnection.usage_rollup, UsageStatistics.on_lost)
+        EmbeddingCache.setup(MongoDBConnection.embedding_cache)
+        MongoDBConnection.setup_headline_cache()
+        MongoDBConnection.group_legacy_exceptions()
+
+        # Setup langchain connection
+        LangChainConnection.setup_langchain(app.config["OPEN_AI_UID"])
+        LangChainConnection.warm_up()
+
+        _warmed_up_pid = os.getpid()
 
 # Create admin
 admin = Admin(
@@ -459,9 +690,6 @@ admin = Admin(
 
 admin.add_view(
     ad_cls.Chat_HistoryView(
-        MongoDBConnection.information,
-        MongoDBConnection.subject,
-        MongoDBConnection.user,
         MongoDBConnection.chat_history,
         "Chat History",
     )
@@ -474,8 +702,6 @@ admin.add_view(
 )
 admin.add_view(
     ad_cls.InformationView(
-        MongoDBConnection.subject,
-        MongoDBConnection.user,
         MongoDBConnection.information,
         name="Information",
     )
@@ -486,13 +712,19 @@ admin.add_view(
         "OpenAI",
     )
 )
+admin.add_view(
+    ad_cls.PromptView(
+        MongoDBConnection.prompt,
+        "Prompt",
+    )
+)
 admin.add_view(
     ad_cls.SubjectView(
-        MongoDBConnection.user,
         MongoDBConnection.subject,
         name="Subject",
     )
 )
+admin.add_view(ad_cls.UsageView(name="Usage"))
 admin.add_view(
     ad_cls.UserView(
         MongoDBConnection.user,
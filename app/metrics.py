@@ -0,0 +1,230 @@
+from contextlib import contextmanager
+from pymongo.collection import Collection
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+from time import monotonic, perf_counter
+
+import threading
+import socket
+import os
+
+from .background_writer import BackgroundWriter
+from .tracing import Tracer
+
+
+# NOTE: Every worker keeps its own metrics in memory and publishes a snapshot to mongodb.
+# The metrics endpoint merges the snapshots of all workers, so it doesn't matter which uWSGI worker serves it.
+class Metrics:
+    STAGE_DURATION: str = "hugo_stage_duration_seconds"
+    STAGE_ERRORS: str = "hugo_stage_errors_total"
+    EXCEPTIONS: str = "hugo_exceptions_total"
+    WORKERS: str = "hugo_workers"
+    COALESCED_REQUESTS: str = "hugo_coalesced_requests_total"
+    UPSTREAM_RETRIES: str = "hugo_upstream_retries_total"
+    UPSTREAM_REJECTED: str = "hugo_upstream_rejected_total"
+    BREAKER_OPENED: str = "hugo_circuit_breaker_opened_total"
+    FIRST_TOKEN_TIMEOUTS: str = "hugo_first_token_timeouts_total"
+    OPENAI_KEY_THROTTLED: str = "hugo_openai_key_throttled_total"
+    EMBEDDING_CACHE: str = "hugo_embedding_cache_total"
+    EXPORTED_HISTORIES: str = "hugo_exported_histories_total"
+    SESSION_CACHE: str = "hugo_session_cache_total"
+    SESSION_CONFLICTS: str = "hugo_session_conflicts_total"
+    CANCELLED_ANSWERS: str = "hugo_cancelled_answers_total"
+    BACKGROUND_WRITES_RETRIED: str = "hugo_background_writes_retried_total"
+    BACKGROUND_WRITES_LOST: str = "hugo_background_writes_lost_total"
+    DROPPED_SPANS: str = "hugo_dropped_spans_total"
+
+    BUCKETS: Tuple[float, ...] = (
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0
+    )
+
+    # Seconds between two snapshots of a worker
+    PUBLISH_INTERVAL: float = 10.0
+    # Snapshots of workers which weren't updated for this long are ignored
+    WORKER_TIMEOUT: timedelta = timedelta(minutes=10)
+
+    HELP: Dict[str, str] = {
+        STAGE_DURATION: "Latency of a single processing stage.",
+        STAGE_ERRORS: "Amount of failed processing stages.",
+        EXCEPTIONS: "Amount of exceptions per endpoint.",
+        WORKERS: "Amount of workers contributing to these metrics.",
+        COALESCED_REQUESTS: "Amount of answers streamed from an identical running request.",
+        UPSTREAM_RETRIES: "Amount of retried calls per upstream.",
+        UPSTREAM_REJECTED: "Amount of calls rejected by an open circuit breaker.",
+        BREAKER_OPENED: "Amount of times the circuit breaker of an upstream opened.",
+        FIRST_TOKEN_TIMEOUTS: "Amount of answers without a first token in time.",
+        OPENAI_KEY_THROTTLED: "Amount of rate limited responses per OpenAI API key.",
+        EMBEDDING_CACHE: "Amount of question embeddings served from the cache (hit) or requested (miss).",
+        EXPORTED_HISTORIES: "Amount of chat histories exported per format.",
+        SESSION_CACHE: "Amount of chat histories served from the session cache (hit) or loaded (miss).",
+        SESSION_CONFLICTS: "Amount of history writes retried because another worker changed the history.",
+        CANCELLED_ANSWERS: "Amount of answer streams abandoned because the client disconnected or no first token arrived in time.",
+        BACKGROUND_WRITES_RETRIED: "Amount of background writes queued again after a failed flush.",
+        BACKGROUND_WRITES_LOST: "Amount of background writes dropped because the queue was full or mongodb rejected them.",
+        DROPPED_SPANS: "Amount of trace spans dropped because the export queue was full.",
+    }
+
+    _lock = threading.Lock()
+    _collection: Collection | None = None
+    _published_at: float = 0.0
+
+    _histograms: Dict[Tuple[str, Tuple], dict] = {}
+    _counters: Dict[Tuple[str, Tuple], float] = {}
+
+    @classmethod
+    def setup(cls, collection: Collection):
+        cls._collection = collection
+
+    @classmethod
+    def get_worker_id(cls) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    # ----- Recording ----------------------------------------------------------------------------------------------------
+    @classmethod
+    def observe(cls, name: str, value: float, labels: Dict[str, str] = None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with cls._lock:
+            histogram = cls._histograms.get(key)
+            if histogram is None:
+                histogram = {"buckets": [0] * len(cls.BUCKETS), "sum": 0.0, "count": 0}
+                cls._histograms[key] = histogram
+
+            for idx, bound in enumerate(cls.BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][idx] += 1
+                    break
+            histogram["sum"] += value
+            histogram["count"] += 1
+        cls._publish_if_due()
+
+    @classmethod
+    def increment(cls, name: str, labels: Dict[str, str] = None, value: float = 1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with cls._lock:
+            cls._counters[key] = cls._counters.get(key, 0) + value
+        cls._publish_if_due()
+
+    # Measures the latency of a stage. Can be used as context manager or as decorator.
+    # Inside of a trace every stage is recorded as span as well.
+    @classmethod
+    @contextmanager
+    def timer(cls, stage: str):
+        start = perf_counter()
+        try:
+            with Tracer.span(stage):
+                yield
+        except BaseException:
+            cls.increment(cls.STAGE_ERRORS, {"stage": stage})
+            raise
+        finally:
+            cls.observe(cls.STAGE_DURATION, perf_counter() - start, {"stage": stage})
+
+    # ----- Aggregation --------------------------------------------------------------------------------------------------
+    @classmethod
+    def snapshot(cls) -> dict:
+        with cls._lock:
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "buckets": list(histogram["buckets"]),
+                    "sum": histogram["sum"],
+                    "count": histogram["count"],
+                }
+                for (name, labels), histogram in cls._histograms.items()
+            ]
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in cls._counters.items()
+            ]
+        return {"histograms": histograms, "counters": counters}
+
+    @classmethod
+    def _publish_if_due(cls):
+        if cls._collection is None or monotonic() - cls._published_at < cls.PUBLISH_INTERVAL:
+            return
+        cls._published_at = monotonic()
+        BackgroundWriter.upsert(
+            cls._collection,
+            {"_id": cls.get_worker_id()},
+            {"$set": dict(cls.snapshot(), updated=datetime.now())},
+        )
+
+    # Merges the snapshots of all live workers. The own snapshot is always up to date.
+    @classmethod
+    def collect(cls) -> dict:
+        own = cls.snapshot()
+        snapshots = [own]
+        if cls._collection is not None:
+            cls._published_at = monotonic()
+            cls._collection.replace_one(
+                {"_id": cls.get_worker_id()},
+                dict(own, updated=datetime.now()),
+                upsert=True,
+            )
+            query = {
+                "_id": {"$ne": cls.get_worker_id()},
+                "updated": {"$gt": datetime.now() - cls.WORKER_TIMEOUT},
+            }
+            snapshots.extend(cls._collection.find(query))
+
+        histograms = {}
+        counters = {}
+        for snapshot in snapshots:
+            for item in snapshot["histograms"]:
+                key = (item["name"], tuple(sorted(item["labels"].items())))
+                merged = histograms.setdefault(
+                    key, {"buckets": [0] * len(cls.BUCKETS), "sum": 0.0, "count": 0}
+                )
+                merged["buckets"] = [a + b for a, b in zip(merged["buckets"], item["buckets"])]
+                merged["sum"] += item["sum"]
+                merged["count"] += item["count"]
+            for item in snapshot["counters"]:
+                key = (item["name"], tuple(sorted(item["labels"].items())))
+                counters[key] = counters.get(key, 0) + item["value"]
+
+        return {"histograms": histograms, "counters": counters, "workers": len(snapshots)}
+
+    # ----- Prometheus Text Format ---------------------------------------------------------------------------------------
+    @classmethod
+    def _format_labels(cls, labels: Tuple, extra: Tuple = ()) -> str:
+        pairs = []
+        for key, value in (*labels, *extra):
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            pairs.append(f'{key}="{value}"')
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    @classmethod
+    def render(cls) -> str:
+        data = cls.collect()
+        lines: List[str] = []
+        written = set()
+
+        def add_header(name: str, type: str):
+            if name not in written:
+                written.add(name)
+                lines.append(f"# HELP {name} {cls.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {type}")
+
+        for (name, labels), histogram in sorted(data["histograms"].items()):
+            add_header(name, "histogram")
+            cumulative = 0
+            for bound, amount in zip(cls.BUCKETS, histogram["buckets"]):
+                cumulative += amount
+                lines.append(
+                    f"{name}_bucket{cls._format_labels(labels, (('le', bound),))} {cumulative}"
+                )
+            lines.append(
+                f"{name}_bucket{cls._format_labels(labels, (('le', '+Inf'),))} {histogram['count']}"
+            )
+            lines.append(f"{name}_sum{cls._format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{cls._format_labels(labels)} {histogram['count']}")
+
+        for (name, labels), value in sorted(data["counters"].items()):
+            add_header(name, "counter")
+            lines.append(f"{name}{cls._format_labels(labels)} {value}")
+
+        add_header(cls.WORKERS, "gauge")
+        lines.append(f"{cls.WORKERS} {data['workers']}")
+
+        return "\n".join(lines) + "\n"
@@ -1,92 +1,127 @@
 from bson.datetime_ms import DatetimeMS
 from bson.objectid import ObjectId
 from datetime import datetime, timedelta
-from pymongo import MongoClient
-from typing import List
+from pymongo.operations import InsertOne
+from pymongo.errors import BulkWriteError
+from pymongo import MongoClient, ReadPreference
+from dataclasses import dataclass, field
+from typing import Callable, List
 
+import traceback
+import hashlib
+import os
+import re
 
-# NOTE: We need to convert our Data Containers to a dict to convert them to BSON format
-def to_dict(obj):
-    return vars(obj)
+from .background_writer import BackgroundWriter
+from .session_cache import Session, SessionCache
+from .metrics import Metrics
 
 
-# NOTE: Basically whats happening :
-# return {
-#     "var_1":self.var_1,
-#     "var_2":self.var_2,
-#     ...
-#     "var_n": self.var_n,
-# }
+# NOTE: We need to convert our Data Containers to a dict to convert them to BSON format
+def to_dict(obj):
+    return obj.to_bson()
 
 
+# NOTE: The containers are slotted, so they don't carry a __dict__ per instance. to_bson builds the document
+# directly instead of copying the attributes with vars().
+@dataclass(slots=True)
 class ChatMessage:
-    def __init__(self, message: str, response: str, tag: str, source_ids: List[str]):
-        self.message = message
-        self.response = response
-        self.tag = tag
-        self.source_ids = source_ids
+    message: str
+    response: str
+    tag: str
+    source_ids: List[str]
+
+    def to_bson(self) -> dict:
+        return {
+            "message": self.message,
+            "response": self.response,
+            "tag": self.tag,
+            "source_ids": self.source_ids,
+        }
 
 
+@dataclass(slots=True)
 class ChatHistory:
-    def __init__(
-        self,
-        start_message: str,
-        description: str,
-        date: str,
-        subjects: List[ObjectId],
-        messages: List[ChatMessage],
-    ):
-        self.start_message = start_message
-        self.description = description
-        self.date = date
-        self.subjects = subjects
-        if messages == None:
-            self.messages = []
-        else:
-            self.messages = messages
+    start_message: str
+    description: str
+    date: DatetimeMS
+    subjects: List[ObjectId] = field(default_factory=list)
+    messages: List[ChatMessage] = field(default_factory=list)
+    # NOTE: Incremented by every write, see MongoDBConnection.update_session
+    version: int = 0
+
+    def to_bson(self) -> dict:
+        return {
+            "start_message": self.start_message,
+            "description": self.description,
+            "date": self.date,
+            "subjects": self.subjects,
+            "messages": [message.to_bson() for message in self.messages],
+            "version": self.version,
+        }
 
 
+@dataclass(slots=True)
 class Information:
-    def __init__(
-        self,
-        headline: str,
-        content: str,
-        source: str,
-        subject: str,
-        tag: str,
-        delete_message: str,
-    ):
-        self.headline = headline
-        self.content = content
-        self.source = source
-        self.subject = subject
-        self.tag = tag
-        self.delete_message = delete_message
+    headline: str
+    content: str
+    source: str
+    subject: str
+    tag: str
+    delete_message: str
+
+    def to_bson(self) -> dict:
+        return {
+            "headline": self.headline,
+            "content": self.content,
+            "source": self.source,
+            "subject": self.subject,
+            "tag": self.tag,
+            "delete_message": self.delete_message,
+        }
 
 
-class Exception:
-    def __init__(self, endpoint: str, time: str, exception: str):
-        self.endpoint = endpoint
-        self.time = time
-        self.exception = exception
+# A recent occurrence of an exception group (see MongoDBConnection.add_exception)
+@dataclass(slots=True)
+class ExceptionSample:
+    endpoint: str
+    time: DatetimeMS
+    exception: str
+
+    def to_bson(self) -> dict:
+        return {"endpoint": self.endpoint, "time": self.time, "exception": self.exception}
 
 
 class MongoDBConnection:
-    CONNECTION: str = "mongodb:27017"
+    CONNECTION: str = os.environ.get("MONGODB_CONNECTION", "mongodb:27017")
     # CONNECTION: str = "mongodb://localhost:27017"
-    DATABASE: str = "Chatbot"
+    DATABASE: str = os.environ.get("MONGODB_DATABASE", "Chatbot")
 
     CHAT_HISTORY_COLL: str = "Chat_History"
+    EMBEDDING_CACHE_COLL: str = "Embedding_Cache"
     EXCEPTION_COLL: str = "Exception"
+    HEADLINE_CACHE_COLL: str = "Headline_Cache"
     INFORMATION_COLL: str = "Information"
+    JOB_COLL: str = "Job"
+    LOCK_COLL: str = "Lock"
+    LOG_COLL: str = "Log"
+    METRICS_COLL: str = "Metrics"
     OPENAI_COLL: str = "OpenAI"
+    PROMPT_COLL: str = "Prompt"
     SUBJECT_COLL: str = "Subject"
+    USAGE_ROLLUP_COLL: str = "Usage_Rollup"
     USER_COLL: str = "User"
+    VECTOR_INDEX_COLL: str = "Vector_Index"
     BEARER_COLL: str = "Bearer_Token"
 
     REVIEWED_MSG_TAG: str = "reviewed"
     NEUTRAL_MSG_TAG: str = "neutral"
     MARK_FOR_REVIEW_MSG_TAG: str = "marked for review"
+    # Messages with these tags were marked for review by a student at some point
+    REVIEW_MSG_TAGS: tuple = (MARK_FOR_REVIEW_MSG_TAG, REVIEWED_MSG_TAG)
+
+    # Answers of the qa prompt if the informations don't contain the answer
+    UNKNOWN_ANSWER: str = "Keine Ahnung"
 
     LIVE_INFO_TAG: str = "Current-Live"
     PRE_LIVE_INFO_TAG: str = "Pending-Live"
@@ -97,19 +132,46 @@ class MongoDBConnection:
 
     EXPIRATION_TIME: timedelta = timedelta(hours=4)
 
+    # Attempts of a history change if other workers changed the history at the same time
+    SESSION_ATTEMPTS: int = 3
+    # Default and maximum amount of messages of a page of a chat history
+    HISTORY_PAGE_SIZE: int = 50
+    MAX_HISTORY_PAGE_SIZE: int = 200
+
+    # Amount of recent occurrences stored per exception group
+    EXCEPTION_SAMPLE_SIZE: int = 10
+    # Frame lines of the tracebacks stored by the former add_exception (see group_legacy_exceptions)
+    LEGACY_FRAME = re.compile(r'^  File "(.+)", line (\d+), in (.+)$', re.MULTILINE)
+
+    # Id of the job document marking the usage rollups as incomplete (see mark_usage_dirty)
+    USAGE_DIRTY_ID: str = "usage_rollup_dirty"
+
+    # Seconds a cached headline is kept after it was created
+    HEADLINE_CACHE_MAX_AGE: int = 30 * 24 * 60 * 60
+
     # ----- DB Operations ------------------------------------------------------------------------------------------------
     # ! If you are working with this class: call this function befor everything else !
+    # NOTE: The client connects on its first operation, so it can be created before uWSGI forks the workers
     @classmethod
     def connect_to_database(cls):
-        cls.client = MongoClient(cls.CONNECTION)
+        cls.client = MongoClient(cls.CONNECTION, connect=False)
         cls.db = cls.client[cls.DATABASE]
         cls.connect_to_chat_history()
+        cls.connect_to_embedding_cache()
         cls.connect_to_exception()
+        cls.connect_to_headline_cache()
         cls.connect_to_information()
+        cls.connect_to_job()
+        cls.connect_to_lock()
+        cls.connect_to_log()
+        cls.connect_to_metrics()
         cls.connect_to_openai()
+        cls.connect_to_prompt()
         cls.connect_to_subject()
+        cls.connect_to_usage_rollup()
         cls.connect_to_user()
         cls.connect_to_bearer_token()
+        cls.connect_to_vector_index()
         return cls.db
 
     @classmethod
@@ -117,26 +179,72 @@ class MongoDBConnection:
         cls.chat_history = cls.db[cls.CHAT_HISTORY_COLL]
         return cls.chat_history
 
+    @classmethod
+    def connect_to_embedding_cache(cls):
+        cls.embedding_cache = cls.db[cls.EMBEDDING_CACHE_COLL]
+        return cls.embedding_cache
+
     @classmethod
     def connect_to_exception(cls):
         cls.exception = cls.db[cls.EXCEPTION_COLL]
         return cls.exception
 
+    @classmethod
+    def connect_to_headline_cache(cls):
+        cls.headline_cache = cls.db[cls.HEADLINE_CACHE_COLL]
+        return cls.headline_cache
+
+    # NOTE: Every prompt version adds its own keys, so old headlines expire instead of piling up. Called after the
+    # workers are forked, because creating the index opens the connection.
+    @classmethod
+    def setup_headline_cache(cls):
+        cls.headline_cache.create_index("created", expireAfterSeconds=cls.HEADLINE_CACHE_MAX_AGE)
+
     @classmethod
     def connect_to_information(cls):
         cls.information = cls.db[cls.INFORMATION_COLL]
         return cls.information
 
+    @classmethod
+    def connect_to_job(cls):
+        cls.job = cls.db[cls.JOB_COLL]
+        return cls.job
+
+    @classmethod
+    def connect_to_lock(cls):
+        cls.lock = cls.db[cls.LOCK_COLL]
+        return cls.lock
+
+    @classmethod
+    def connect_to_log(cls):
+        cls.log = cls.db[cls.LOG_COLL]
+        return cls.log
+
+    @classmethod
+    def connect_to_metrics(cls):
+        cls.metrics = cls.db[cls.METRICS_COLL]
+        return cls.metrics
+
     @classmethod
     def connect_to_openai(cls):
         cls.openai = cls.db[cls.OPENAI_COLL]
         return cls.openai
 
+    @classmethod
+    def connect_to_prompt(cls):
+        cls.prompt = cls.db[cls.PROMPT_COLL]
+        return cls.prompt
+
     @classmethod
     def connect_to_subject(cls):
         cls.subject = cls.db[cls.SUBJECT_COLL]
         return cls.subject
 
+    @classmethod
+    def connect_to_usage_rollup(cls):
+        cls.usage_rollup = cls.db[cls.USAGE_ROLLUP_COLL]
+        return cls.usage_rollup
+
     @classmethod
     def connect_to_user(cls):
         cls.user = cls.db[cls.USER_COLL]
@@ -147,99 +255,261 @@ class MongoDBConnection:
         cls.bearer_token = cls.db[cls.BEARER_COLL]
         return cls.bearer_token
 
+    @classmethod
+    def connect_to_vector_index(cls):
+        cls.vector_index = cls.db[cls.VECTOR_INDEX_COLL]
+        return cls.vector_index
+
     # ----- API access Chat History --------------------------------------------------------------------------------------
     @classmethod
+    @Metrics.timer("mongo.create_chat_history")
     def create_chat_history(cls, start_message: str):
         time = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
         date = DatetimeMS(time)
         history = ChatHistory(start_message, cls.DEFAULT, date, [], [])
         result = cls.chat_history.insert_one(to_dict(history))
+        SessionCache.put(str(result.inserted_id), Session(history.version, date, [], []))
+        cls.add_usage(time, [], {"sessions": 1})
         return result.inserted_id
 
+    # ----- Session Cache ------------------------------------------------------------------------------------------------
+    # Returns the cached history of a running chat, or loads it from mongodb
     @classmethod
-    def get_last_messages(cls, id: str, amount: int):
-        history = cls.chat_history.find_one({"_id": ObjectId(id)})
-        messages = history["messages"]
-        message_amount = 0
-        if messages != None:
-            message_amount = len(messages)
-        amount = min(amount, message_amount)
-        last_messages = []
-        for i in range(amount - 1, -1, -1):
-            last_messages.append(history["messages"][message_amount - 1 - i])
-        return last_messages
+    def get_session(cls, id: str) -> Session:
+        session = SessionCache.get(id)
+        if session is not None:
+            Metrics.increment(Metrics.SESSION_CACHE, {"result": "hit"})
+            return session
+
+        Metrics.increment(Metrics.SESSION_CACHE, {"result": "miss"})
+        with Metrics.timer("mongo.load_session"):
+            history = cls.chat_history.find_one(
+                {"_id": ObjectId(id)},
+                {"date": 1, "subjects": 1, "messages": 1, "version": 1},
+            )
+        if history is None:
+            raise LookupError(f"Chat history '{id}' doesn't exist.")
+
+        session = Session(
+            history.get("version", 0),
+            history["date"],
+            history["subjects"],
+            history["messages"] or [],
+        )
+        SessionCache.put(id, session)
+        return session
 
+    # Writes the update returned by change(session). The write only applies if the history has still the version
+    # of the session, otherwise another worker changed it in the meantime and the change is retried on a fresh copy.
+    @classmethod
+    def update_session(cls, id: str, change: Callable[[Session], dict]) -> Session:
+        for _ in range(cls.SESSION_ATTEMPTS):
+            session = cls.get_session(id)
+            version = session.version
+            update = change(session)
+            update["$inc"] = dict(update.get("$inc", {}), version=1)
+
+            # NOTE: Histories created before the version field was added have no version yet
+            query = {"_id": ObjectId(id), "version": version if version else {"$in": [0, None]}}
+            result = cls.chat_history.update_one(query, update)
+            if result.matched_count == 1:
+                session.version = version + 1
+                SessionCache.replace(id, version, session)
+                return session
+
+            Metrics.increment(Metrics.SESSION_CONFLICTS)
+            SessionCache.invalidate(id)
+
+        raise RuntimeError(f"Chat history '{id}' was changed by another request. Please try again.")
+
+    # Returns the last messages before the message `before_idx` (default: the newest messages)
+    @classmethod
+    @Metrics.timer("mongo.get_last_messages")
+    def get_last_messages(cls, id: str, amount: int, before_idx: int | None = None):
+        messages = cls.get_session(id).messages
+        end = len(messages) if before_idx is None else min(before_idx, len(messages))
+        return messages[max(end - amount, 0):end]
+
+    # Returns the index of the added message. Later changes of the turn have to use it, because other requests of
+    # the same chat may have added messages in the meantime.
+    # NOTE: $push instead of $addToSet, so asking the same question twice adds two messages
     @classmethod
+    @Metrics.timer("mongo.add_chat_history_message")
     def add_chat_history_message(
         cls, id: str, message: str, response: str, tag: str, source_ids: List[str]
-    ):
-        message = ChatMessage(message, response, tag, source_ids)
-        return cls.chat_history.update_one(
-            {"_id": ObjectId(id)},
-            {"$addToSet": {"messages": to_dict(message)}},
-        )
-
+    ) -> int:
+        message = to_dict(ChatMessage(message, response, tag, source_ids))
+        added = {}
+
+        # NOTE: The version guard of update_session makes sure the cached messages match the stored ones
+        def _change(session: Session) -> dict:
+            added["idx"] = len(session.messages)
+            session.messages.append(dict(message))
+            return {"$push": {"messages": message}}
+
+        cls.update_session(id, _change)
+        return added["idx"]
+
+    # Returns the whole history, or a page of it if before_idx, limit or since is given:
+    # - before_idx / limit: the `limit` messages before the message `before_idx` (default: the newest messages)
+    # - since: the messages starting at the message `since`, e.g. the ones added after the client rendered `since`
+    # NOTE: Only the requested messages are read, the page is cut by mongodb ($slice) and not in python
     @classmethod
-    def get_chat_history(cls, history_id: str):
-        result = cls.chat_history.find_one({"_id": ObjectId(history_id)})
-        for key in ["_id", "description", "date", "subjects"]:
-            del result[key]
-        result["messages"] = [
-            {"message": msg["message"], "response": msg["response"]}
-            for msg in result["messages"]
+    @Metrics.timer("mongo.get_chat_history")
+    def get_chat_history(
+        cls,
+        history_id: str,
+        before_idx: int | None = None,
+        limit: int | None = None,
+        since: int | None = None,
+    ) -> dict:
+        if before_idx is None and limit is None and since is None:
+            result = cls.chat_history.find_one(
+                {"_id": ObjectId(history_id)},
+                {"_id": 0, "start_message": 1, "messages.message": 1, "messages.response": 1},
+            )
+            if result is None:
+                raise LookupError(f"Chat history '{history_id}' doesn't exist.")
+            result["messages"] = result.get("messages") or []
+            return result
+
+        limit = min(limit or cls.HISTORY_PAGE_SIZE, cls.MAX_HISTORY_PAGE_SIZE)
+        if since is not None:
+            messages = {"$slice": ["$messages", since, limit]}
+        elif before_idx == 0:
+            messages = {"$literal": []}
+        elif before_idx is not None:
+            messages = {"$slice": [{"$slice": ["$messages", before_idx]}, -limit]}
+        else:
+            messages = {"$slice": ["$messages", -limit]}
+
+        pipeline = [
+            {"$match": {"_id": ObjectId(history_id)}},
+            {"$project": {"start_message": 1, "messages": {"$ifNull": ["$messages", []]}}},
+            {
+                "$project": {
+                    "_id": 0,
+                    "start_message": 1,
+                    "total": {"$size": "$messages"},
+                    "messages": {
+                        "$map": {
+                            "input": messages,
+                            "as": "msg",
+                            "in": {"message": "$$msg.message", "response": "$$msg.response"},
+                        }
+                    },
+                }
+            },
         ]
+        result = next(cls.chat_history.aggregate(pipeline), None)
+        if result is None:
+            raise LookupError(f"Chat history '{history_id}' doesn't exist.")
+
+        # NOTE: Index of the first returned message, the client passes it as before_idx to load the previous page
+        total = result["total"]
+        if since is not None:
+            result["start_idx"] = min(since, total)
+        else:
+            end = total if before_idx is None else min(before_idx, total)
+            result["start_idx"] = end - len(result["messages"])
         return result
 
     @classmethod
+    @Metrics.timer("mongo.update_chat_history")
     def update_chat_history(
         cls,
         id: str,
+        message_idx: int,
         description: str | None,
         subjects_to_add: List[ObjectId],
         response: str,
         source_ids: List[str],
     ):
-        obj_id = ObjectId(id)
-        chat_history = cls.chat_history.find_one({"_id": obj_id})
+        subjects = {}
 
-        current_subjects = chat_history["subjects"]
-        current_subjects.extend(
-            subject for subject in subjects_to_add if subject not in current_subjects
-        )
+        def _change(session: Session) -> dict:
+            current_subjects = session.subjects
+            subjects["new"] = list(
+                dict.fromkeys(x for x in subjects_to_add if x not in current_subjects)
+            )
+            subjects["previous"] = list(current_subjects)
+            current_subjects.extend(subjects["new"])
 
-        msg_size = len(chat_history["messages"]) - 1
+            session.messages[message_idx].update({"response": response, "source_ids": source_ids})
 
-        update = {
-            "$set": {
-                "subjects": current_subjects,
-                f"messages.{msg_size}.response": response,
-                f"messages.{msg_size}.source_ids": source_ids,
+            update = {
+                "$set": {
+                    "subjects": current_subjects,
+                    f"messages.{message_idx}.response": response,
+                    f"messages.{message_idx}.source_ids": source_ids,
+                }
             }
-        }
 
-        if description is not None:
-            update["$set"]["description"] = description
+            if description is not None:
+                update["$set"]["description"] = description
 
-        return cls.chat_history.update_one(
-            {"_id": obj_id},
-            update,
-        )
+            return update
+
+        session = cls.update_session(id, _change)
+
+        # NOTE: A subject counts every turn of the sessions it belongs to, so subjects found later get the earlier turns
+        messages = session.messages
+        cls.add_usage(session.date, subjects["previous"], cls.get_usage(messages[message_idx:message_idx + 1]))
+        if subjects["new"]:
+            usage = cls.get_usage(messages)
+            usage["sessions"] = 1
+            cls.add_usage(session.date, subjects["new"], usage, with_total=False)
+
+        return session
+
+    # NOTE: Exports read from a secondary if there is one, so they don't slow down the live chats
+    @classmethod
+    def export_chat_histories(cls, query: dict, fields: List[str], batch_size: int):
+        collection = cls.chat_history.with_options(read_preference=ReadPreference.SECONDARY_PREFERRED)
+        projection = {key: 1 for key in fields}
+        if "_id" not in fields:
+            projection["_id"] = 0
+        return collection.find(query, projection).sort("_id", 1).batch_size(batch_size)
 
     @classmethod
+    @Metrics.timer("mongo.set_message_tag")
     def set_message_tag(cls, history_id: str, message_idx: int, tag: str):
-        return cls.chat_history.update_one(
+        history = cls.chat_history.find_one_and_update(
             {"_id": ObjectId(history_id)},
-            {"$set": {f"messages.{message_idx}.tag": tag}},
+            {"$set": {f"messages.{message_idx}.tag": tag}, "$inc": {"version": 1}},
+            {"date": 1, "subjects": 1, "messages.tag": 1},
         )
+        SessionCache.invalidate(history_id)
+        if (
+            history is not None
+            and tag in cls.REVIEW_MSG_TAGS
+            and 0 <= message_idx < len(history["messages"])
+        ):
+            previous = history["messages"][message_idx].get("tag")
+            if previous not in cls.REVIEW_MSG_TAGS:
+                cls.add_usage(history["date"], history["subjects"], {"reviews": 1})
+        return history
 
     # ----- API access Information ---------------------------------------------------------------------------------------
     @classmethod
+    @Metrics.timer("mongo.get_information_subject_ids")
     def get_information_subject_ids(cls, info_ids: List[str]):
         query = {"_id": {"$in": [ObjectId(id) for id in info_ids]}}
         info_cursor = cls.information.find(query, {"_id": 0, "subject_id": 1})
         return [info["subject_id"] for info in info_cursor]
 
+    # Maps every given information id to its headline. Unknown or deleted informations are left out.
     @classmethod
+    @Metrics.timer("mongo.get_information_headlines")
+    def get_information_headlines(cls, info_ids: List[str]) -> dict:
+        object_ids = [ObjectId(x) for x in info_ids if ObjectId.is_valid(x)]
+        if len(object_ids) == 0:
+            return {}
+        cursor = cls.information.find({"_id": {"$in": object_ids}}, {"headline": 1})
+        return dict((str(info["_id"]), info["headline"]) for info in cursor)
+
+    @classmethod
+    @Metrics.timer("mongo.get_live_information")
     def get_live_information(cls):
         cursor = cls.information.find(
             {
@@ -254,25 +524,330 @@ class MongoDBConnection:
         information = [dict(document, _id=str(document["_id"])) for document in cursor]
         return information
 
+    # NOTE: Headlines are cached by the hash of their prompt, so repeated content isn't sent to the llm again
+    @classmethod
+    @Metrics.timer("mongo.get_cached_headline")
+    def get_cached_headline(cls, key: str) -> str | None:
+        result = cls.headline_cache.find_one({"_id": key}, {"headline": 1})
+        return result["headline"] if result is not None else None
+
+    @classmethod
+    def add_cached_headline(cls, key: str, headline: str):
+        return BackgroundWriter.upsert(
+            cls.headline_cache,
+            {"_id": key},
+            {"$set": {"headline": headline, "created": DatetimeMS(datetime.now())}},
+        )
+
+    @classmethod
+    def get_pending_information_ids(cls) -> List[ObjectId]:
+        cursor = cls.information.find({"tag": cls.PRE_LIVE_INFO_TAG}, {"_id": 1})
+        return [info["_id"] for info in cursor]
+
+    # Inserts the operations unordered, so one failing document doesn't stop the rest of the batch
+    @classmethod
+    @Metrics.timer("mongo.insert_informations")
+    def insert_informations(cls, operations: List[InsertOne]) -> tuple[int, List[dict]]:
+        try:
+            result = cls.information.bulk_write(operations, ordered=False)
+        except BulkWriteError as ex:
+            return ex.details.get("nInserted", 0), ex.details.get("writeErrors", [])
+        return result.inserted_count, []
+
     @classmethod
     def delete_information(cls, id: str):
         result = cls.information.delete_one({"_id": ObjectId(id)})
         return result.deleted_count == 1
 
     @classmethod
+    @Metrics.timer("mongo.update_information_tag")
     def update_information_tag(cls, query: str, tag: str):
         result = cls.information.update_many(query, {"$set": {"tag": tag}})
         return result.modified_count
 
+    # NOTE: Exceptions are grouped by their fingerprint, so an error storm only updates a single document
     @classmethod
-    # def add_exception(cls, name: str, time: datetime, exception: str):
-    def add_exception(cls, name: str, exception: str):
-        time = datetime.now()
-        date = DatetimeMS(time)
-        result = cls.exception.insert_one(to_dict(Exception(name, date, exception)))
-        return result
+    def get_exception_fingerprint(cls, name: str, ex: BaseException) -> str:
+        frames = [
+            f"{frame.filename}:{frame.name}:{frame.lineno}"
+            for frame in traceback.extract_tb(ex.__traceback__)
+        ]
+        return cls.hash_exception(name, type(ex).__qualname__, frames)
+
+    @classmethod
+    def hash_exception(cls, name: str, exception_type: str, frames: List[str]) -> str:
+        key = "\n".join([name, exception_type, *frames])
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    # NOTE: The write is handed to the background writer, so the failing request doesn't wait for the database
+    @classmethod
+    def add_exception(cls, name: str, ex: BaseException):
+        date = DatetimeMS(datetime.now())
+        exception = "".join(traceback.format_exception(ex))
+        sample = ExceptionSample(name, date, exception)
+
+        return BackgroundWriter.upsert(
+            cls.exception,
+            {"_id": cls.get_exception_fingerprint(name, ex)},
+            {
+                "$setOnInsert": {
+                    "endpoint": name,
+                    "exception_type": type(ex).__qualname__,
+                    "first_seen": date,
+                },
+                "$set": {
+                    "message": str(ex),
+                    "exception": exception,
+                    "last_seen": date,
+                },
+                "$inc": {"count": 1},
+                "$push": {
+                    "samples": {
+                        "$each": [to_dict(sample)],
+                        "$slice": -cls.EXCEPTION_SAMPLE_SIZE,
+                    }
+                },
+            },
+        )
+
+    # NOTE: Before exceptions were grouped, every failure was stored as its own document with the formatted traceback.
+    # Each of these documents is claimed with find_one_and_delete and folded into its group, so workers running the
+    # migration at the same time don't count a failure twice. Returns the amount of folded documents.
+    @classmethod
+    def group_legacy_exceptions(cls) -> int:
+        folded = 0
+        while True:
+            legacy = cls.exception.find_one_and_delete({"count": {"$exists": False}})
+            if legacy is None:
+                return folded
+
+            text = legacy.get("exception") or ""
+            # NOTE: Chained exceptions contain several tracebacks, the fingerprint uses the last one (see add_exception)
+            last = text.split("Traceback (most recent call last):")[-1]
+            frames = [
+                f"{filename}:{function}:{lineno}"
+                for filename, lineno, function in cls.LEGACY_FRAME.findall(last)
+            ]
+            lines = [x for x in last.splitlines() if x.strip() and not x.startswith(" ")]
+            type_name, _, message = (lines[-1] if lines else "Exception").partition(":")
+            exception_type = type_name.strip().split(".")[-1]
+
+            name = legacy.get("endpoint", "")
+            date = legacy.get("time") or legacy["_id"].generation_time
+            sample = ExceptionSample(name, date, text)
+            cls.exception.update_one(
+                {"_id": cls.hash_exception(name, exception_type, frames)},
+                {
+                    "$setOnInsert": {
+                        "endpoint": name,
+                        "exception_type": exception_type,
+                        "message": message.strip(),
+                        "exception": text,
+                    },
+                    "$min": {"first_seen": date},
+                    "$max": {"last_seen": date},
+                    "$inc": {"count": 1},
+                    "$push": {
+                        "samples": {
+                            "$each": [to_dict(sample)],
+                            "$sort": {"time": 1},
+                            "$slice": -cls.EXCEPTION_SAMPLE_SIZE,
+                        }
+                    },
+                },
+                upsert=True,
+            )
+            folded += 1
+
+    # ----- Vector Index Versions ----------------------------------------------------------------------------------------
+    # NOTE: Every rebuild of the vector store creates a new version. Only called while holding the vector_store lock.
+    @classmethod
+    def create_vector_index(cls, index_prefix: str):
+        last = cls.vector_index.find_one({}, sort=[("_id", -1)])
+        version = 1 if last is None else last["_id"] + 1
+        name = f"{index_prefix}_v{version}"
+        cls.vector_index.insert_one(
+            {"_id": version, "name": name, "state": "building", "created": datetime.now()}
+        )
+        return version, name
+
+    @classmethod
+    @Metrics.timer("mongo.get_active_vector_index")
+    def get_active_vector_index(cls):
+        return cls.vector_index.find_one({"state": "active"}, sort=[("_id", -1)])
+
+    @classmethod
+    def activate_vector_index(cls, version: int, documents: int):
+        now = datetime.now()
+        cls.vector_index.update_one(
+            {"_id": version},
+            {"$set": {"state": "active", "activated": now, "documents": documents}},
+        )
+        cls.vector_index.update_many(
+            {"state": "active", "_id": {"$ne": version}},
+            {"$set": {"state": "retired", "retired_at": now}},
+        )
+
+    @classmethod
+    def retire_vector_index(cls, version: int, state: str = "retired"):
+        cls.vector_index.update_one(
+            {"_id": version}, {"$set": {"state": state, "retired_at": datetime.now()}}
+        )
+
+    # The unversioned index of older releases is garbage collected like a retired version
+    @classmethod
+    def retire_legacy_vector_index(cls, name: str):
+        cls.vector_index.update_one(
+            {"_id": 0},
+            {"$setOnInsert": {"name": name, "state": "retired", "retired_at": datetime.now()}},
+            upsert=True,
+        )
+
+    @classmethod
+    def delete_vector_index(cls, version: int):
+        cls.vector_index.delete_one({"_id": version})
+
+    @classmethod
+    def get_retired_vector_indexes(cls, retired_before: datetime):
+        cursor = cls.vector_index.find(
+            {"state": {"$in": ["retired", "failed"]}, "retired_at": {"$lt": retired_before}}
+        )
+        return [index for index in cursor]
+
+    # ----- Prompt Versions ----------------------------------------------------------------------------------------------
+    @classmethod
+    def get_next_prompt_version(cls, name: str) -> int:
+        result = cls.prompt.find_one({"name": name}, {"version": 1}, sort=[("version", -1)])
+        return 1 if result is None else result["version"] + 1
+
+    # NOTE: At most one version of a prompt is active, without an active version the built-in default is used
+    @classmethod
+    def activate_prompt(cls, id: ObjectId) -> str | None:
+        result = cls.prompt.find_one_and_update({"_id": id}, {"$set": {"active": True}})
+        if result is None:
+            return None
+        cls.prompt.update_many(
+            {"name": result["name"], "_id": {"$ne": id}}, {"$set": {"active": False}}
+        )
+        return result["name"]
+
+    @classmethod
+    def deactivate_prompts(cls, ids: List[ObjectId]):
+        return cls.prompt.update_many({"_id": {"$in": ids}}, {"$set": {"active": False}})
+
+    # ----- Admin Log ----------------------------------------------------------------------------------------------------
+    @classmethod
+    def add_log(cls, message: str):
+        return BackgroundWriter.insert(
+            cls.log, {"time": DatetimeMS(datetime.now()), "message": message}
+        )
+
+    @classmethod
+    def get_logs(cls, amount: int):
+        cursor = cls.log.find({}, {"_id": 0}).sort("time", -1).limit(amount)
+        return [log for log in cursor][::-1]
+
+    # ----- Usage Rollups ------------------------------------------------------------------------------------------------
+    # NOTE: Usage is counted per day of the session and per subject. The bucket without subject_id holds the totals.
+    @classmethod
+    def get_usage_id(cls, day: datetime, subject_id: ObjectId | None) -> str:
+        return f"{day.strftime('%Y-%m-%d')}:{subject_id or 'total'}"
+
+    # Counts the turns, reviews, unknown answers and cited sources of the messages
+    @classmethod
+    def get_usage(cls, messages: List[dict]) -> dict:
+        usage = {"turns": 0, "reviews": 0, "unknown_answers": 0}
+        for message in messages:
+            if not message.get("response"):
+                continue
+            usage["turns"] += 1
+            if message.get("tag") in cls.REVIEW_MSG_TAGS:
+                usage["reviews"] += 1
+            if cls.UNKNOWN_ANSWER.lower() in message["response"].lower():
+                usage["unknown_answers"] += 1
+            for source_id in message.get("source_ids", []):
+                key = f"sources.{source_id}"
+                usage[key] = usage.get(key, 0) + 1
+        return usage
+
+    @classmethod
+    def add_usage(
+        cls, day, subject_ids: List[ObjectId], usage: dict, with_total: bool = True
+    ):
+        if hasattr(day, "as_datetime"):
+            day = day.as_datetime()
+        day = day.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        usage = {key: value for key, value in usage.items() if value}
+        if not usage:
+            return
+
+        subject_ids = ([None] if with_total else []) + list(subject_ids)
+        for subject_id in subject_ids:
+            BackgroundWriter.upsert(
+                cls.usage_rollup,
+                {"_id": cls.get_usage_id(day, subject_id)},
+                {
+                    "$setOnInsert": {"day": day, "subject_id": subject_id},
+                    "$inc": usage,
+                },
+            )
+
+    @classmethod
+    @Metrics.timer("mongo.get_usage_rollups")
+    def get_usage_rollups(cls, since: datetime) -> List[dict]:
+        return list(cls.usage_rollup.find({"day": {"$gte": since}}))
+
+    # NOTE: Marks the rollups as incomplete, e.g. after the background writer lost some of their updates. Only the
+    # time of the last loss is kept, so a rebuild started at or after it repairs the rollups (see clear_usage_dirty).
+    @classmethod
+    def mark_usage_dirty(cls):
+        cls.job.update_one({"_id": cls.USAGE_DIRTY_ID}, {"$max": {"last_loss": datetime.now()}}, upsert=True)
+
+    # Returns the time of the last lost update of the rollups, or None if the rollups are complete
+    @classmethod
+    def get_usage_dirty(cls) -> datetime | None:
+        marker = cls.job.find_one({"_id": cls.USAGE_DIRTY_ID})
+        return None if marker is None else marker["last_loss"]
+
+    @classmethod
+    def clear_usage_dirty(cls, rebuild_started: datetime):
+        cls.job.delete_one({"_id": cls.USAGE_DIRTY_ID, "last_loss": {"$lte": rebuild_started}})
+
+    # ----- Background Jobs ----------------------------------------------------------------------------------------------
+    @classmethod
+    def create_job(cls, id: ObjectId, type: str, phase: str):
+        result = cls.job.insert_one(
+            {
+                "_id": id,
+                "type": type,
+                "phase": phase,
+                "done": 0,
+                "total": 0,
+                "started": DatetimeMS(datetime.now()),
+                "worker": Metrics.get_worker_id(),
+            }
+        )
+        return result.inserted_id
+
+    @classmethod
+    def update_job(cls, id: ObjectId, fields: dict):
+        cls.job.update_one({"_id": ObjectId(id)}, {"$set": fields})
+
+    @classmethod
+    def delete_job(cls, id: ObjectId):
+        cls.job.delete_one({"_id": ObjectId(id)})
+
+    @classmethod
+    def get_job(cls, id: str):
+        return cls.job.find_one({"_id": ObjectId(id)})
+
+    @classmethod
+    def get_last_job(cls, type: str):
+        return cls.job.find_one({"type": type}, sort=[("started", -1)])
 
     @classmethod
+    @Metrics.timer("mongo.get_bearer_token")
     def get_bearer_token(cls):
         expiration_date = datetime.now().replace(microsecond=0) + cls.EXPIRATION_TIME
         result = cls.bearer_token.insert_one(
@@ -285,6 +860,7 @@ class MongoDBConnection:
         return token
 
     @classmethod
+    @Metrics.timer("mongo.verify_bearer_token")
     def verify_bearer_token(cls, token_id: str):
         try:
             expiration_date = datetime.now().replace(microsecond=0)
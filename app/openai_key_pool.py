@@ -0,0 +1,209 @@
+from typing import Dict
+from time import monotonic
+
+import requests
+import threading
+import random
+import re
+
+from .periodic_reload import PeriodicReload
+from .mongodb_connection import MongoDBConnection
+from .metrics import Metrics
+
+
+class KeyState:
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self.limit_requests: int | None = None
+        self.limit_tokens: int | None = None
+        self.remaining_requests: int | None = None
+        self.remaining_tokens: int | None = None
+        self.reset_at: float = 0.0
+        self.cooldown_until: float = 0.0
+
+    # Share of the rate limit left until the next reset (1.0 if unknown)
+    def get_headroom(self, now: float) -> float:
+        if now >= self.reset_at:
+            return 1.0
+        headroom = 1.0
+        if self.limit_requests and self.remaining_requests is not None:
+            headroom = min(headroom, self.remaining_requests / self.limit_requests)
+        if self.limit_tokens and self.remaining_tokens is not None:
+            headroom = min(headroom, self.remaining_tokens / self.limit_tokens)
+        return headroom
+
+
+# NOTE: Spreads the OpenAI requests of all students over every active key of OPEN_AI_UID. Keys are picked at random,
+# weighted by the headroom reported in the rate limit headers of their last response. Keys answering with 429 are
+# left out until their limit resets. The state is kept per worker, keys are reloaded from mongodb after MAX_AGE.
+class OpenAIKeyPool:
+    MAX_AGE: float = 60.0
+    # Seconds a throttled key is left out if OpenAI doesn't tell when its limit resets
+    COOLDOWN: float = 20.0
+    MIN_WEIGHT: float = 0.01
+
+    # NOTE: The reload shares the lock of the key states, so keys aren't swapped while a key is picked
+    _lock = threading.Lock()
+    _reload = PeriodicReload(_lock)
+    _keys: Dict[str, KeyState] = {}
+    # The last streamed response of every thread (see on_stream)
+    _streams = threading.local()
+
+    uid: str | None = None
+
+    @classmethod
+    def setup(cls, uid: str):
+        import openai
+
+        cls.uid = uid
+        openai.requestssession = cls.create_session
+
+    # Called by openai once per thread, the hook sees the headers of every response
+    # NOTE: Replaces the session factory of openai, so the proxy has to be applied here (like openai does)
+    @classmethod
+    def create_session(cls) -> requests.Session:
+        import openai
+
+        session = requests.Session()
+        if isinstance(openai.proxy, str):
+            session.proxies = {"http": openai.proxy, "https": openai.proxy}
+        elif isinstance(openai.proxy, dict):
+            session.proxies = dict(openai.proxy)
+        session.mount("https://", requests.adapters.HTTPAdapter(max_retries=2))
+        session.hooks["response"].append(cls.on_response)
+        session.hooks["response"].append(cls.on_stream)
+        return session
+
+    # ----- Cache Handling -----------------------------------------------------------------------------------------------
+    @classmethod
+    def invalidate(cls):
+        cls._reload.invalidate()
+
+    @classmethod
+    def _ensure_loaded(cls):
+        cls._reload.ensure(cls.MAX_AGE, cls._load)
+
+    # Keys which are still active keep their rate limit state
+    @classmethod
+    def _load(cls):
+        keys = {}
+        query = {"uid": cls.uid, "active": {"$ne": False}}
+        for doc in MongoDBConnection.openai.find(query, {"api_key": 1}):
+            api_key = doc.get("api_key")
+            if api_key:
+                keys[api_key] = cls._keys.get(api_key) or KeyState(api_key)
+
+        cls._keys = keys
+
+    # ----- Key Selection ------------------------------------------------------------------------------------------------
+    @classmethod
+    def get_key(cls) -> str:
+        if not cls.uid:
+            raise Exception(
+                "Missing OpenAI UID. Please provide a openai uid and restart the server."
+            )
+
+        cls._ensure_loaded()
+        with cls._lock:
+            states = list(cls._keys.values())
+            if len(states) == 0:
+                raise Exception(
+                    "Missing OpenAI API Key. Please contact your admin or add the api key."
+                )
+
+            now = monotonic()
+            available = [x for x in states if x.cooldown_until <= now]
+            if len(available) == 0:
+                return min(states, key=lambda x: x.cooldown_until).api_key
+
+            weights = [max(cls.MIN_WEIGHT, x.get_headroom(now)) for x in available]
+            return random.choices(available, weights=weights)[0].api_key
+
+    # Headroom and remaining cooldown of a key, as seen by this worker
+    @classmethod
+    def get_state(cls, api_key: str) -> dict | None:
+        now = monotonic()
+        with cls._lock:
+            state = cls._keys.get(api_key)
+            if state is None:
+                return None
+            return {
+                "headroom": state.get_headroom(now),
+                "cooldown": max(0.0, state.cooldown_until - now),
+            }
+
+    @classmethod
+    def mask(cls, api_key: str) -> str:
+        return f"...{api_key[-4:]}"
+
+    # ----- Rate Limit Headers -------------------------------------------------------------------------------------------
+    # Parses durations like "20ms", "1s" or "6m0s"
+    @classmethod
+    def parse_duration(cls, value: str | None) -> float | None:
+        if not value:
+            return None
+        units = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+        parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+        if len(parts) == 0:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+        return sum(float(amount) * units[unit] for amount, unit in parts)
+
+    @classmethod
+    def parse_int(cls, value: str | None) -> int | None:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    # NOTE: openai only returns a generator over the lines of a streamed response. Closing the generator leaves the
+    # response open until it is garbage collected, so the response is kept for the caller to close it.
+    @classmethod
+    def on_stream(cls, response: requests.Response, *args, **kwargs):
+        if "text/event-stream" in response.headers.get("Content-Type", ""):
+            cls._streams.response = response
+
+    # Returns the last streamed response of the current thread once, or None if there is none
+    @classmethod
+    def take_stream_response(cls) -> requests.Response | None:
+        response = getattr(cls._streams, "response", None)
+        cls._streams.response = None
+        return response
+
+    @classmethod
+    def on_response(cls, response: requests.Response, *args, **kwargs):
+        authorization = response.request.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer "):
+            return
+        api_key = authorization[len("Bearer "):]
+
+        headers = response.headers
+        now = monotonic()
+        resets = [
+            cls.parse_duration(headers.get("x-ratelimit-reset-requests")),
+            cls.parse_duration(headers.get("x-ratelimit-reset-tokens")),
+        ]
+        resets = [x for x in resets if x is not None]
+
+        with cls._lock:
+            state = cls._keys.get(api_key)
+            if state is None:
+                return
+
+            if "x-ratelimit-remaining-requests" in headers:
+                state.limit_requests = cls.parse_int(headers.get("x-ratelimit-limit-requests"))
+                state.limit_tokens = cls.parse_int(headers.get("x-ratelimit-limit-tokens"))
+                state.remaining_requests = cls.parse_int(headers.get("x-ratelimit-remaining-requests"))
+                state.remaining_tokens = cls.parse_int(headers.get("x-ratelimit-remaining-tokens"))
+                state.reset_at = now + (max(resets) if resets else cls.COOLDOWN)
+
+            if response.status_code == 429:
+                cooldown = cls.parse_duration(headers.get("retry-after"))
+                if cooldown is None:
+                    cooldown = max(resets) if resets else cls.COOLDOWN
+                state.cooldown_until = now + cooldown
+
+        if response.status_code == 429:
+            Metrics.increment(Metrics.OPENAI_KEY_THROTTLED, {"key": cls.mask(api_key)})
@@ -0,0 +1,25 @@
+from typing import ContextManager, Callable
+from time import monotonic
+
+import threading
+
+
+# NOTE: Guards data a worker loads from mongodb and keeps in memory. The data is loaded on first use and again once
+# it is older than max_age. invalidate() only reaches the worker it runs in, the max age is what makes the other
+# uWSGI workers pick up a change.
+class PeriodicReload:
+    def __init__(self, lock: ContextManager | None = None):
+        self.lock = lock or threading.Lock()
+        self.loaded_at: float | None = None
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+    # Runs load() while holding the lock, unless the data is younger than max_age
+    def ensure(self, max_age: float, load: Callable[[], None]):
+        with self.lock:
+            if self.loaded_at is not None and monotonic() - self.loaded_at < max_age:
+                return
+            load()
+            self.loaded_at = monotonic()
@@ -0,0 +1,176 @@
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, Tuple
+from string import Formatter
+
+from .periodic_reload import PeriodicReload
+from .mongodb_connection import MongoDBConnection
+
+if TYPE_CHECKING:
+    from langchain import PromptTemplate
+
+
+@dataclass(slots=True)
+class CompiledPrompt:
+    name: str
+    # 0 is the built-in default, edited versions start at 1
+    version: int
+    template: str
+    input_variables: List[str]
+    # Tokens of the template without its variables, None if the tokenizer isn't loaded (see LangChainConnection.preload)
+    static_tokens: int | None
+    prompt: "PromptTemplate"
+
+    def format(self, **kwargs) -> str:
+        return self.prompt.format(**kwargs)
+
+
+# NOTE: Every prompt is compiled once per version into a PromptTemplate, instead of filling the template string on
+# every call. Admins can add new versions of a prompt (see PromptView), the active version of each prompt is loaded
+# from mongodb and falls back to the built-in default.
+class PromptRegistry:
+    GREETING: str = "greeting"
+    DESCRIPTION: str = "description"
+    HEADLINE: str = "headline"
+    QA: str = "qa"
+
+    DEFAULTS: Dict[str, str] = {
+        GREETING: """Du heißt Hugo Eckener und bist ein Luftschiffführer der sehr gerne anderen bei ihren Problemen hilft. 
+    Begrüße einen Schüler und stelle dich vor. 
+    Dutze deinen gegenüber immer. 
+    Du darfst Emoticons benutzen. 
+    Stelle bei der Begrüßung keine Fragen.""",
+        DESCRIPTION: """Fasse folgende Konversation in weniger als 5 Worten zusammen. Benutze dabei keine Anführungszeichen '"'.
+    Konversation:
+    Frage: {message}
+    Antwort: {result}""",
+        HEADLINE: """Erstelle einen Titel für den folgenden Text. Benutze dabei keine Anführungszeichen '"'.
+    Tex: {content}""",
+        QA: """Du heißt Hugo Eckener und ein freundlicher älterer Herr der sehr gerne anderen bei ihren Problemen hilft. Dutze deinen gegenüber immer.
+        
+        Falls die Antwort nicht in den in diesem Prompt übergebenen Informationen vorkommt, antworte immer mit "Keine Ahnung" und gib niemals eine andere Antwort. 
+        Ansonsten beantworte die Frage ausschließlich mit den übergebenen Informationen. 
+
+        Regel: Benutze immer Emoticons in deinen Antworten!
+
+        Informationen:
+        {context}
+
+        Erinnerung:
+        {chat_history}
+        Human: {question}
+        Hugo Eckener:""",
+    }
+
+    # Seconds until a version activated in another worker is used by this one
+    MAX_AGE: float = 60.0
+
+    # tiktoken encoding used to count the static tokens
+    encoding = None
+
+    _reload = PeriodicReload()
+
+    _active: Dict[str, CompiledPrompt] = {}
+    _compiled: Dict[Tuple[str, int, str], CompiledPrompt] = {}
+
+    # ----- Compiling ----------------------------------------------------------------------------------------------------
+    # NOTE: Runs before the workers are forked, so it must not open any connection
+    @classmethod
+    def preload(cls, encoding=None):
+        if encoding is not None:
+            cls.encoding = encoding
+        for name, template in cls.DEFAULTS.items():
+            cls.compile(name, 0, template)
+
+    @classmethod
+    def get_variables(cls, template: str) -> List[str]:
+        variables = set()
+        for _, field, _, _ in Formatter().parse(template):
+            if field is None:
+                continue
+            if not field.isidentifier():
+                raise ValueError(f"Invalid variable '{{{field}}}'. Write '{{{{' and '}}}}' for literal braces.")
+            variables.add(field)
+        return sorted(variables)
+
+    # Raises a ValueError if the template can't replace the template of the prompt
+    @classmethod
+    def validate(cls, name: str, template: str):
+        if name not in cls.DEFAULTS:
+            raise ValueError(f"Unknown prompt '{name}'.")
+        expected = cls.get_variables(cls.DEFAULTS[name])
+        variables = cls.get_variables(template)
+        if variables != expected:
+            allowed = ", ".join("{" + x + "}" for x in expected) or "none"
+            raise ValueError(f"The prompt '{name}' has to use exactly these variables: {allowed}.")
+
+    @classmethod
+    def count_tokens(cls, text: str) -> int | None:
+        if cls.encoding is None:
+            return None
+        return len(cls.encoding.encode(text))
+
+    # Counts the tokens of the template without its variables
+    @classmethod
+    def count_static_tokens(cls, template: str) -> int | None:
+        return cls.count_tokens("".join(literal for literal, _, _, _ in Formatter().parse(template)))
+
+    @classmethod
+    def compile(cls, name: str, version: int, template: str) -> CompiledPrompt:
+        key = (name, version, template)
+        compiled = cls._compiled.get(key)
+        if compiled is None:
+            from langchain import PromptTemplate
+
+            variables = cls.get_variables(template)
+            compiled = CompiledPrompt(
+                name,
+                version,
+                template,
+                variables,
+                cls.count_static_tokens(template),
+                PromptTemplate(input_variables=variables, template=template),
+            )
+            cls._compiled[key] = compiled
+        return compiled
+
+    # ----- Cache Handling -----------------------------------------------------------------------------------------------
+    @classmethod
+    def invalidate(cls):
+        cls._reload.invalidate()
+
+    @classmethod
+    def _ensure_loaded(cls):
+        cls._reload.ensure(cls.MAX_AGE, cls._load)
+
+    @classmethod
+    def _load(cls):
+        active = dict((name, cls.compile(name, 0, x)) for name, x in cls.DEFAULTS.items())
+        for doc in MongoDBConnection.prompt.find({"active": True}):
+            if doc.get("name") not in cls.DEFAULTS:
+                continue
+            try:
+                active[doc["name"]] = cls.compile(doc["name"], doc["version"], doc["template"])
+            except Exception as ex:
+                print(f"Failed to compile version {doc.get('version')} of prompt '{doc['name']}': {ex}", flush=True)
+
+        # NOTE: Only the defaults and the active versions stay compiled, replaced versions are dropped
+        keep = set((x.name, x.version, x.template) for x in active.values())
+        cls._compiled = dict((key, x) for key, x in cls._compiled.items() if key[1] == 0 or key in keep)
+
+        cls._active = active
+
+    # ----- Lookups ------------------------------------------------------------------------------------------------------
+    @classmethod
+    def get(cls, name: str) -> CompiledPrompt:
+        cls._ensure_loaded()
+        return cls._active[name]
+
+    @classmethod
+    def get_names(cls) -> List[str]:
+        return list(cls.DEFAULTS)
+
+    # Returns the template of the active version without compiling it, e.g. for the admin ui
+    @classmethod
+    def get_template(cls, name: str) -> str:
+        doc = MongoDBConnection.prompt.find_one({"name": name, "active": True}, {"template": 1})
+        return cls.DEFAULTS[name] if doc is None else doc["template"]
@@ -0,0 +1,146 @@
+from contextlib import contextmanager
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, Tuple
+
+import threading
+import random
+
+from .metrics import Metrics
+
+
+class UpstreamUnavailable(Exception):
+    pass
+
+
+# NOTE: Counts consecutive failures of one upstream (OpenAI, Weaviate). After FAILURE_THRESHOLD failures the
+# breaker opens and every call fails fast. After RESET_TIMEOUT a single trial call is let through (half open),
+# its outcome closes the breaker again or keeps it open for another RESET_TIMEOUT.
+class CircuitBreaker:
+    CLOSED: str = "closed"
+    OPEN: str = "open"
+    HALF_OPEN: str = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+
+    def before_call(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.trial_running = False
+            if self.state == self.HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return
+
+        Metrics.increment(Metrics.UPSTREAM_REJECTED, {"upstream": self.name})
+        raise UpstreamUnavailable(
+            f"{self.name} is currently not available. Please try again in a few seconds."
+        )
+
+    def on_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_running = False
+
+    def on_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    Metrics.increment(Metrics.BREAKER_OPENED, {"upstream": self.name})
+                self.state = self.OPEN
+                self.opened_at = monotonic()
+
+    @contextmanager
+    def guard(self):
+        self.before_call()
+        try:
+            yield
+        except BaseException as ex:
+            if Resilience.is_transient(ex):
+                self.on_failure()
+            else:
+                self.on_success()
+            raise
+        self.on_success()
+
+
+class Resilience:
+    OPENAI: str = "OpenAI"
+    WEAVIATE: str = "Weaviate"
+
+    # Seconds to establish a connection and to wait for the next bytes of a response
+    CONNECT_TIMEOUT: float = 5.0
+    READ_TIMEOUT: float = 30.0
+    # Seconds a student waits for the first token of an answer
+    FIRST_TOKEN_TIMEOUT: float = 20.0
+
+    # Attempts of idempotent calls and the base of their exponential backoff
+    ATTEMPTS: int = 3
+    BACKOFF: float = 0.5
+    MAX_BACKOFF: float = 8.0
+
+    breakers: Dict[str, CircuitBreaker] = {
+        OPENAI: CircuitBreaker(OPENAI),
+        WEAVIATE: CircuitBreaker(WEAVIATE),
+    }
+
+    @classmethod
+    def get_timeout(cls) -> Tuple[float, float]:
+        return (cls.CONNECT_TIMEOUT, cls.READ_TIMEOUT)
+
+    @classmethod
+    def is_transient(cls, ex: BaseException) -> bool:
+        import openai.error
+        import requests
+
+        if isinstance(ex, UpstreamUnavailable):
+            return False
+        if isinstance(
+            ex,
+            (
+                openai.error.Timeout,
+                openai.error.APIConnectionError,
+                openai.error.RateLimitError,
+                openai.error.ServiceUnavailableError,
+                openai.error.TryAgain,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                TimeoutError,
+                ConnectionError,
+            ),
+        ):
+            return True
+        if isinstance(ex, openai.error.APIError):
+            return ex.http_status is None or ex.http_status >= 500
+        return type(ex).__module__.startswith("weaviate")
+
+    # Runs function inside of the circuit breaker of the upstream
+    @classmethod
+    def call(cls, upstream: str, function: Callable[..., Any], *args, **kwargs) -> Any:
+        with cls.breakers[upstream].guard():
+            return function(*args, **kwargs)
+
+    # NOTE: Only for idempotent calls. Waits with full jitter, so retrying workers don't hit the upstream at once.
+    @classmethod
+    def call_with_retry(cls, upstream: str, function: Callable[..., Any], *args, **kwargs) -> Any:
+        for attempt in range(cls.ATTEMPTS):
+            try:
+                return cls.call(upstream, function, *args, **kwargs)
+            except Exception as ex:
+                if attempt + 1 >= cls.ATTEMPTS or not cls.is_transient(ex):
+                    raise
+            Metrics.increment(Metrics.UPSTREAM_RETRIES, {"upstream": upstream})
+            sleep(random.uniform(0, min(cls.MAX_BACKOFF, cls.BACKOFF * 2**attempt)))
@@ -0,0 +1,83 @@
+from bson.objectid import ObjectId
+from collections import OrderedDict
+from time import monotonic
+from typing import List, Tuple
+
+import threading
+
+
+class Session:
+    def __init__(self, version: int, date, subjects: List[ObjectId], messages: List[dict]):
+        self.version = version
+        self.date = date
+        self.subjects = subjects
+        self.messages = messages
+
+    def copy(self) -> "Session":
+        return Session(
+            self.version,
+            self.date,
+            list(self.subjects),
+            [dict(message) for message in self.messages],
+        )
+
+
+# NOTE: Keeps the histories of the running chats of this worker, so a follow-up question doesn't read the whole history
+# from mongodb again. Writes still go to mongodb right away. Every write increments the "version" of the history and
+# only applies if the version didn't change since the history was cached, so changes of other workers are detected
+# (see MongoDBConnection.update_session). Histories unused for IDLE_TIMEOUT seconds are evicted.
+class SessionCache:
+    MAX_SIZE: int = 512
+    IDLE_TIMEOUT: float = 30 * 60
+
+    _lock = threading.Lock()
+    _sessions: "OrderedDict[str, Tuple[float, Session]]" = OrderedDict()
+
+    # Returns a copy of the cached session, which may be changed freely
+    @classmethod
+    def get(cls, history_id: str) -> Session | None:
+        now = monotonic()
+        with cls._lock:
+            cls._evict_idle(now)
+            entry = cls._sessions.get(history_id)
+            if entry is None:
+                return None
+            cls._sessions[history_id] = (now, entry[1])
+            cls._sessions.move_to_end(history_id)
+            return entry[1].copy()
+
+    @classmethod
+    def put(cls, history_id: str, session: Session):
+        with cls._lock:
+            cls._store(history_id, session)
+
+    # Stores the changed session, unless another thread of this worker changed it since the given version was read
+    @classmethod
+    def replace(cls, history_id: str, version: int, session: Session):
+        with cls._lock:
+            entry = cls._sessions.get(history_id)
+            if entry is None or entry[1].version != version:
+                cls._sessions.pop(history_id, None)
+                return
+            cls._store(history_id, session)
+
+    @classmethod
+    def _store(cls, history_id: str, session: Session):
+        cls._sessions[history_id] = (monotonic(), session.copy())
+        cls._sessions.move_to_end(history_id)
+        while len(cls._sessions) > cls.MAX_SIZE:
+            cls._sessions.popitem(last=False)
+
+    @classmethod
+    def invalidate(cls, history_id: str):
+        with cls._lock:
+            cls._sessions.pop(history_id, None)
+
+    # NOTE: The sessions are ordered by their last use, so only the oldest ones have to be checked
+    @classmethod
+    def _evict_idle(cls, now: float):
+        while cls._sessions:
+            history_id, (used_at, _) = next(iter(cls._sessions.items()))
+            if now - used_at < cls.IDLE_TIMEOUT:
+                return
+            cls._sessions.popitem(last=False)
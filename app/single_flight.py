@@ -0,0 +1,138 @@
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import BaseMessage
+from typing import Any, Dict, List, Tuple
+
+import threading
+import hashlib
+import re
+
+from .streaming_handler import StreamingHandler
+
+
+# One running llm stream. Subscribers receive every token, including the ones emitted before they joined.
+class Flight(BaseCallbackHandler):
+    def __init__(self, key: str, leader: StreamingHandler):
+        self.key = key
+        self.leader = leader
+        self.lock = threading.Lock()
+        self.tokens: List[str] = []
+        self.subscribers: List[StreamingHandler] = []
+        self.streaming_over = False
+        self.cancelled = False
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    # Returns False if the stream was cancelled, the answer would be cut off
+    def subscribe(self, handler: StreamingHandler) -> bool:
+        with self.lock:
+            if self.cancelled:
+                return False
+            for token in self.tokens:
+                handler.queue.put(token)
+            if self.streaming_over:
+                handler.queue.put(StreamingHandler.STOP_ITEM)
+            else:
+                self.subscribers.append(handler)
+            return True
+
+    # NOTE: The stream only stops once the leader and every subscriber left. The decision is final and made under the
+    # same lock as subscribe, so a request either joins before the stream stops or leads a new one.
+    def is_cancelled(self) -> bool:
+        with self.lock:
+            if not self.cancelled and not self.streaming_over:
+                self.cancelled = self.leader.is_cancelled() and all(
+                    handler.is_cancelled() for handler in self.subscribers
+                )
+            return self.cancelled
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        with self.lock:
+            self.tokens.append(token)
+            for handler in self.subscribers:
+                if not handler.is_cancelled():
+                    handler.queue.put(token)
+
+    def on_llm_end(self, *args: Any, **kwargs: Any) -> None:
+        self.close_stream()
+
+    def close_stream(self):
+        with self.lock:
+            if self.streaming_over:
+                return
+            self.streaming_over = True
+            for handler in self.subscribers:
+                handler.queue.put(StreamingHandler.STOP_ITEM)
+            self.subscribers = []
+
+    def finish(self, result: Dict[str, Any] = None, error: BaseException = None):
+        self.result = result
+        self.error = error
+        # NOTE: On errors every subscriber reports the error on its own stream
+        if error is None:
+            self.close_stream()
+        self.done.set()
+
+    def wait(self) -> Dict[str, Any]:
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+# NOTE: Collapses identical concurrent questions (e.g. a whole class typing the projected question) into one llm
+# stream. Flights are only shared inside of one worker process and are forgotten as soon as they are finished.
+class SingleFlight:
+    # Characters of every history message taken into account
+    HISTORY_MESSAGE_LENGTH: int = 500
+
+    _lock = threading.Lock()
+    _flights: Dict[str, Flight] = {}
+
+    @classmethod
+    def normalize_question(cls, question: str) -> str:
+        question = re.sub(r"\s+", " ", question.strip().lower())
+        return question.rstrip("?!. ")
+
+    @classmethod
+    def get_key(
+        cls,
+        model: str,
+        question: str,
+        source_ids: List[str],
+        history: List[BaseMessage],
+        prompt: str = "",
+    ) -> str:
+        history_hash = hashlib.sha1()
+        for message in history:
+            history_hash.update(message.type.encode("utf-8"))
+            history_hash.update(message.content[: cls.HISTORY_MESSAGE_LENGTH].encode("utf-8"))
+
+        key = "\n".join(
+            [
+                model,
+                cls.normalize_question(question),
+                ",".join(sorted(source_ids)),
+                history_hash.hexdigest(),
+                prompt,
+            ]
+        )
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    # Subscribes the handler to the flight of the key and returns the flight and whether the handler leads it.
+    # A cancelled flight is replaced by a new one, even if its leader hasn't left yet.
+    @classmethod
+    def join(cls, key: str, handler: StreamingHandler) -> Tuple[Flight, bool]:
+        with cls._lock:
+            flight = cls._flights.get(key)
+            if flight is not None and flight.subscribe(handler):
+                return flight, False
+            flight = Flight(key, handler)
+            cls._flights[key] = flight
+            return flight, True
+
+    @classmethod
+    def leave(cls, flight: Flight):
+        with cls._lock:
+            if cls._flights.get(flight.key) is flight:
+                del cls._flights[flight.key]
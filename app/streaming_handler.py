@@ -3,6 +3,13 @@ from langchain.schema import LLMResult
 from typing import Any, Dict, List, Optional
 from queue import Queue
 from uuid import UUID
+from time import perf_counter
+
+from .metrics import Metrics
+from .tracing import Span, Tracer
+
+import threading
+import tiktoken
 
 
 class StreamingHandler(BaseCallbackHandler):
@@ -10,9 +17,34 @@ class StreamingHandler(BaseCallbackHandler):
 
     def __init__(self, queue: Queue):
         self.queue = queue
+        self.llm_start_time = None
+        self.first_token_time = None
+        self.cancelled = threading.Event()
+
+    # NOTE: Called when nobody reads the queue anymore, e.g. the student closed the tab
+    def cancel(self):
+        self.cancelled.set()
+
+    def is_cancelled(self) -> bool:
+        return self.cancelled.is_set()
+
+    # A llm run is cancelled once every handler waiting for its tokens is cancelled (see Flight.is_cancelled).
+    # Checked by the chat models while streaming, see CancellableChatOpenAI.
+    @classmethod
+    def is_run_cancelled(cls, handlers: List[BaseCallbackHandler]) -> bool:
+        states = [x.is_cancelled() for x in handlers if hasattr(x, "is_cancelled")]
+        return len(states) > 0 and all(states)
 
     def on_llm_new_token(self, token: str, **kwargs) -> None:
-        self.queue.put(token)
+        if self.first_token_time is None and self.llm_start_time is not None:
+            self.first_token_time = perf_counter()
+            Metrics.observe(
+                Metrics.STAGE_DURATION,
+                self.first_token_time - self.llm_start_time,
+                {"stage": "llm_first_token"},
+            )
+        if not self.cancelled.is_set():
+            self.queue.put(token)
 
     def on_llm_start(
         self,
@@ -23,6 +55,8 @@ class StreamingHandler(BaseCallbackHandler):
         parent_run_id: UUID | None = None,
         **kwargs: Any,
     ) -> Any:
+        self.llm_start_time = perf_counter()
+        self.first_token_time = None
         return super().on_llm_start(
             serialized, prompts, run_id=run_id, parent_run_id=parent_run_id, **kwargs
         )
@@ -35,8 +69,91 @@ class StreamingHandler(BaseCallbackHandler):
         parent_run_id: UUID | None = None,
         **kwargs: Any,
     ) -> Any:
+        if self.llm_start_time is not None:
+            Metrics.observe(
+                Metrics.STAGE_DURATION,
+                perf_counter() - self.llm_start_time,
+                {"stage": "llm_stream"},
+            )
         self.queue.put(self.STOP_ITEM)
 
         return super().on_llm_end(
             response, run_id=run_id, parent_run_id=parent_run_id, **kwargs
         )
+
+
+# Records every llm call of a trace as span, including its token counts
+class TracingHandler(BaseCallbackHandler):
+    ENCODING: str = "cl100k_base"
+
+    def __init__(self):
+        self.spans: Dict[UUID, Span] = {}
+        self.streamed_tokens: Dict[UUID, int] = {}
+
+    # NOTE: tiktoken downloads its encoding on first use. Without network access the count is skipped.
+    def count_tokens(self, texts: List[str]) -> int | None:
+        try:
+            encoding = tiktoken.get_encoding(self.ENCODING)
+        except Exception:
+            return None
+        return sum(len(encoding.encode(text)) for text in texts)
+
+    def on_llm_start(
+        self,
+        serialized: Dict[str, Any],
+        prompts: List[str],
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        **kwargs: Any,
+    ) -> Any:
+        span = Tracer.start_span("llm")
+        if span is not None:
+            span.set_attribute(
+                "model", kwargs.get("invocation_params", {}).get("model_name")
+            )
+            span.set_attribute("prompt_tokens", self.count_tokens(prompts))
+            self.spans[run_id] = span
+            self.streamed_tokens[run_id] = 0
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> Any:
+        if run_id in self.streamed_tokens:
+            self.streamed_tokens[run_id] += 1
+
+    def on_llm_end(
+        self,
+        response: LLMResult,
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        **kwargs: Any,
+    ) -> Any:
+        span = self.spans.pop(run_id, None)
+        streamed_tokens = self.streamed_tokens.pop(run_id, 0)
+        if span is None:
+            return
+
+        # NOTE: Streamed responses don't report their usage, so the streamed tokens are counted instead
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if "prompt_tokens" in usage:
+            span.set_attribute("prompt_tokens", usage["prompt_tokens"])
+        span.set_attribute(
+            "completion_tokens", usage.get("completion_tokens", streamed_tokens)
+        )
+        if (response.llm_output or {}).get("cancelled"):
+            span.set_attribute("cancelled", True)
+        span.end()
+
+    def on_llm_error(
+        self,
+        error: BaseException,
+        *,
+        run_id: UUID,
+        parent_run_id: UUID | None = None,
+        **kwargs: Any,
+    ) -> Any:
+        span = self.spans.pop(run_id, None)
+        self.streamed_tokens.pop(run_id, None)
+        if span is not None:
+            span.set_error(error)
+            span.end()
@@ -0,0 +1,83 @@
+from bson.objectid import ObjectId
+from typing import Dict, List, Tuple
+
+from .periodic_reload import PeriodicReload
+from .mongodb_connection import MongoDBConnection
+
+
+class SubjectDirectory:
+    # Seconds until subjects and users changed in another worker show up in this one
+    MAX_AGE: float = 60.0
+
+    _reload = PeriodicReload()
+
+    _labels: Dict[ObjectId, str] = {}
+    _subject_teachers: Dict[ObjectId, ObjectId] = {}
+    _teacher_subjects: Dict[ObjectId, List[ObjectId]] = {}
+    _usernames: Dict[ObjectId, str] = {}
+
+    # ----- Cache Handling -----------------------------------------------------------------------------------------------
+    @classmethod
+    def invalidate(cls):
+        cls._reload.invalidate()
+
+    @classmethod
+    def _ensure_loaded(cls):
+        cls._reload.ensure(cls.MAX_AGE, cls._load)
+
+    @classmethod
+    def _load(cls):
+        users = MongoDBConnection.user.find({}, {"username": 1})
+        usernames = dict((x["_id"], x["username"]) for x in users)
+
+        labels = {}
+        subject_teachers = {}
+        teacher_subjects = {}
+        for sub in MongoDBConnection.subject.find({}):
+            teacher_id = sub.get("teacher_id")
+            labels[sub["_id"]] = (
+                f"{sub['subject']} - {sub['course']} - {usernames.get(teacher_id)}"
+            )
+            subject_teachers[sub["_id"]] = teacher_id
+            teacher_subjects.setdefault(teacher_id, []).append(sub["_id"])
+
+        cls._labels = labels
+        cls._subject_teachers = subject_teachers
+        cls._teacher_subjects = teacher_subjects
+        cls._usernames = usernames
+
+    # ----- Lookups ------------------------------------------------------------------------------------------------------
+    @classmethod
+    def get_label(cls, subject_id: ObjectId) -> str | None:
+        cls._ensure_loaded()
+        return cls._labels.get(subject_id)
+
+    @classmethod
+    def get_labels(cls, subject_ids: List[ObjectId]) -> List[str]:
+        cls._ensure_loaded()
+        return [cls._labels[x] for x in subject_ids if x in cls._labels]
+
+    @classmethod
+    def get_teacher_id(cls, subject_id: ObjectId) -> ObjectId | None:
+        cls._ensure_loaded()
+        return cls._subject_teachers.get(subject_id)
+
+    @classmethod
+    def get_username(cls, user_id: ObjectId) -> str | None:
+        cls._ensure_loaded()
+        return cls._usernames.get(user_id)
+
+    @classmethod
+    def get_usernames(cls) -> Dict[ObjectId, str]:
+        cls._ensure_loaded()
+        return cls._usernames
+
+    # Returns (subject_id, label) pairs of every subject, or only of the subjects of the given teacher
+    @classmethod
+    def get_subject_choices(
+        cls, teacher_id: ObjectId | None = None
+    ) -> List[Tuple[ObjectId, str]]:
+        cls._ensure_loaded()
+        if teacher_id is None:
+            return list(cls._labels.items())
+        return [(x, cls._labels[x]) for x in cls._teacher_subjects.get(teacher_id, [])]
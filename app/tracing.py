@@ -0,0 +1,213 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Any, Callable, Dict, List
+from time import time, perf_counter
+from uuid import uuid4
+
+import threading
+import atexit
+import json
+import os
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: str | None, attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_time = time()
+        self.duration = None
+        self.status = "ok"
+        self.error = None
+        self._start = perf_counter()
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def set_error(self, ex: BaseException):
+        self.status = "error"
+        self.error = f"{type(ex).__qualname__}: {ex}"
+
+    def end(self):
+        if self.duration is not None:
+            return
+        self.duration = perf_counter() - self._start
+        Tracer.export(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration": self.duration,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+# ----- Exporter ---------------------------------------------------------------------------------------------------------
+class SpanExporter(ABC):
+    # Called with every finished span, on the thread which ended it
+    @abstractmethod
+    def export(self, span: Span):
+        pass
+
+
+# Appends every finished span as one json line to a local file. The file is rotated once it exceeds MAX_SIZE.
+# NOTE: Spans are queued and written in batches by a background thread, so requests never wait for the disk.
+# Spans above MAX_PENDING are dropped until the next flush.
+class JsonLinesExporter(SpanExporter):
+    MAX_SIZE: int = 50 * 1024 * 1024
+    # Amount of queued spans which triggers an early flush
+    BATCH_SIZE: int = 200
+    MAX_PENDING: int = 10_000
+    # Seconds between two flushes
+    FLUSH_INTERVAL: float = 1.0
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending: List[dict] = []
+        self.dropped = 0
+        self.thread: threading.Thread | None = None
+        self.pid: int | None = None
+        atexit.register(self.flush)
+
+    def export(self, span: Span):
+        with self.lock:
+            if len(self.pending) >= self.MAX_PENDING:
+                self.dropped += 1
+                return
+            self.pending.append(span.to_dict())
+            is_full = len(self.pending) >= self.BATCH_SIZE
+        self._ensure_thread()
+        if is_full:
+            self.wakeup.set()
+
+    # NOTE: uWSGI forks its workers, so every process has to start its own thread
+    def _ensure_thread(self):
+        if self.pid == os.getpid() and self.thread is not None:
+            return
+        with self.lock:
+            if self.pid == os.getpid() and self.thread is not None:
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.FLUSH_INTERVAL)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as ex:
+                print(f"Failed to export spans: {ex}", flush=True)
+
+    def flush(self):
+        from .metrics import Metrics
+
+        with self.lock:
+            spans, self.pending = self.pending, []
+            dropped, self.dropped = self.dropped, 0
+        if dropped > 0:
+            Metrics.increment(Metrics.DROPPED_SPANS, value=dropped)
+        if len(spans) == 0:
+            return
+
+        lines = "".join(json.dumps(span, default=str) + "\n" for span in spans)
+        with self.write_lock:
+            try:
+                if os.path.getsize(self.path) > self.MAX_SIZE:
+                    os.replace(self.path, f"{self.path}.1")
+            except OSError:
+                pass
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(lines)
+
+
+# ----- Tracer -----------------------------------------------------------------------------------------------------------
+# NOTE: Spans are only recorded inside of a trace. Without a root span all calls are no-ops.
+class Tracer:
+    TRACE_FILE: str = os.environ.get(
+        "TRACE_FILE",
+        os.path.join(os.path.dirname(os.path.dirname(__file__)), "instance", "traces.jsonl"),
+    )
+
+    _current: ContextVar[Span | None] = ContextVar("current_span", default=None)
+    _exporter: SpanExporter | None = None
+
+    @classmethod
+    def set_exporter(cls, exporter: SpanExporter | None):
+        cls._exporter = exporter
+
+    @classmethod
+    def get_exporter(cls) -> SpanExporter:
+        if cls._exporter is None:
+            os.makedirs(os.path.dirname(cls.TRACE_FILE), exist_ok=True)
+            cls._exporter = JsonLinesExporter(cls.TRACE_FILE)
+        return cls._exporter
+
+    @classmethod
+    def export(cls, span: Span):
+        try:
+            cls.get_exporter().export(span)
+        except Exception as ex:
+            print(f"Failed to export span '{span.name}': {ex}", flush=True)
+
+    @classmethod
+    def current_span(cls) -> Span | None:
+        return cls._current.get()
+
+    # Starts a new trace when trace_id is given, otherwise a child of the current span
+    @classmethod
+    def start_span(cls, name: str, trace_id: str | None = None, **attributes) -> Span | None:
+        parent = cls._current.get()
+        if trace_id is not None:
+            return Span(name, trace_id, None, attributes)
+        if parent is None:
+            return None
+        return Span(name, parent.trace_id, parent.span_id, attributes)
+
+    @classmethod
+    @contextmanager
+    def span(cls, name: str, trace_id: str | None = None, **attributes):
+        span = cls.start_span(name, trace_id, **attributes)
+        if span is None:
+            yield None
+            return
+
+        token = cls._current.set(span)
+        try:
+            yield span
+        except BaseException as ex:
+            span.set_error(ex)
+            raise
+        finally:
+            cls._current.reset(token)
+            span.end()
+
+    # NOTE: Threads don't inherit the context of their creator.
+    # Wrap the thread target to continue the current trace, or the given span, inside of the thread.
+    @classmethod
+    def wrap(cls, function: Callable, span: Span | None = None) -> Callable:
+        context = copy_context()
+
+        def _run(*args, **kwargs):
+            if span is not None:
+                cls._current.set(span)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if span is not None:
+                    span.end()
+
+        return lambda *args, **kwargs: context.run(_run, *args, **kwargs)
@@ -0,0 +1,226 @@
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import threading
+
+from .mongodb_connection import MongoDBConnection
+from .subject_directory import SubjectDirectory
+from .lease_lock import LeaseLock
+from .tracing import Tracer
+
+
+# NOTE: The dashboard only reads the Usage_Rollup collection. The rollups are counted up while the chats are running
+# (see MongoDBConnection.add_usage) and can be rebuilt from all chat histories, e.g. after the counting changed.
+# Usage recorded while a rebuild is running may be lost, the rebuild only sees the histories at its start.
+# The counters are written by the background writer. If it loses some of them, the rollups are marked as incomplete
+# and rebuilt (see on_lost).
+class UsageStatistics:
+    JOB_TYPE: str = "usage_rollup_rebuild"
+    TOP_SOURCES: int = 10
+    COUNTERS = ("sessions", "turns", "reviews", "unknown_answers")
+    # NOTE: The teacher rows sum the rollups of the subjects. A session with several subjects of one teacher would be
+    # counted once per subject, so the teacher rows leave out the sessions.
+    TEACHER_COUNTERS = ("turns", "reviews", "unknown_answers")
+
+    lock = LeaseLock("usage_rollup")
+
+    # ----- Rebuild ------------------------------------------------------------------------------------------------------
+    # Returns the id of the started job, or None if a rebuild is already running
+    @classmethod
+    def start_rebuild(cls) -> ObjectId | None:
+        job_id = MongoDBConnection.create_job(ObjectId(), cls.JOB_TYPE, "running")
+        lease = cls.lock.try_acquire(job_id=str(job_id))
+        if lease is None:
+            MongoDBConnection.delete_job(job_id)
+            return None
+
+        def _run():
+            started = datetime.now()
+            try:
+                rollups = cls.rebuild()
+                lease.check()
+                MongoDBConnection.clear_usage_dirty(started)
+                MongoDBConnection.update_job(job_id, {"phase": "done", "total": rollups})
+            except Exception as ex:
+                MongoDBConnection.add_exception(cls.JOB_TYPE, ex)
+                MongoDBConnection.update_job(job_id, {"phase": "failed", "msg": str(ex)})
+                return
+            finally:
+                lease.release()
+
+            # NOTE: Updates lost during the rebuild couldn't start another one
+            if MongoDBConnection.get_usage_dirty() is not None:
+                cls.start_rebuild()
+
+        span = Tracer.start_span(f"job/{cls.JOB_TYPE}", trace_id=str(job_id))
+        threading.Thread(target=Tracer.wrap(_run, span)).start()
+        return job_id
+
+    # Called by the background writer when updates of the rollups were lost (see main.warm_up)
+    @classmethod
+    def on_lost(cls, amount: int):
+        MongoDBConnection.mark_usage_dirty()
+        cls.start_rebuild()
+
+    # Counts the sessions, turns, reviews and unknown answers per day and subject
+    @classmethod
+    def get_counter_pipeline(cls) -> List[dict]:
+        messages = {"$filter": {"input": {"$ifNull": ["$messages", []]}, "cond": {"$ne": ["$$this.response", ""]}}}
+        return [
+            {
+                "$project": {
+                    "date": 1,
+                    "subjects": {"$concatArrays": [[None], {"$ifNull": ["$subjects", []]}]},
+                    "messages": messages,
+                }
+            },
+            {
+                "$project": {
+                    "date": 1,
+                    "subjects": 1,
+                    "turns": {"$size": "$messages"},
+                    "reviews": {
+                        "$size": {
+                            "$filter": {
+                                "input": "$messages",
+                                "cond": {"$in": ["$$this.tag", list(MongoDBConnection.REVIEW_MSG_TAGS)]},
+                            }
+                        }
+                    },
+                    "unknown_answers": {
+                        "$size": {
+                            "$filter": {
+                                "input": "$messages",
+                                "cond": {
+                                    "$regexMatch": {
+                                        "input": "$$this.response",
+                                        "regex": MongoDBConnection.UNKNOWN_ANSWER,
+                                        "options": "i",
+                                    }
+                                },
+                            }
+                        }
+                    },
+                }
+            },
+            {"$unwind": "$subjects"},
+            {
+                "$group": {
+                    "_id": {"day": "$date", "subject_id": "$subjects"},
+                    "sessions": {"$sum": 1},
+                    "turns": {"$sum": "$turns"},
+                    "reviews": {"$sum": "$reviews"},
+                    "unknown_answers": {"$sum": "$unknown_answers"},
+                }
+            },
+        ]
+
+    # Counts the citations of every source per day and subject
+    @classmethod
+    def get_source_pipeline(cls) -> List[dict]:
+        return [
+            {"$unwind": "$messages"},
+            {"$match": {"messages.response": {"$ne": ""}}},
+            {"$unwind": "$messages.source_ids"},
+            {
+                "$project": {
+                    "date": 1,
+                    "source_id": "$messages.source_ids",
+                    "subjects": {"$concatArrays": [[None], {"$ifNull": ["$subjects", []]}]},
+                }
+            },
+            {"$unwind": "$subjects"},
+            {
+                "$group": {
+                    "_id": {"day": "$date", "subject_id": "$subjects", "source_id": "$source_id"},
+                    "count": {"$sum": 1},
+                }
+            },
+        ]
+
+    # Recomputes all rollups from the chat histories and replaces the rollup collection at once
+    @classmethod
+    def rebuild(cls) -> int:
+        rollups: Dict[str, dict] = {}
+
+        def _get_rollup(day: datetime, subject_id: ObjectId | None) -> dict:
+            if hasattr(day, "as_datetime"):
+                day = day.as_datetime()
+            day = day.replace(hour=0, minute=0, second=0, microsecond=0)
+            id = MongoDBConnection.get_usage_id(day, subject_id)
+            if id not in rollups:
+                rollups[id] = {"_id": id, "day": day, "subject_id": subject_id, "sources": {}}
+                rollups[id].update((key, 0) for key in cls.COUNTERS)
+            return rollups[id]
+
+        histories = MongoDBConnection.chat_history
+        for group in histories.aggregate(cls.get_counter_pipeline(), allowDiskUse=True):
+            rollup = _get_rollup(group["_id"]["day"], group["_id"]["subject_id"])
+            for key in cls.COUNTERS:
+                rollup[key] += group[key]
+
+        for group in histories.aggregate(cls.get_source_pipeline(), allowDiskUse=True):
+            rollup = _get_rollup(group["_id"]["day"], group["_id"]["subject_id"])
+            source_id = str(group["_id"]["source_id"])
+            rollup["sources"][source_id] = rollup["sources"].get(source_id, 0) + group["count"]
+
+        rebuilt = MongoDBConnection.db[f"{MongoDBConnection.USAGE_ROLLUP_COLL}_Rebuild"]
+        rebuilt.drop()
+        if rollups:
+            rebuilt.insert_many(list(rollups.values()))
+            rebuilt.rename(MongoDBConnection.USAGE_ROLLUP_COLL, dropTarget=True)
+        else:
+            MongoDBConnection.usage_rollup.delete_many({})
+        return len(rollups)
+
+    # ----- Dashboard ----------------------------------------------------------------------------------------------------
+    # Sums the rollups of the last days per day (totals), per subject and per teacher
+    @classmethod
+    def get_dashboard(cls, days: int) -> dict:
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        since = today - timedelta(days=days - 1)
+
+        daily = []
+        subjects: Dict[ObjectId, dict] = {}
+        teachers: Dict[ObjectId | None, dict] = {}
+        sources: Dict[str, int] = {}
+        total = dict((key, 0) for key in cls.COUNTERS)
+
+        def _add(target: dict, rollup: dict, counters: tuple = cls.COUNTERS):
+            for key in counters:
+                target[key] = target.get(key, 0) + rollup.get(key, 0)
+
+        for rollup in MongoDBConnection.get_usage_rollups(since):
+            subject_id = rollup.get("subject_id")
+            if subject_id is None:
+                daily.append(rollup)
+                _add(total, rollup)
+                for source_id, count in rollup.get("sources", {}).items():
+                    sources[source_id] = sources.get(source_id, 0) + count
+                continue
+
+            _add(subjects.setdefault(subject_id, {}), rollup)
+            _add(teachers.setdefault(SubjectDirectory.get_teacher_id(subject_id), {}), rollup, cls.TEACHER_COUNTERS)
+
+        top_sources = sorted(sources.items(), key=lambda x: x[1], reverse=True)[: cls.TOP_SOURCES]
+        headlines = MongoDBConnection.get_information_headlines([x for x, _ in top_sources])
+
+        return {
+            "since": since,
+            "total": total,
+            "daily": sorted(daily, key=lambda x: x["day"], reverse=True),
+            "subjects": sorted(
+                ((SubjectDirectory.get_label(x) or str(x), counts) for x, counts in subjects.items()),
+                key=lambda x: x[1].get("turns", 0),
+                reverse=True,
+            ),
+            "teachers": sorted(
+                ((SubjectDirectory.get_username(x) or "-", counts) for x, counts in teachers.items()),
+                key=lambda x: x[1].get("turns", 0),
+                reverse=True,
+            ),
+            "sources": [(x, headlines.get(x, x), count) for x, count in top_sources],
+            "last_rebuild": MongoDBConnection.get_last_job(cls.JOB_TYPE),
+            "last_loss": MongoDBConnection.get_usage_dirty(),
+        }
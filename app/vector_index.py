@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+from .periodic_reload import PeriodicReload
+from .mongodb_connection import MongoDBConnection
+
+
+# NOTE: Blue/green versions of the weaviate index. A rebuild fills a fresh class (e.g. Information_Vectorstore_v42)
+# while the students keep using the active one. After verifying the new class, the active pointer in mongodb is
+# swapped. Retired classes are deleted after GRACE_PERIOD, so requests which already read the old pointer can finish.
+class VectorIndex:
+    # Seconds a worker keeps using the active index name it read last
+    MAX_AGE: float = 10.0
+    GRACE_PERIOD: timedelta = timedelta(minutes=15)
+
+    _reload = PeriodicReload()
+    _active_name: str | None = None
+
+    @classmethod
+    def invalidate(cls):
+        cls._reload.invalidate()
+
+    @classmethod
+    def _load(cls):
+        index = MongoDBConnection.get_active_vector_index()
+        cls._active_name = index["name"] if index is not None else None
+
+    # Returns the name of the active class, or the legacy name if no versioned index was built yet
+    @classmethod
+    def get_active_name(cls, legacy_name: str) -> str:
+        cls._reload.ensure(cls.MAX_AGE, cls._load)
+        return cls._active_name or legacy_name
+
+    @classmethod
+    def create(cls, index_prefix: str) -> tuple[int, str]:
+        return MongoDBConnection.create_vector_index(index_prefix)
+
+    @classmethod
+    def activate(cls, version: int, documents: int, legacy_name: str):
+        if MongoDBConnection.get_active_vector_index() is None:
+            MongoDBConnection.retire_legacy_vector_index(legacy_name)
+        MongoDBConnection.activate_vector_index(version, documents)
+        cls.invalidate()
+
+    @classmethod
+    def fail(cls, version: int):
+        MongoDBConnection.retire_vector_index(version, "failed")
+
+    # Deletes the weaviate classes of versions retired (or failed) longer than GRACE_PERIOD ago
+    @classmethod
+    def collect_garbage(cls, client) -> int:
+        deleted = 0
+        for index in MongoDBConnection.get_retired_vector_indexes(datetime.now() - cls.GRACE_PERIOD):
+            if client.schema.exists(index["name"]):
+                client.schema.delete_class(index["name"])
+                deleted += 1
+            MongoDBConnection.delete_vector_index(index["_id"])
+        return deleted
@@ -0,0 +1,123 @@
+from bson.datetime_ms import DatetimeMS
+from bson.objectid import ObjectId
+from datetime import datetime
+from time import perf_counter
+
+import threading
+
+from .langchain_connection import LangChainConnection
+from .mongodb_connection import MongoDBConnection
+from .lease_lock import Lease, LeaseLock
+from .tracing import Tracer
+from . import admin_classes as ad_cls
+
+
+# NOTE: Rebuilds the vector store in a background thread of the worker that received /update_vector_store.
+# The progress is stored in the Job collection, so every worker can answer the status requests of the admin ui.
+class VectorStoreJob:
+    TYPE: str = "vector_store_rebuild"
+
+    QUEUED: str = "queued"
+    LOADING: str = "loading"
+    EMBEDDING: str = "embedding"
+    PUBLISHING: str = "publishing"
+    DONE: str = "done"
+    FAILED: str = "failed"
+
+    # NOTE: Only one rebuild runs at a time across all workers, a second one could corrupt the index
+    lock = LeaseLock("vector_store")
+
+    # Returns the id of the new job, or of the job which is still running, and whether a new job was started
+    @classmethod
+    def start(cls) -> tuple[ObjectId | None, bool]:
+        # NOTE: The job is created first, so the id stored in the lock always belongs to an existing job
+        job_id = MongoDBConnection.create_job(ObjectId(), cls.TYPE, cls.QUEUED)
+        lease = cls.lock.try_acquire(job_id=str(job_id))
+        if lease is None:
+            MongoDBConnection.delete_job(job_id)
+            holder = cls.lock.get_holder()
+            running_job_id = holder["data"].get("job_id") if holder is not None else None
+            return running_job_id, False
+
+        try:
+            span = Tracer.start_span(f"job/{cls.TYPE}", trace_id=str(job_id))
+            thread = threading.Thread(target=Tracer.wrap(cls.run, span), args=(job_id, lease))
+            thread.start()
+        except BaseException:
+            lease.release()
+            raise
+
+        return job_id, True
+
+    @classmethod
+    def run(cls, job_id: ObjectId, lease: Lease):
+        started = perf_counter()
+
+        def _progress(done: int, total: int):
+            elapsed = perf_counter() - started
+            MongoDBConnection.update_job(
+                job_id,
+                {
+                    "phase": cls.EMBEDDING,
+                    "done": done,
+                    "total": total,
+                    "embed_rate": done / elapsed if elapsed > 0 else 0.0,
+                },
+            )
+
+        try:
+            MongoDBConnection.update_job(job_id, {"phase": cls.LOADING})
+
+            # NOTE: Only the informations pending at the start are part of this build, so only those are set live
+            pending_ids = MongoDBConnection.get_pending_information_ids()
+            vector_store = LangChainConnection.create_weaviate(_progress)
+            if vector_store is None:
+                raise Exception("The vector store wasn't created.")
+
+            lease.check()
+            MongoDBConnection.update_job(job_id, {"phase": cls.PUBLISHING})
+            with ad_cls.information_lock.hold():
+                query = {"_id": {"$in": pending_ids}, "tag": MongoDBConnection.PRE_LIVE_INFO_TAG}
+                MongoDBConnection.update_information_tag(query, MongoDBConnection.LIVE_INFO_TAG)
+
+            type = "info"
+            msg = "Successfully updated weaviate vector store."
+            phase = cls.DONE
+        except Exception as ex:
+            span = Tracer.current_span()
+            if span is not None:
+                span.set_error(ex)
+            MongoDBConnection.add_exception(cls.TYPE, ex)
+            type = "error"
+            msg = f"Failed to update weaviate vector store: '{str(ex)}'"
+            phase = cls.FAILED
+        finally:
+            lease.release()
+
+        MongoDBConnection.update_job(
+            job_id,
+            {
+                "phase": phase,
+                "type": type,
+                "msg": msg,
+                "finished": DatetimeMS(datetime.now()),
+                "duration": perf_counter() - started,
+            },
+        )
+        ad_cls.write_log(msg)
+
+    @classmethod
+    def get_status(cls, job_id: str) -> dict | None:
+        # NOTE: A malformed id can't belong to any job, ObjectId() would raise an InvalidId
+        if not ObjectId.is_valid(job_id):
+            return None
+
+        job = MongoDBConnection.get_job(job_id)
+        if job is None:
+            return None
+
+        job["_id"] = str(job["_id"])
+        for key in ("started", "finished"):
+            if key in job:
+                job[key] = str(job[key])
+        return job
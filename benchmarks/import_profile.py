@@ -0,0 +1,132 @@
+# Startup profile of a worker. Every run starts a fresh interpreter and measures how long it takes to import the app,
+# to preload the heavy modules (done once by the uWSGI master), to warm up the worker and to answer the first request.
+#
+# Usage (from the repository root):
+#   python -m benchmarks.import_profile
+#   python -m benchmarks.import_profile --runs 10 --top 15 --compare benchmarks/results/<run>.json
+from typing import Dict, List, Tuple
+
+import subprocess
+import argparse
+import json
+import sys
+import re
+
+from .reporting import compare_results, print_results, save_results, summarize
+
+PHASES = ("import", "preload", "warm_up", "first_request")
+PHASE_MARKER = "#phase "
+
+# NOTE: Runs inside of the child interpreter. The phase markers split the -X importtime output written to stderr.
+CHILD = f"""
+import json, sys
+from time import perf_counter
+
+def phase(name):
+    print("{PHASE_MARKER}" + name, file=sys.stderr, flush=True)
+
+timings = {{}}
+phase("import")
+start = perf_counter()
+from benchmarks.offline_app import load_app, seed_database
+main = load_app("mongomock", {{"FAKE_LLM_FIRST_TOKEN_LATENCY": 0, "FAKE_LLM_TOKENS_PER_SECOND": 1000000}})
+timings["import"] = perf_counter() - start
+seed_database(main.MongoDBConnection.db, informations=50, histories=1)
+
+phase("preload")
+start = perf_counter()
+main.preload()
+timings["preload"] = perf_counter() - start
+
+phase("warm_up")
+start = perf_counter()
+main.warm_up()
+timings["warm_up"] = perf_counter() - start
+
+phase("first_request")
+client = main.app.test_client()
+start = perf_counter()
+token = client.get("/get_token", headers={{"API-KEY": "benchmark-api-key"}}).json["token"]
+client.post("/start_session", headers={{"BEARER-TOKEN": token}})
+timings["first_request"] = perf_counter() - start
+
+print(json.dumps(timings))
+"""
+
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+# Returns the cumulative import time (seconds) of every top level package, per phase
+def parse_import_times(stderr: str) -> Dict[str, Dict[str, float]]:
+    phases: Dict[str, Dict[str, float]] = {}
+    current = phases.setdefault("startup", {})
+    for line in stderr.splitlines():
+        if line.startswith(PHASE_MARKER):
+            current = phases.setdefault(line[len(PHASE_MARKER):], {})
+            continue
+
+        match = IMPORT_LINE.match(line)
+        if match is None:
+            continue
+        package = match.group(4).split(".")[0]
+        if package in ("app", "benchmarks"):
+            continue
+        cumulative = int(match.group(2)) / 1_000_000
+        current[package] = max(current.get(package, 0.0), cumulative)
+    return phases
+
+
+def run_child() -> Tuple[Dict[str, float], Dict[str, Dict[str, float]]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise Exception(f"The profiled worker failed:\n{result.stderr[-2000:]}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    return timings, parse_import_times(result.stderr)
+
+
+def print_packages(packages: Dict[str, Dict[str, float]], top: int):
+    for phase in PHASES:
+        ranked = sorted(packages.get(phase, {}).items(), key=lambda x: x[1], reverse=True)[:top]
+        if not ranked:
+            continue
+        print(f"\nSlowest imports during '{phase}':")
+        for package, seconds in ranked:
+            print(f"  {package:<32}{seconds * 1000:>10.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup profile of a worker.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="Amount of packages listed per phase")
+    parser.add_argument("--compare", help="Result file of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown before a regression is reported")
+    args = parser.parse_args()
+
+    timings: Dict[str, List[float]] = dict((phase, []) for phase in PHASES)
+    packages = {}
+    for run in range(args.runs):
+        print(f"Run {run + 1} / {args.runs} ...", file=sys.stderr)
+        run_timings, packages = run_child()
+        for phase in PHASES:
+            timings[phase].append(run_timings[phase])
+
+    results = dict((phase, summarize(values, [], 0, sum(values))) for phase, values in timings.items())
+    print_results(results)
+    print_packages(packages, args.top)
+
+    path = save_results("import_profile", results, vars(args))
+    print(f"\nResults stored in '{path}'")
+
+    if args.compare:
+        regressions = compare_results(results, args.compare, args.threshold)
+        if regressions:
+            print(f"\nRegressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
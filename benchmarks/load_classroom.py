@@ -0,0 +1,318 @@
+# Load generator simulating a classroom of students chatting at the same time.
+# Every virtual student runs the real api flow: /get_token -> /start_session -> several /get_response turns.
+#
+# Usage (from the repository root, server started with FAKE_LLM=1 so no OpenAI calls are made):
+#   python -m benchmarks.load_classroom --url http://localhost:5000 --students 30
+#   python -m benchmarks.load_classroom --spawn --mongo mongodb://localhost:27017 --students 30
+from urllib.parse import urlsplit
+from time import perf_counter, sleep, time
+from typing import Dict, List
+
+import http.client
+import subprocess
+import threading
+import argparse
+import json
+import sys
+import os
+
+from .offline_app import BENCHMARK_ENV
+from .reporting import percentile, save_results
+
+REPO_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Turn:
+    def __init__(self, student: int, started: float):
+        self.student = student
+        self.started = started
+        self.queue_delay = None
+        self.first_token_time = None
+        self.finished_time = None
+        self.worker = None
+        self.error = None
+
+
+class Classroom:
+    def __init__(self, url: str, api_key: str, students: int, turns: int, ramp_up: float, think_time: float, timeout: float):
+        split = urlsplit(url)
+        self.host = split.hostname
+        self.port = split.port or 80
+        self.api_key = api_key
+        self.students = students
+        self.turns = turns
+        self.ramp_up = ramp_up
+        self.think_time = think_time
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.results: List[Turn] = []
+        self.active_streams = 0
+        self.max_active_streams = 0
+        self.failed_sessions = 0
+        self.start = None
+
+    # ----- HTTP ---------------------------------------------------------------------------------------------------------
+    def request(self, method: str, path: str, headers: Dict[str, str], body: dict = None):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        data = json.dumps(body) if body is not None else None
+        if data is not None:
+            headers = dict(headers, **{"Content-Type": "application/json"})
+        connection.request(method, path, body=data, headers=headers)
+        return connection, connection.getresponse()
+
+    def request_json(self, method: str, path: str, headers: Dict[str, str], body: dict = None):
+        connection, response = self.request(method, path, headers, body)
+        try:
+            if response.status != 200:
+                raise RuntimeError(f"{path} returned {response.status}")
+            return json.loads(response.read())
+        finally:
+            connection.close()
+
+    # ----- Virtual Student ----------------------------------------------------------------------------------------------
+    def run_student(self, student: int):
+        try:
+            token = self.request_json("GET", "/get_token", {"API-KEY": self.api_key})["token"]
+            headers = {"BEARER-TOKEN": token}
+            history_id = self.request_json("POST", "/start_session", headers)["history_id"]
+        except Exception as ex:
+            print(f"Student {student} failed to start a session: {ex}", file=sys.stderr)
+            with self.lock:
+                self.failed_sessions += 1
+            return
+
+        for turn_idx in range(self.turns):
+            self.run_turn(student, headers, history_id, turn_idx)
+            sleep(self.think_time)
+
+    def run_turn(self, student: int, headers: Dict[str, str], history_id: str, turn_idx: int):
+        turn = Turn(student, perf_counter() - self.start)
+        body = {"history_id": history_id, "message": f"Frage {turn_idx} von Schüler {student}?"}
+
+        with self.lock:
+            self.active_streams += 1
+            self.max_active_streams = max(self.max_active_streams, self.active_streams)
+
+        connection = None
+        try:
+            sent_at = time()
+            sent = perf_counter()
+            connection, response = self.request("POST", "/get_response", headers, body)
+            turn.worker = response.getheader("X-Worker-Id")
+            # NOTE: Time until a worker picked up the request. Client and server share the clock on local runs.
+            if response.getheader("X-Request-Start") is not None:
+                turn.queue_delay = max(0.0, float(response.getheader("X-Request-Start")) - sent_at)
+            if response.status != 200:
+                raise RuntimeError(f"/get_response returned {response.status}")
+
+            received = 0
+            while True:
+                chunk = response.read1(1024)
+                if not chunk:
+                    break
+                if received == 0:
+                    turn.first_token_time = perf_counter() - sent
+                received += len(chunk)
+            if received == 0:
+                raise RuntimeError("Stream closed without any token")
+            turn.finished_time = perf_counter() - sent
+        except Exception as ex:
+            turn.error = str(ex)
+        finally:
+            if connection is not None:
+                connection.close()
+            with self.lock:
+                self.active_streams -= 1
+                self.results.append(turn)
+
+    def run(self):
+        self.start = perf_counter()
+        threads = []
+        for student in range(self.students):
+            thread = threading.Thread(target=self.run_student, args=(student,), daemon=True)
+            thread.start()
+            threads.append(thread)
+            sleep(self.ramp_up / max(self.students, 1))
+        for thread in threads:
+            thread.join()
+        return perf_counter() - self.start
+
+    # ----- Report -------------------------------------------------------------------------------------------------------
+    def report(self, wall_time: float) -> dict:
+        finished = [x for x in self.results if x.error is None]
+        dropped = [x for x in self.results if x.error is not None]
+        queue_delays = [x.queue_delay for x in finished if x.queue_delay is not None]
+
+        # Streams grouped by the amount of students started at that time
+        steps = {}
+        step_size = max(1, self.students // 5)
+        for turn in self.results:
+            started_students = min(
+                self.students, int(turn.started / max(self.ramp_up, 1e-9) * self.students) + 1
+            )
+            step = min(self.students, ((started_students - 1) // step_size + 1) * step_size)
+            steps.setdefault(step, []).append(turn)
+
+        ramp = {}
+        for step, turns in sorted(steps.items()):
+            ok = [x for x in turns if x.error is None]
+            ramp[str(step)] = {
+                "streams": len(turns),
+                "dropped": len(turns) - len(ok),
+                "queue_p95": percentile([x.queue_delay for x in ok if x.queue_delay is not None], 95),
+                "ttft_p95": percentile([x.first_token_time for x in ok], 95),
+            }
+
+        # Share of the wall time every worker spent streaming
+        workers = {}
+        for turn in finished:
+            worker = workers.setdefault(turn.worker or "unknown", {"streams": 0, "busy": 0.0})
+            worker["streams"] += 1
+            worker["busy"] += turn.finished_time
+        for worker in workers.values():
+            worker["saturation"] = worker["busy"] / wall_time
+
+        return {
+            "students": self.students,
+            "wall_time": wall_time,
+            "streams": len(self.results),
+            "dropped_streams": len(dropped),
+            "failed_sessions": self.failed_sessions,
+            "max_active_streams": self.max_active_streams,
+            "throughput": len(finished) / wall_time,
+            "queue_delay": {
+                "p50": percentile(queue_delays, 50),
+                "p95": percentile(queue_delays, 95),
+                "p99": percentile(queue_delays, 99),
+            },
+            "ttft": {
+                "p50": percentile([x.first_token_time for x in finished], 50),
+                "p95": percentile([x.first_token_time for x in finished], 95),
+                "p99": percentile([x.first_token_time for x in finished], 99),
+            },
+            "stream_duration": {
+                "p50": percentile([x.finished_time for x in finished], 50),
+                "p95": percentile([x.finished_time for x in finished], 95),
+            },
+            "ramp": ramp,
+            "workers": workers,
+            "errors": sorted(set(x.error for x in dropped)),
+        }
+
+
+def print_report(report: dict):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.0f}ms"
+
+    print(f"Students:            {report['students']}")
+    print(f"Streams:             {report['streams']} ({report['dropped_streams']} dropped, {report['failed_sessions']} failed sessions)")
+    print(f"Max active streams:  {report['max_active_streams']}")
+    print(f"Throughput:          {report['throughput']:.2f} answers/s")
+    print(f"Queue delay:         p50 {ms(report['queue_delay']['p50'])}  p95 {ms(report['queue_delay']['p95'])}  p99 {ms(report['queue_delay']['p99'])}")
+    print(f"Time to first token: p50 {ms(report['ttft']['p50'])}  p95 {ms(report['ttft']['p95'])}  p99 {ms(report['ttft']['p99'])}")
+    print(f"Stream duration:     p50 {ms(report['stream_duration']['p50'])}  p95 {ms(report['stream_duration']['p95'])}")
+
+    print("\nRamp up (students started -> streams, dropped, p95 queue delay, p95 time to first token):")
+    for step, values in report["ramp"].items():
+        print(f"  {step:>5} {values['streams']:>6} {values['dropped']:>6} {ms(values['queue_p95']):>10} {ms(values['ttft_p95']):>10}")
+
+    print("\nWorkers (streams, share of the wall time spent streaming):")
+    for worker, values in sorted(report["workers"].items()):
+        print(f"  {worker:>10} {values['streams']:>6} {values['saturation']:>8.0%}")
+
+    for error in report["errors"]:
+        print(f"Error: {error}")
+
+
+# Starts uWSGI with the worker settings of uwsgi.ini, serving http and running in fake llm mode
+def spawn_server(port: int, processes: int, mongo: str, env: dict):
+    server_env = dict(os.environ)
+    for key, value in BENCHMARK_ENV.items():
+        server_env.setdefault(key, value)
+    server_env.update(env)
+    server_env["MONGODB_CONNECTION"] = mongo
+    server_env["FAKE_LLM"] = "1"
+
+    process = subprocess.Popen(
+        [
+            "uwsgi",
+            "--master",
+            "--processes", str(processes),
+            "--enable-threads",
+            "--die-on-term",
+            "--http-socket", f":{port}",
+            "--wsgi-file", os.path.join(REPO_DIR, "uwsgi.py"),
+            "--chdir", REPO_DIR,
+        ],
+        env=server_env,
+    )
+
+    for _ in range(100):
+        try:
+            connection = http.client.HTTPConnection("localhost", port, timeout=1)
+            connection.request("GET", "/")
+            connection.getresponse().read()
+            connection.close()
+            return process
+        except OSError:
+            sleep(0.2)
+    process.terminate()
+    raise RuntimeError("uWSGI didn't start")
+
+
+def seed_server(mongo: str):
+    from pymongo import MongoClient
+    from .offline_app import seed_database
+
+    client = MongoClient(mongo)
+    client.drop_database(BENCHMARK_ENV["MONGODB_DATABASE"])
+    seed_database(client[BENCHMARK_ENV["MONGODB_DATABASE"]])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates a classroom of streaming students.")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--api-key", default=os.environ.get("API_KEY", BENCHMARK_ENV["API_KEY"]))
+    parser.add_argument("--students", type=int, default=30)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--ramp-up", type=float, default=30.0, help="Seconds until all students are started")
+    parser.add_argument("--think-time", type=float, default=2.0, help="Seconds between two questions of a student")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Socket timeout of a single request")
+    parser.add_argument("--spawn", action="store_true", help="Start a local uWSGI server in fake llm mode")
+    parser.add_argument("--processes", type=int, default=2, help="uWSGI processes of the spawned server")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017", help="mongod of the spawned server")
+    parser.add_argument("--tokens-per-second", type=float, default=30.0)
+    parser.add_argument("--response-tokens", type=int, default=150)
+    args = parser.parse_args()
+
+    process = None
+    if args.spawn:
+        seed_server(args.mongo)
+        process = spawn_server(
+            urlsplit(args.url).port or 5000,
+            args.processes,
+            args.mongo,
+            {
+                "FAKE_LLM_TOKENS_PER_SECOND": str(args.tokens_per_second),
+                "FAKE_LLM_RESPONSE_TOKENS": str(args.response_tokens),
+            },
+        )
+
+    try:
+        classroom = Classroom(
+            args.url, args.api_key, args.students, args.turns, args.ramp_up, args.think_time, args.timeout
+        )
+        report = classroom.report(classroom.run())
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print_report(report)
+    path = save_results("classroom", {"classroom": report}, vars(args))
+    print(f"\nResults stored in '{path}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+from bson.datetime_ms import DatetimeMS
+from datetime import datetime, timedelta
+
+import os
+
+# NOTE: Credentials used by the benchmarks. They are only set if the environment doesn't define them already.
+BENCHMARK_ENV = {
+    "SECRET_KEY": "benchmark-secret",
+    "API_KEY": "benchmark-api-key",
+    "CREF_TOKEN": "benchmark-cref-token",
+    "METRICS_TOKEN": "benchmark-metrics-token",
+    "OPEN_AI_UID": "benchmark",
+    "MASTER_ID": "000000000000000000000000",
+    "MASTER_NAME": "admin",
+    "MASTER_PASS": "admin",
+    "FAKE_LLM": "1",
+    "MONGODB_CONNECTION": "mongodb://localhost:27017",
+    "MONGODB_DATABASE": "Chatbot_Benchmark",
+}
+
+
+def configure_environment(mongo: str, overrides: dict = None):
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+    for key, value in (overrides or {}).items():
+        os.environ[key] = str(value)
+    if mongo != "mongomock":
+        os.environ["MONGODB_CONNECTION"] = mongo
+
+
+# Imports the real flask app. With mongo="mongomock" an in-memory mongodb is used instead of a local mongod.
+def load_app(mongo: str, overrides: dict = None):
+    configure_environment(mongo, overrides)
+
+    if mongo == "mongomock":
+        import mongomock
+        from app import mongodb_connection
+
+        mongodb_connection.MongoClient = mongomock.MongoClient
+    else:
+        from pymongo import MongoClient
+
+        MongoClient(os.environ["MONGODB_CONNECTION"]).drop_database(
+            os.environ["MONGODB_DATABASE"]
+        )
+
+    from app import main
+
+    if mongo == "mongomock":
+        use_plain_datetimes()
+
+    return main
+
+
+# NOTE: mongomock can't compare DatetimeMS values, so the app stores plain datetimes while running against it
+def use_plain_datetimes():
+    import sys
+
+    for name, module in list(sys.modules.items()):
+        if name.startswith("app.") and getattr(module, "DatetimeMS", None) is DatetimeMS:
+            module.DatetimeMS = lambda value: value
+
+
+# Fills the database with an api key, teachers, subjects, live informations and chat histories
+def seed_database(db, teachers: int = 5, subjects: int = 20, informations: int = 200, histories: int = 200):
+    db.OpenAI.insert_one(
+        {
+            "uid": os.environ.get("OPEN_AI_UID", BENCHMARK_ENV["OPEN_AI_UID"]),
+            "api_key": "benchmark-openai-key",
+            "active": True,
+        }
+    )
+
+    teacher_ids = db.User.insert_many(
+        [
+            {"username": f"teacher_{idx}", "password": "secret", "is_admin": False}
+            for idx in range(teachers)
+        ]
+    ).inserted_ids
+
+    subject_ids = db.Subject.insert_many(
+        [
+            {
+                "course": f"Kurs {idx % 4}",
+                "subject": f"Fach {idx}",
+                "teacher_id": teacher_ids[idx % teachers],
+            }
+            for idx in range(subjects)
+        ]
+    ).inserted_ids
+
+    info_ids = db.Information.insert_many(
+        [
+            {
+                "headline": f"Thema {idx}",
+                "content": f"Informationen zu Thema {idx}: Luftschiffe fahren mit Gas {idx}. " * 5,
+                "source": f"Buch {idx}",
+                "subject_id": subject_ids[idx % subjects],
+                "tag": "Current-Live",
+            }
+            for idx in range(informations)
+        ]
+    ).inserted_ids
+
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    db.Chat_History.insert_many(
+        [
+            {
+                "start_message": "Moin! Ich bin Hugo Eckener.",
+                "description": f"Gespräch {idx}",
+                "date": today - timedelta(days=idx % 30),
+                "subjects": [subject_ids[idx % subjects]],
+                "messages": [
+                    {
+                        "message": f"Frage {turn}",
+                        "response": f"Antwort {turn}",
+                        "tag": "neutral",
+                        "source_ids": [str(info_ids[(idx + turn) % informations])],
+                    }
+                    for turn in range(10)
+                ],
+            }
+            for idx in range(histories)
+        ]
+    )
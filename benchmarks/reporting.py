@@ -0,0 +1,110 @@
+from datetime import datetime
+from typing import Dict, List
+
+import subprocess
+import platform
+import json
+import os
+
+RESULTS_DIR: str = os.path.join(os.path.dirname(__file__), "results")
+
+
+def percentile(values: List[float], pct: float) -> float | None:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, round(pct / 100 * len(values) + 0.5) - 1))
+    return values[idx]
+
+
+def summarize(latencies: List[float], ttfts: List[float], errors: int, wall_time: float) -> dict:
+    result = {
+        "count": len(latencies),
+        "errors": errors,
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "throughput": len(latencies) / wall_time if wall_time > 0 else None,
+    }
+    if ttfts:
+        result["ttft_p50"] = percentile(ttfts, 50)
+        result["ttft_p95"] = percentile(ttfts, 95)
+        result["ttft_p99"] = percentile(ttfts, 99)
+    return result
+
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(name: str, results: Dict[str, dict], settings: dict) -> str:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    commit = get_git_commit()
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(RESULTS_DIR, f"{name}-{timestamp}-{commit or 'nogit'}.json")
+    data = {
+        "meta": {
+            "name": name,
+            "timestamp": timestamp,
+            "commit": commit,
+            "python": platform.python_version(),
+            "settings": settings,
+        },
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(data, file, indent=2)
+    return path
+
+
+def format_value(value) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value * 1000:.1f}ms" if value < 100 else f"{value:.1f}"
+    return str(value)
+
+
+def print_results(results: Dict[str, dict]):
+    columns = ["count", "errors", "p50", "p95", "p99", "ttft_p50", "ttft_p95", "throughput"]
+    print(f"{'scenario':<28}" + "".join(f"{x:>12}" for x in columns))
+    for scenario, result in results.items():
+        values = []
+        for column in columns:
+            value = result.get(column)
+            if column == "throughput" and value is not None:
+                values.append(f"{value:.1f}/s")
+            else:
+                values.append(format_value(value))
+        print(f"{scenario:<28}" + "".join(f"{x:>12}" for x in values))
+
+
+# Compares the latencies with a stored run. Returns the scenarios which got slower than the threshold.
+def compare_results(results: Dict[str, dict], baseline_path: str, threshold: float) -> List[str]:
+    with open(baseline_path, "r", encoding="utf-8") as file:
+        baseline = json.load(file)["results"]
+
+    regressions = []
+    print(f"\nCompared with '{baseline_path}':")
+    for scenario, result in results.items():
+        if scenario not in baseline:
+            continue
+        for key in ["p50", "p95", "p99", "ttft_p95"]:
+            old, new = baseline[scenario].get(key), result.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            marker = ""
+            if change > threshold:
+                marker = "  <-- regression"
+                regressions.append(f"{scenario}.{key}")
+            print(
+                f"  {scenario:<26} {key:<9} {format_value(old):>10} -> {format_value(new):>10} ({change:+.0%}){marker}"
+            )
+    return regressions
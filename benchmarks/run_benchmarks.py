@@ -0,0 +1,221 @@
+# Offline benchmark suite of the flask app. OpenAI and Weaviate are replaced by the fakes of app/fake_llm.py.
+#
+# Usage (from the repository root):
+#   python -m benchmarks.run_benchmarks --mongo mongomock
+#   python -m benchmarks.run_benchmarks --mongo mongodb://localhost:27017 --compare benchmarks/results/<run>.json
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+from typing import Callable, List, Tuple
+
+import argparse
+import sys
+
+from .offline_app import load_app, seed_database
+from .reporting import compare_results, print_results, save_results, summarize
+
+
+class Benchmark:
+    def __init__(self, main, iterations: int, concurrency: int):
+        self.main = main
+        self.app = main.app
+        self.iterations = iterations
+        self.concurrency = concurrency
+
+    # Runs the request function with the given concurrency. It returns the latency and the time to first token.
+    def run(self, request: Callable[[object, int], Tuple[float, float | None]], setup: Callable = None):
+        latencies: List[float] = []
+        ttfts: List[float] = []
+        errors = 0
+
+        clients = [self.app.test_client() for _ in range(self.concurrency)]
+        if setup is not None:
+            for client in clients:
+                setup(client)
+
+        def _worker(idx: int):
+            return request(clients[idx % self.concurrency], idx)
+
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for result in executor.map(self._safe(_worker), range(self.iterations)):
+                if result is None:
+                    errors += 1
+                    continue
+                latencies.append(result[0])
+                if result[1] is not None:
+                    ttfts.append(result[1])
+        wall_time = perf_counter() - start
+
+        return summarize(latencies, ttfts, errors, wall_time)
+
+    def _safe(self, function: Callable):
+        def _call(idx: int):
+            try:
+                return function(idx)
+            except Exception as ex:
+                print(f"Request failed: {ex}", file=sys.stderr)
+                return None
+
+        return _call
+
+    # ----- Helpers ------------------------------------------------------------------------------------------------------
+    def timed(self, send: Callable, expected_status: int = 200):
+        start = perf_counter()
+        response = send()
+        latency = perf_counter() - start
+        if response.status_code != expected_status:
+            raise RuntimeError(f"Unexpected status {response.status_code}: {response.data[:200]}")
+        return latency, None
+
+    def timed_stream(self, send: Callable):
+        start = perf_counter()
+        response = send()
+        ttft = None
+        try:
+            if response.status_code != 200:
+                raise RuntimeError(f"Unexpected status {response.status_code}")
+            for chunk in response.response:
+                if ttft is None and len(chunk) > 0:
+                    ttft = perf_counter() - start
+        finally:
+            response.close()
+        return perf_counter() - start, ttft
+
+    def get_bearer_token(self, client) -> str:
+        response = client.get("/get_token", headers={"API-KEY": self.app.config["API-KEY"]})
+        return response.json["token"]
+
+    def login(self, client):
+        client.post(
+            "/admin/login/",
+            data={
+                "login": self.app.config["MASTER_NAME"],
+                "password": self.app.config["MASTER_PASS"],
+            },
+        )
+
+    # ----- Scenarios ----------------------------------------------------------------------------------------------------
+    def get_token(self):
+        headers = {"API-KEY": self.app.config["API-KEY"]}
+        return self.run(lambda client, idx: self.timed(lambda: client.get("/get_token", headers=headers)))
+
+    def start_session(self, client_token: str):
+        headers = {"BEARER-TOKEN": client_token}
+        return self.run(
+            lambda client, idx: self.timed(lambda: client.post("/start_session", headers=headers))
+        )
+
+    def get_response(self, client_token: str, history_ids: List[str]):
+        headers = {"BEARER-TOKEN": client_token}
+
+        def _request(client, idx: int):
+            data = {
+                "history_id": history_ids[idx % len(history_ids)],
+                "message": f"Wie fahren Luftschiffe mit Gas {idx % 10}?",
+            }
+            return self.timed_stream(
+                lambda: client.post("/get_response", json=data, headers=headers, buffered=False)
+            )
+
+        return self.run(_request)
+
+    # Measures the whole background job, from starting it until the status reports it as finished
+    def update_vector_store(self):
+        headers = {"CREF_TOKEN": self.app.config["CREF_TOKEN"]}
+
+        def _request(client, idx: int):
+            start = perf_counter()
+            response = client.post("/update_vector_store", headers=headers)
+            if response.status_code != 202:
+                raise RuntimeError(f"Unexpected status {response.status_code}: {response.data[:200]}")
+
+            job_id = response.json["job_id"]
+            while True:
+                job = client.get(f"/vector_store_job/{job_id}", headers=headers).json
+                if job["phase"] == "failed":
+                    raise RuntimeError(job["msg"])
+                if job["phase"] == "done":
+                    return perf_counter() - start, None
+                sleep(0.01)
+
+        return self.run(_request)
+
+    def admin_list(self, url: str):
+        return self.run(
+            lambda client, idx: self.timed(lambda: client.get(url)),
+            setup=self.login,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the chatbot backend.")
+    parser.add_argument("--mongo", default="mongomock", help="'mongomock' or the uri of a local mongod")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--first-token-latency", type=float, default=0.2)
+    parser.add_argument("--response-tokens", type=int, default=40)
+    parser.add_argument("--embedding-latency", type=float, default=0.02)
+    parser.add_argument("--informations", type=int, default=200)
+    parser.add_argument("--histories", type=int, default=200)
+    parser.add_argument("--scenarios", nargs="*", help="Only run the given scenarios")
+    parser.add_argument("--compare", help="Result file of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown before a regression is reported")
+    args = parser.parse_args()
+
+    main_module = load_app(
+        args.mongo,
+        {
+            "FAKE_LLM_TOKENS_PER_SECOND": args.tokens_per_second,
+            "FAKE_LLM_FIRST_TOKEN_LATENCY": args.first_token_latency,
+            "FAKE_LLM_RESPONSE_TOKENS": args.response_tokens,
+            "FAKE_EMBEDDING_LATENCY": args.embedding_latency,
+        },
+    )
+    seed_database(
+        main_module.MongoDBConnection.db,
+        informations=args.informations,
+        histories=args.histories,
+    )
+
+    benchmark = Benchmark(main_module, args.iterations, args.concurrency)
+    client = main_module.app.test_client()
+    token = benchmark.get_bearer_token(client)
+
+    # Sessions the get_response scenario chats in
+    history_ids = [
+        client.post("/start_session", headers={"BEARER-TOKEN": token}).json["history_id"]
+        for _ in range(args.concurrency)
+    ]
+
+    scenarios = {
+        "update_vector_store": benchmark.update_vector_store,
+        "get_token": benchmark.get_token,
+        "start_session": lambda: benchmark.start_session(token),
+        "get_response": lambda: benchmark.get_response(token, history_ids),
+        "admin_chat_history": lambda: benchmark.admin_list("/admin/chat_historyview/"),
+        "admin_information": lambda: benchmark.admin_list("/admin/informationview/"),
+        "admin_subject": lambda: benchmark.admin_list("/admin/subjectview/"),
+        "admin_exception": lambda: benchmark.admin_list("/admin/exceptionview/"),
+    }
+
+    results = {}
+    for name, scenario in scenarios.items():
+        if args.scenarios and name not in args.scenarios:
+            continue
+        print(f"Running '{name}' ...", file=sys.stderr)
+        results[name] = scenario()
+
+    print_results(results)
+    path = save_results("benchmark", results, vars(args))
+    print(f"\nResults stored in '{path}'")
+
+    if args.compare:
+        regressions = compare_results(results, args.compare, args.threshold)
+        if regressions:
+            print(f"\nRegressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+# Micro-benchmark of the data containers. Compares the former __dict__ containers (converted with vars() and
+# json.dumps(default=lambda o: o.__dict__)) with the slotted records of mongodb_connection and fast_json.
+#
+# Usage (from the repository root):
+#   python -m benchmarks.serialization
+#   python -m benchmarks.serialization --messages 2000 --runs 50 --compare benchmarks/results/<run>.json
+from bson.datetime_ms import DatetimeMS
+from bson.objectid import ObjectId
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+from time import perf_counter
+
+import tracemalloc
+import argparse
+import json
+import sys
+
+from app.mongodb_connection import ChatHistory, ChatMessage
+from app import fast_json
+
+from .reporting import compare_results, print_results, save_results, summarize
+
+
+# ----- Former Containers ------------------------------------------------------------------------------------------------
+class LegacyChatMessage:
+    def __init__(self, message: str, response: str, tag: str, source_ids: List[str]):
+        self.message = message
+        self.response = response
+        self.tag = tag
+        self.source_ids = source_ids
+
+
+class LegacyChatHistory:
+    def __init__(self, start_message, description, date, subjects, messages):
+        self.start_message = start_message
+        self.description = description
+        self.date = date
+        self.subjects = subjects
+        self.messages = messages
+        self.version = 0
+
+
+def legacy_to_bson(history: LegacyChatHistory) -> dict:
+    document = dict(vars(history))
+    document["messages"] = [vars(message) for message in history.messages]
+    return document
+
+
+def legacy_to_json(history: LegacyChatHistory) -> bytes:
+    return json.dumps(history, default=lambda o: o.__dict__ if hasattr(o, "__dict__") else str(o)).encode("utf-8")
+
+
+# ----- Scenarios --------------------------------------------------------------------------------------------------------
+# NOTE: The contents are created once, so building a history only measures the containers themselves
+MESSAGE: str = "Wann wurde das Zeppelin Museum eröffnet?"
+RESPONSE: str = "Das Zeppelin Museum wurde 1996 im ehemaligen Hafenbahnhof eröffnet. " * 4
+SOURCE_IDS: List[List[str]] = [[str(ObjectId()) for _ in range(3)] for _ in range(64)]
+
+
+def build(message_class, history_class, messages: int):
+    items = [
+        message_class(MESSAGE, RESPONSE, "Not Tagged", SOURCE_IDS[idx % len(SOURCE_IDS)]) for idx in range(messages)
+    ]
+    return history_class("Hallo, ich bin Hugo Eckener!", "Zeppelin", DatetimeMS(datetime.now()), [ObjectId()], items)
+
+
+def measure_time(function: Callable, runs: int) -> List[float]:
+    durations = []
+    for _ in range(runs):
+        start = perf_counter()
+        function()
+        durations.append(perf_counter() - start)
+    return durations
+
+
+# Returns the peak memory (bytes) and the amount of memory blocks still allocated by the result of the function
+def measure_memory(function: Callable) -> Tuple[int, int]:
+    tracemalloc.start()
+    try:
+        result = function()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+    del result
+    return peak, blocks
+
+
+def get_scenarios(messages: int) -> Dict[str, Callable]:
+    legacy = build(LegacyChatMessage, LegacyChatHistory, messages)
+    records = build(ChatMessage, ChatHistory, messages)
+    return {
+        "legacy.build": lambda: build(LegacyChatMessage, LegacyChatHistory, messages),
+        "records.build": lambda: build(ChatMessage, ChatHistory, messages),
+        "legacy.to_bson": lambda: legacy_to_bson(legacy),
+        "records.to_bson": lambda: records.to_bson(),
+        "legacy.to_json": lambda: legacy_to_json(legacy),
+        "records.to_json": lambda: fast_json.dumps(records),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the data containers.")
+    parser.add_argument("--messages", type=int, default=1000, help="Amount of messages of the history")
+    parser.add_argument("--runs", type=int, default=30)
+    parser.add_argument("--compare", help="Result file of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown before a regression is reported")
+    args = parser.parse_args()
+
+    results = {}
+    for name, function in get_scenarios(args.messages).items():
+        durations = measure_time(function, args.runs)
+        peak, blocks = measure_memory(function)
+        results[name] = dict(summarize(durations, [], 0, sum(durations)), peak_memory=peak, memory_blocks=blocks)
+
+    print(f"JSON encoder: {'orjson' if fast_json.orjson is not None else 'json'}\n")
+    print_results(results)
+    print(f"\n{'scenario':<28}{'peak memory':>14}{'blocks':>12}")
+    for name, result in results.items():
+        print(f"{name:<28}{result['peak_memory'] / 1024:>12.1f}kB{result['memory_blocks']:>12}")
+
+    path = save_results("serialization", results, vars(args))
+    print(f"\nResults stored in '{path}'")
+
+    if args.compare:
+        regressions = compare_results(results, args.compare, args.threshold)
+        if regressions:
+            print(f"\nRegressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+from pymongo.errors import AutoReconnect
+
+import threading
+import mongomock
+import pytest
+
+from app.background_writer import BackgroundWriter, merge_updates
+
+
+# The writer thread is paused (flush is replaced), the tests flush on their own
+@pytest.fixture
+def writer(monkeypatch):
+    flush = BackgroundWriter.flush
+    monkeypatch.setattr(BackgroundWriter, "flush", lambda: None)
+    monkeypatch.setattr(BackgroundWriter, "_wakeup", threading.Event())
+    monkeypatch.setattr(BackgroundWriter, "_collections", {})
+    monkeypatch.setattr(BackgroundWriter, "_inserts", {})
+    monkeypatch.setattr(BackgroundWriter, "_upserts", {})
+    monkeypatch.setattr(BackgroundWriter, "_pending", 0)
+    monkeypatch.setattr(BackgroundWriter, "_dropped", {})
+    reports = []
+    monkeypatch.setattr(BackgroundWriter, "report", reports.append)
+    return flush, reports
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.records
+
+
+def test_merge_updates():
+    current = merge_updates(
+        {},
+        {
+            "$setOnInsert": {"first": 1},
+            "$set": {"message": "a"},
+            "$inc": {"count": 1},
+            "$push": {"samples": {"$each": [1, 2], "$slice": -3}},
+            "$max": {"last": 5},
+            "$min": {"first_seen": 5},
+        },
+    )
+    merge_updates(
+        current,
+        {
+            "$setOnInsert": {"first": 2},
+            "$set": {"message": "b"},
+            "$inc": {"count": 2, "other": 1},
+            "$push": {"samples": {"$each": [3, 4], "$slice": -3}},
+            "$max": {"last": 3},
+            "$min": {"first_seen": 3},
+        },
+    )
+    assert current == {
+        "$setOnInsert": {"first": 1},
+        "$set": {"message": "b"},
+        "$inc": {"count": 3, "other": 1},
+        "$push": {"samples": {"$each": [2, 3, 4], "$slice": -3}},
+        "$max": {"last": 5},
+        "$min": {"first_seen": 3},
+    }
+
+
+def test_upserts_of_one_document_are_merged(writer, collection):
+    flush, _ = writer
+    for _ in range(3):
+        BackgroundWriter.upsert(collection, {"_id": "a"}, {"$inc": {"count": 1}})
+    assert BackgroundWriter._pending == 1
+
+    flush()
+    assert collection.find_one({"_id": "a"})["count"] == 3
+
+
+def test_records_above_max_pending_are_dropped_and_reported(writer, collection, monkeypatch):
+    flush, reports = writer
+    monkeypatch.setattr(BackgroundWriter, "MAX_PENDING", 2)
+
+    assert [BackgroundWriter.insert(collection, {"idx": idx}) for idx in range(3)] == [True, True, False]
+    assert BackgroundWriter.upsert(collection, {"_id": "a"}, {"$inc": {"count": 1}}) is False
+
+    flush()
+    assert collection.count_documents({}) == 2
+    assert reports == ["Background writer lost records: '2' full (db.records)."]
+
+
+def test_reaching_the_batch_size_wakes_the_writer(writer, collection, monkeypatch):
+    monkeypatch.setattr(BackgroundWriter, "BATCH_SIZE", 3)
+
+    BackgroundWriter.insert(collection, {"idx": 0})
+    BackgroundWriter.upsert(collection, {"_id": "a"}, {"$inc": {"count": 1}})
+    assert not BackgroundWriter._wakeup.is_set()
+
+    BackgroundWriter.insert(collection, {"idx": 1})
+    assert BackgroundWriter._wakeup.is_set()
+
+
+def test_failed_writes_are_retried_with_the_next_flush(writer, collection, monkeypatch):
+    flush, reports = writer
+    insert_many, bulk_write = collection.insert_many, collection.bulk_write
+
+    def fail(*args, **kwargs):
+        raise AutoReconnect("connection lost")
+
+    monkeypatch.setattr(collection, "insert_many", fail)
+    monkeypatch.setattr(collection, "bulk_write", fail)
+    BackgroundWriter.insert(collection, {"_id": 1})
+    BackgroundWriter.upsert(collection, {"_id": "a"}, {"$inc": {"count": 1}})
+    flush()
+    assert collection.count_documents({}) == 0
+
+    # NOTE: A newer upsert of the same document is merged into the retried one
+    BackgroundWriter.upsert(collection, {"_id": "a"}, {"$inc": {"count": 2}})
+    monkeypatch.setattr(collection, "insert_many", insert_many)
+    monkeypatch.setattr(collection, "bulk_write", bulk_write)
+    flush()
+    assert collection.find_one({"_id": 1}) is not None
+    assert collection.find_one({"_id": "a"})["count"] == 3
+    assert reports == []
+
+
+# NOTE: Documents rejected by mongodb would fail again, the rest of the batch is still written
+def test_rejected_documents_are_reported(writer, collection):
+    flush, reports = writer
+    collection.insert_one({"_id": 1})
+
+    BackgroundWriter.insert(collection, {"_id": 1})
+    BackgroundWriter.insert(collection, {"_id": 2})
+    flush()
+    assert collection.count_documents({}) == 2
+    assert reports == ["Background writer lost records: '1' failed (db.records)."]
+    assert BackgroundWriter._pending == 0
@@ -0,0 +1,84 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+
+import threading
+import json
+
+import openai
+import pytest
+
+from app.openai_key_pool import OpenAIKeyPool
+from app.streaming_handler import StreamingHandler
+
+TOKENS = 200
+
+
+# Streams TOKENS chunks like the chat completions of OpenAI and records how many were sent before the client left
+class StreamServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StreamRequestHandler)
+        self.sent = 0
+        self.disconnected = threading.Event()
+
+
+class StreamRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        try:
+            for idx in range(TOKENS):
+                chunk = {"choices": [{"delta": {"content": f"{idx} "}, "index": 0, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                self.server.sent += 1
+                threading.Event().wait(0.01)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.disconnected.set()
+
+    def log_message(self, *args):
+        pass
+
+
+class CancellingHandler(StreamingHandler):
+    def __init__(self, tokens: int):
+        super().__init__(Queue())
+        self.tokens = tokens
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        super().on_llm_new_token(token, **kwargs)
+        self.tokens -= 1
+        if self.tokens == 0:
+            self.cancel()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = StreamServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(openai, "api_base", f"http://127.0.0.1:{server.server_port}/v1")
+    monkeypatch.setattr(openai, "api_key", "sk-test")
+    monkeypatch.setattr(openai, "requestssession", OpenAIKeyPool.create_session)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_cancelled_stream_drops_the_connection(server):
+    from langchain.schema import HumanMessage
+    from app.cancellable_llm import CancellableChatOpenAI
+
+    llm = CancellableChatOpenAI(
+        openai_api_key="sk-test", openai_api_base=openai.api_base, streaming=True, max_retries=1
+    )
+    result = llm.generate([[HumanMessage(content="Frage")]], callbacks=[CancellingHandler(3)])
+
+    assert result.generations[0][0].text == "0 1 2 "
+    assert result.llm_output["cancelled"]
+    assert server.disconnected.wait(timeout=2)
+    assert server.sent < TOKENS
+    assert OpenAIKeyPool.take_stream_response() is None
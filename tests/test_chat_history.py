@@ -0,0 +1,38 @@
+from bson.objectid import ObjectId
+
+import pytest
+
+from benchmarks.offline_app import load_app
+
+
+@pytest.fixture(scope="module")
+def connection():
+    return load_app("mongomock", {"FAKE_LLM_FIRST_TOKEN_LATENCY": 0, "FAKE_EMBEDDING_LATENCY": 0}).MongoDBConnection
+
+
+# Two turns of the same chat overlap: the second question is added before the answer of the first one is stored
+def test_overlapping_turns_keep_their_answers(connection):
+    history_id = str(connection.create_chat_history("Moin!"))
+
+    first_idx = connection.add_chat_history_message(history_id, "Frage 0", "", connection.NEUTRAL_MSG_TAG, [])
+    second_idx = connection.add_chat_history_message(history_id, "Frage 1", "", connection.NEUTRAL_MSG_TAG, [])
+    assert (first_idx, second_idx) == (0, 1)
+
+    connection.update_chat_history(history_id, second_idx, None, [], "Antwort 1", ["b"])
+    connection.update_chat_history(history_id, first_idx, "Zeppelin", [], "Antwort 0", ["a"])
+
+    history = connection.chat_history.find_one({"_id": ObjectId(history_id)})
+    assert [(x["message"], x["response"], x["source_ids"]) for x in history["messages"]] == [
+        ("Frage 0", "Antwort 0", ["a"]),
+        ("Frage 1", "Antwort 1", ["b"]),
+    ]
+    assert connection.get_session(history_id).messages == history["messages"]
+
+
+def test_last_messages_end_before_the_turn(connection):
+    history_id = str(connection.create_chat_history("Moin!"))
+    for idx in range(3):
+        connection.add_chat_history_message(history_id, f"Frage {idx}", "", connection.NEUTRAL_MSG_TAG, [])
+
+    messages = connection.get_last_messages(history_id, 5, before_idx=1)
+    assert [x["message"] for x in messages] == ["Frage 0"]
@@ -0,0 +1,78 @@
+from bson.objectid import ObjectId
+from datetime import datetime
+
+import csv
+import gzip
+import io
+import json
+
+import pytest
+
+from benchmarks.offline_app import load_app
+
+HEADERS = {"CREF_TOKEN": "benchmark-cref-token"}
+
+
+@pytest.fixture(scope="module")
+def app_module():
+    return load_app("mongomock", {"FAKE_EMBEDDING_LATENCY": 0})
+
+
+@pytest.fixture(scope="module")
+def subject_id(app_module):
+    subject_id = ObjectId()
+    other_subject_id = ObjectId()
+    app_module.MongoDBConnection.chat_history.insert_many(
+        [
+            {
+                "date": datetime(2023, 9, day, 12),
+                "description": f"Chat {day}",
+                "subjects": [subject_id] if day < 30 else [other_subject_id],
+                "start_message": "Moin!",
+                "messages": [{"message": "Frage", "response": "Antwort", "tag": tag}],
+            }
+            for day, tag in [(1, "Positive"), (15, "Negative"), (29, "Positive"), (30, "Positive")]
+        ]
+    )
+    return str(subject_id)
+
+
+def export(app_module, **args):
+    return app_module.app.test_client().get("/export_chat_histories", query_string=args, headers=HEADERS)
+
+
+def test_filters_select_the_histories(app_module, subject_id):
+    def descriptions(**args):
+        response = export(app_module, subject=subject_id, **args)
+        assert response.status_code == 200
+        return [json.loads(line)["description"] for line in response.data.splitlines()]
+
+    assert descriptions() == ["Chat 1", "Chat 15", "Chat 29"]
+    assert descriptions(**{"from": "2023-09-15", "to": "2023-09-29"}) == ["Chat 15", "Chat 29"]
+    # NOTE: A date without a time includes the whole day, a date with a time ends at that time
+    assert descriptions(to="2023-09-15") == ["Chat 1", "Chat 15"]
+    assert descriptions(to="2023-09-15T11:00:00") == ["Chat 1"]
+    assert descriptions(tag="Negative") == ["Chat 15"]
+
+
+def test_fields_are_projected(app_module, subject_id):
+    response = export(app_module, subject=subject_id, tag="Negative", fields="messages, description")
+    assert [json.loads(line) for line in response.data.splitlines()] == [
+        {"description": "Chat 15", "messages": [{"message": "Frage", "response": "Antwort", "tag": "Negative"}]}
+    ]
+
+    response = export(app_module, subject=subject_id, format="csv", fields="_id,date,messages")
+    assert response.mimetype == "application/gzip"
+    rows = list(csv.reader(io.StringIO(gzip.decompress(response.data).decode("utf-8"))))
+    assert rows[0] == ["_id", "date", "messages"]
+    assert [row[1] for row in rows[1:]] == ["2023-09-01T12:00:00", "2023-09-15T12:00:00", "2023-09-29T12:00:00"]
+    assert ObjectId.is_valid(rows[1][0])
+    assert json.loads(rows[2][2])[0]["tag"] == "Negative"
+
+
+@pytest.mark.parametrize(
+    "args",
+    [{"format": "xml"}, {"fields": "date,password"}, {"subject": "1234"}, {"from": "gestern"}],
+)
+def test_bad_arguments_are_rejected(app_module, args):
+    assert export(app_module, **args).status_code == 400
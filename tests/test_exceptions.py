@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+import traceback
+import pytest
+
+from benchmarks.offline_app import load_app
+
+
+@pytest.fixture(scope="module")
+def connection():
+    return load_app("mongomock").MongoDBConnection
+
+
+def fail():
+    raise ValueError("Kaputt")
+
+
+def catch() -> BaseException:
+    try:
+        fail()
+    except ValueError as ex:
+        return ex
+
+
+# Documents of the former add_exception are folded into the group of the same failure
+def test_legacy_exceptions_join_their_group(connection):
+    from app.background_writer import BackgroundWriter
+
+    connection.exception.delete_many({})
+    ex = catch()
+    connection.add_exception("get_response", ex)
+    BackgroundWriter.flush()
+
+    text = "".join(traceback.format_exception(ex))
+    old = datetime.now().replace(microsecond=0) - timedelta(days=3)
+    connection.exception.insert_many(
+        [
+            {"endpoint": "get_response", "time": old, "exception": text},
+            {"endpoint": "get_response", "time": old + timedelta(days=1), "exception": text},
+            {
+                "endpoint": "update_vector_store",
+                "time": old,
+                "exception": "Traceback (most recent call last):\nKeyError: 'x'",
+            },
+        ]
+    )
+
+    assert connection.group_legacy_exceptions() == 3
+    assert connection.group_legacy_exceptions() == 0
+
+    groups = dict((x["endpoint"], x) for x in connection.exception.find())
+    assert len(groups) == 2
+    group = groups["get_response"]
+    assert (group["count"], group["exception_type"], group["first_seen"]) == (3, "ValueError", old)
+    assert [x["time"] for x in group["samples"]][:2] == [old, old + timedelta(days=1)]
+
+    other = groups["update_vector_store"]
+    assert (other["count"], other["exception_type"], other["message"]) == (1, "KeyError", "'x'")
@@ -0,0 +1,100 @@
+from bson.objectid import ObjectId
+
+import pytest
+
+from benchmarks.offline_app import load_app
+
+
+@pytest.fixture(scope="module")
+def app_module():
+    return load_app("mongomock", {"FAKE_LLM_FIRST_TOKEN_LATENCY": 0, "FAKE_EMBEDDING_LATENCY": 0})
+
+
+@pytest.fixture(scope="module")
+def connection(app_module):
+    return app_module.MongoDBConnection
+
+
+@pytest.fixture(scope="module")
+def history_id(connection):
+    history_id = connection.create_chat_history("Moin!")
+    messages = [{"message": f"Frage {idx}", "response": f"Antwort {idx}", "tag": "neutral"} for idx in range(10)]
+    connection.chat_history.update_one({"_id": history_id}, {"$push": {"messages": {"$each": messages}}})
+    return str(history_id)
+
+
+@pytest.fixture(scope="module")
+def headers(app_module):
+    client = app_module.app.test_client()
+    token = client.get("/get_token", headers={"API-KEY": "benchmark-api-key"}).json["token"]
+    return {"BEARER-TOKEN": token}
+
+
+def page(connection, history_id, **args):
+    result = connection.get_chat_history(history_id, **args)
+    return [int(x["message"].split()[1]) for x in result["messages"]], result["start_idx"], result["total"]
+
+
+@pytest.mark.parametrize(
+    "args, expected",
+    [
+        ({"limit": 3}, ([7, 8, 9], 7, 10)),
+        ({"before_idx": 7, "limit": 3}, ([4, 5, 6], 4, 10)),
+        ({"before_idx": 2, "limit": 3}, ([0, 1], 0, 10)),
+        ({"before_idx": 0}, ([], 0, 10)),
+        ({"before_idx": 50, "limit": 2}, ([8, 9], 8, 10)),
+        ({"since": 8}, ([8, 9], 8, 10)),
+        ({"since": 0, "limit": 4}, ([0, 1, 2, 3], 0, 10)),
+        ({"since": 20}, ([], 10, 10)),
+    ],
+)
+def test_pages_slice_the_messages(connection, history_id, args, expected):
+    assert page(connection, history_id, **args) == expected
+
+
+def test_page_size_is_capped(connection, history_id, monkeypatch):
+    monkeypatch.setattr(connection, "MAX_HISTORY_PAGE_SIZE", 4)
+    assert page(connection, history_id, limit=100) == ([6, 7, 8, 9], 6, 10)
+
+
+def test_without_page_arguments_all_messages_are_returned(app_module, history_id, headers):
+    response = app_module.app.test_client().post("/start_session", json={"history_id": history_id}, headers=headers)
+    assert response.status_code == 200
+    assert response.json["start_message"] == "Moin!"
+    assert len(response.json["messages"]) == 10
+    assert "start_idx" not in response.json
+
+
+def test_page_is_returned_by_the_route(app_module, history_id, headers):
+    response = app_module.app.test_client().post(
+        "/start_session", json={"history_id": history_id, "before_idx": 5, "limit": 2}, headers=headers
+    )
+    assert response.status_code == 200
+    assert (response.json["start_idx"], response.json["total"]) == (3, 10)
+    assert response.json["messages"] == [
+        {"message": "Frage 3", "response": "Antwort 3"},
+        {"message": "Frage 4", "response": "Antwort 4"},
+    ]
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        {"limit": 0},
+        {"limit": True},
+        {"since": -1},
+        {"before_idx": "3"},
+        {"before_idx": 1.5},
+        {"before_idx": 1, "since": 1},
+    ],
+)
+def test_bad_page_arguments_are_rejected(app_module, history_id, headers, args):
+    response = app_module.app.test_client().post(
+        "/start_session", json={"history_id": history_id, **args}, headers=headers
+    )
+    assert response.status_code == 400
+
+
+def test_missing_history_raises(connection):
+    with pytest.raises(LookupError):
+        connection.get_chat_history(str(ObjectId()), limit=3)
@@ -0,0 +1,41 @@
+from bson.objectid import ObjectId
+
+import pytest
+
+from benchmarks.offline_app import load_app
+
+
+@pytest.fixture(scope="module")
+def connection():
+    return load_app("mongomock").MongoDBConnection
+
+
+def test_headlines_are_cached_until_invalidated(connection, monkeypatch):
+    from app.information_headlines import InformationHeadlines
+
+    info_id = str(connection.information.insert_one({"headline": "Luftschiffe"}).inserted_id)
+    missing_id = str(ObjectId())
+    InformationHeadlines.invalidate()
+
+    assert InformationHeadlines.get([info_id, missing_id, info_id, "invalid"]) == {info_id: "Luftschiffe"}
+
+    lookups = []
+    original = connection.get_information_headlines
+    monkeypatch.setattr(connection, "get_information_headlines", lambda ids: lookups.append(ids) or original(ids))
+
+    connection.information.update_one({"_id": ObjectId(info_id)}, {"$set": {"headline": "Zeppeline"}})
+    assert InformationHeadlines.get([info_id, missing_id]) == {info_id: "Luftschiffe"}
+    assert lookups == []
+
+    InformationHeadlines.invalidate([info_id])
+    assert InformationHeadlines.get([info_id, missing_id]) == {info_id: "Zeppeline"}
+    assert lookups == [[info_id]]
+
+
+def test_cache_is_bounded(connection, monkeypatch):
+    from app.information_headlines import InformationHeadlines
+
+    InformationHeadlines.invalidate()
+    monkeypatch.setattr(InformationHeadlines, "MAX_SIZE", 3)
+    InformationHeadlines.get([str(ObjectId()) for _ in range(5)])
+    assert len(InformationHeadlines._entries) == 3
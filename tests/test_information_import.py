@@ -0,0 +1,91 @@
+import io
+import json
+
+from bson.objectid import ObjectId
+
+import pytest
+
+from benchmarks.offline_app import load_app
+
+
+@pytest.fixture(scope="module")
+def connection():
+    return load_app("mongomock", {"FAKE_EMBEDDING_LATENCY": 0}).MongoDBConnection
+
+
+def parse(format, text):
+    from app.information_import import InformationImport
+
+    return list(InformationImport.parse(io.StringIO(text, newline=""), format))
+
+
+def test_jsonl_reports_errors_per_line(connection):
+    text = "\n".join(
+        [
+            json.dumps({"headline": "A", "content": "a", "source": "s"}),
+            "",
+            "not json",
+            "[1, 2]",
+            json.dumps({"headline": "B"}),
+        ]
+    )
+    rows = parse("jsonl", text)
+
+    assert [(number, error is None) for number, _, error in rows] == [(1, True), (3, False), (4, False), (5, True)]
+    assert rows[0][1] == {"headline": "A", "content": "a", "source": "s"}
+    assert rows[1][2].startswith("Invalid JSON")
+    assert rows[2][2] == "Should be a JSON object."
+
+
+def test_csv_rows_keep_their_line_numbers(connection):
+    rows = parse("csv", 'headline,content,source\nA,"multi\nline",src\nB,,src\n')
+
+    assert [(number, data["headline"], data["content"]) for number, data, _ in rows] == [
+        (3, "A", "multi\nline"),
+        (4, "B", ""),
+    ]
+
+
+def test_markdown_sections_need_a_source(connection):
+    text = "intro\n# Luftschiffe\nSource: wiki\n\nZeppelin\nmehr\n## Ohne Quelle\nText\n### Leer\nsource: buch\n"
+    rows = parse("markdown", text)
+
+    assert rows == [
+        (2, {"headline": "Luftschiffe", "source": "wiki", "content": "Zeppelin\nmehr"}, None),
+        (7, None, "Missing 'Source: ...' line after the heading."),
+        (9, {"headline": "Leer", "source": "buch", "content": ""}, None),
+    ]
+
+
+def test_insert_skips_invalid_rows(connection, monkeypatch):
+    from app.admin_classes import InformationForm
+    from app.information_import import InformationImport
+
+    monkeypatch.setattr(InformationImport, "BATCH_SIZE", 2)
+    subject_id = str(ObjectId())
+    other_subject_id = str(ObjectId())
+    rows = [
+        (1, {"headline": "Import 1", "content": "c", "source": "s"}, None),
+        (2, None, "Invalid JSON"),
+        (3, {"headline": "Import 3", "content": "c"}, None),
+        (4, {"headline": "Import 4", "content": "c", "source": "s", "subject_id": other_subject_id}, None),
+        (5, {"headline": "Import 5", "content": "c", "source": "s", "subject_id": "unknown"}, None),
+        (6, {"headline": "Import 6", "content": 6, "source": "s"}, None),
+        (7, {"headline": "Import 7", "content": "c", "source": "s"}, None),
+    ]
+    choices = [(subject_id, "Subject"), (other_subject_id, "Other")]
+    result = InformationImport.insert(iter(rows), InformationForm, choices, subject_id)
+
+    assert (result.rows, result.inserted, result.failed) == (7, 3, 4)
+    assert [(x["row"], list(x["errors"])) for x in result.errors] == [
+        (2, ["row"]),
+        (3, ["source"]),
+        (5, ["subject_id"]),
+        (6, ["content"]),
+    ]
+    documents = connection.information.find({"headline": {"$regex": "^Import "}}, sort=[("headline", 1)])
+    assert [(x["headline"], str(x["subject_id"]), x["tag"]) for x in documents] == [
+        ("Import 1", subject_id, connection.ADD_INFO_TAG),
+        ("Import 4", other_subject_id, connection.ADD_INFO_TAG),
+        ("Import 7", subject_id, connection.ADD_INFO_TAG),
+    ]
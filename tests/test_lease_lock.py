@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+from time import sleep
+
+import pytest
+
+from benchmarks.offline_app import load_app
+
+
+@pytest.fixture(scope="module")
+def connection():
+    return load_app("mongomock", {"FAKE_EMBEDDING_LATENCY": 0}).MongoDBConnection
+
+
+@pytest.fixture
+def lease_lock(connection, request):
+    from app.lease_lock import LeaseLock
+
+    lock = LeaseLock(request.node.name, ttl=0.5, heartbeat_interval=0.05)
+    yield lock
+    connection.lock.delete_one({"_id": lock.name})
+
+
+def expire(connection, lock):
+    connection.lock.update_one({"_id": lock.name}, {"$set": {"expires_at": datetime.now() - timedelta(seconds=1)}})
+
+
+def test_held_lock_is_not_acquired_twice(connection, lease_lock):
+    lease = lease_lock.try_acquire(reason="first")
+    assert lease is not None
+    assert lease_lock.try_acquire() is None
+    assert lease_lock.get_holder()["data"] == {"reason": "first"}
+    with pytest.raises(Exception, match="locked by another update"):
+        lease_lock.acquire(timeout=0.2)
+
+    lease.release()
+    assert lease_lock.get_holder() is None
+    second = lease_lock.try_acquire()
+    assert second is not None
+    second.release()
+
+
+def test_heartbeat_keeps_the_lease(connection, lease_lock):
+    with lease_lock.hold() as lease:
+        sleep(lease_lock.ttl * 2)
+        assert lease_lock.get_holder()["owner"] == lease.owner
+        assert lease_lock.try_acquire() is None
+        lease.check()
+    assert lease_lock.get_holder() is None
+
+
+def test_expired_lease_is_taken_over(connection, lease_lock):
+    lease = lease_lock.try_acquire()
+    # NOTE: Stands in for a worker that was paused longer than the ttl
+    lease.stopped.set()
+    lease.heartbeat.join()
+    expire(connection, lease_lock)
+
+    takeover = lease_lock.try_acquire()
+    assert takeover is not None
+    assert lease_lock.get_holder()["owner"] == takeover.owner
+
+    # The old owner neither extends nor releases the lease of the new one
+    assert lease_lock.extend(lease.owner) is False
+    lease.release()
+    assert lease_lock.get_holder()["owner"] == takeover.owner
+    takeover.release()
+
+
+def test_heartbeat_notices_a_lost_lease(connection, lease_lock):
+    lease = lease_lock.try_acquire()
+    connection.lock.update_one({"_id": lease_lock.name}, {"$set": {"owner": "other-worker"}})
+    lease.heartbeat.join(timeout=1)
+
+    assert lease.lost
+    with pytest.raises(Exception, match="Lost the lock"):
+        lease.check()
+    lease.release()
+    assert lease_lock.get_holder()["owner"] == "other-worker"
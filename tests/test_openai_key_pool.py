@@ -0,0 +1,14 @@
+import openai
+
+from app.openai_key_pool import OpenAIKeyPool
+
+
+def test_sessions_use_the_proxy_of_openai(monkeypatch):
+    monkeypatch.setattr(openai, "proxy", None)
+    assert OpenAIKeyPool.create_session().proxies == {}
+
+    monkeypatch.setattr(openai, "proxy", "http://proxy:3128")
+    assert OpenAIKeyPool.create_session().proxies == {"http": "http://proxy:3128", "https": "http://proxy:3128"}
+
+    monkeypatch.setattr(openai, "proxy", {"https": "http://secure-proxy:3128"})
+    assert OpenAIKeyPool.create_session().proxies == {"https": "http://secure-proxy:3128"}
@@ -0,0 +1,129 @@
+import pytest
+
+from app import resilience
+from app.resilience import CircuitBreaker, Resilience, UpstreamUnavailable
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def breakers(monkeypatch):
+    breakers = {
+        Resilience.OPENAI: CircuitBreaker(Resilience.OPENAI, failure_threshold=2, reset_timeout=30.0),
+        Resilience.WEAVIATE: CircuitBreaker(Resilience.WEAVIATE, failure_threshold=2, reset_timeout=30.0),
+    }
+    monkeypatch.setattr(Resilience, "breakers", breakers)
+    return breakers
+
+
+def fail(ex: BaseException):
+    raise ex
+
+
+def test_breaker_opens_after_the_threshold_and_recovers(clock, breakers):
+    breaker = breakers[Resilience.OPENAI]
+    for _ in range(2):
+        with pytest.raises(TimeoutError):
+            Resilience.call(Resilience.OPENAI, fail, TimeoutError())
+    assert breaker.state == CircuitBreaker.OPEN
+
+    with pytest.raises(UpstreamUnavailable):
+        Resilience.call(Resilience.OPENAI, lambda: "never called")
+
+    # NOTE: After the reset timeout a single trial call is let through
+    clock.now += 30.0
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(UpstreamUnavailable):
+        breaker.before_call()
+    breaker.on_success()
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert Resilience.call(Resilience.OPENAI, lambda: "answer") == "answer"
+
+
+def test_failed_trial_opens_the_breaker_again(clock, breakers):
+    breaker = breakers[Resilience.OPENAI]
+    for _ in range(2):
+        breaker.on_failure()
+
+    clock.now += 30.0
+    with pytest.raises(TimeoutError):
+        Resilience.call(Resilience.OPENAI, fail, TimeoutError())
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.opened_at == clock.now
+
+
+def test_errors_of_the_caller_dont_count_as_failures(clock, breakers):
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            Resilience.call(Resilience.OPENAI, fail, ValueError("bad request"))
+    assert breakers[Resilience.OPENAI].state == CircuitBreaker.CLOSED
+
+
+def test_retries_are_bounded(clock, breakers, monkeypatch):
+    monkeypatch.setattr(Resilience, "ATTEMPTS", 3)
+    monkeypatch.setattr(breakers[Resilience.WEAVIATE], "failure_threshold", 10)
+    sleeps = []
+    monkeypatch.setattr(resilience, "sleep", sleeps.append)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        raise ConnectionError()
+
+    with pytest.raises(ConnectionError):
+        Resilience.call_with_retry(Resilience.WEAVIATE, flaky)
+    assert len(calls) == 3
+    assert len(sleeps) == 2
+    assert all(0 <= x <= min(Resilience.MAX_BACKOFF, Resilience.BACKOFF * 2**idx) for idx, x in enumerate(sleeps))
+
+    calls.clear()
+    with pytest.raises(ValueError):
+        Resilience.call_with_retry(Resilience.WEAVIATE, lambda: calls.append(1) or fail(ValueError()))
+    assert len(calls) == 1
+
+
+def test_open_breaker_isnt_retried(clock, breakers, monkeypatch):
+    monkeypatch.setattr(resilience, "sleep", lambda x: None)
+    for _ in range(2):
+        breakers[Resilience.WEAVIATE].on_failure()
+
+    calls = []
+    with pytest.raises(UpstreamUnavailable):
+        Resilience.call_with_retry(Resilience.WEAVIATE, lambda: calls.append(1))
+    assert calls == []
+
+
+# NOTE: Retrieval embeds the question through OpenAI, its failures must not open the weaviate breaker
+def test_embedding_failures_count_against_openai(clock, breakers, monkeypatch):
+    from app.embedding_cache import VectorRetriever
+
+    monkeypatch.setattr(resilience, "sleep", lambda x: None)
+    monkeypatch.setattr(breakers[Resilience.OPENAI], "failure_threshold", 10)
+
+    class Embeddings:
+        def embed_query(self, text):
+            raise TimeoutError()
+
+    class VectorStore:
+        def similarity_search_by_vector(self, vector, k):
+            return []
+
+    with pytest.raises(TimeoutError):
+        VectorRetriever(VectorStore(), Embeddings()).get_relevant_documents("Wie fahren Luftschiffe?")
+    assert breakers[Resilience.OPENAI].failures == Resilience.ATTEMPTS
+    assert breakers[Resilience.WEAVIATE].failures == 0
@@ -0,0 +1,31 @@
+from queue import Queue
+
+from app.streaming_handler import StreamingHandler
+from app.single_flight import SingleFlight
+
+
+def test_join_shares_a_running_flight():
+    leader, follower = StreamingHandler(Queue()), StreamingHandler(Queue())
+    flight, is_leader = SingleFlight.join("shared", leader)
+    flight.on_llm_new_token("Moin")
+
+    joined, follower_leads = SingleFlight.join("shared", follower)
+    assert is_leader and not follower_leads and joined is flight
+    assert follower.queue.get_nowait() == "Moin"
+    SingleFlight.leave(flight)
+
+
+# A request joining after the stream was cancelled, but before its leader left, must not get the cut off answer
+def test_join_replaces_a_cancelled_flight():
+    leader, late = StreamingHandler(Queue()), StreamingHandler(Queue())
+    flight, _ = SingleFlight.join("cancelled", leader)
+    leader.cancel()
+    assert StreamingHandler.is_run_cancelled([leader, flight])
+
+    replacement, late_leads = SingleFlight.join("cancelled", late)
+    assert late_leads and replacement is not flight
+    assert late.queue.empty()
+
+    SingleFlight.leave(flight)
+    assert SingleFlight.join("cancelled", StreamingHandler(Queue())) == (replacement, False)
+    SingleFlight.leave(replacement)
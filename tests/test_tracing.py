@@ -0,0 +1,84 @@
+import threading
+import json
+
+import pytest
+
+from app.tracing import JsonLinesExporter, SpanExporter, Tracer
+
+
+class ListExporter(SpanExporter):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+@pytest.fixture
+def exporter(monkeypatch):
+    exporter = ListExporter()
+    monkeypatch.setattr(Tracer, "_exporter", exporter)
+    return exporter
+
+
+def test_exporters_have_to_implement_export():
+    with pytest.raises(TypeError):
+        SpanExporter()
+
+
+# A span opened in the caller is the parent of the spans of a thread started with Tracer.wrap
+def test_wrap_continues_the_trace_in_the_thread(exporter):
+    def work():
+        with Tracer.span("child"):
+            pass
+
+    with Tracer.span("root", trace_id="trace") as root:
+        thread = threading.Thread(target=Tracer.wrap(work))
+        thread.start()
+        thread.join()
+
+    child = next(x for x in exporter.spans if x.name == "child")
+    assert (child.trace_id, child.parent_id) == ("trace", root.span_id)
+
+
+# NOTE: A span handed to wrap outlives the caller and ends together with the thread
+def test_wrap_ends_the_given_span_with_the_thread(exporter):
+    started = threading.Event()
+    release = threading.Event()
+
+    def work():
+        started.set()
+        release.wait(5)
+        with Tracer.span("child"):
+            pass
+
+    with Tracer.span("request", trace_id="trace") as request:
+        worker = Tracer.start_span("worker")
+        thread = threading.Thread(target=Tracer.wrap(work, worker))
+        thread.start()
+        started.wait(5)
+
+    assert [x.name for x in exporter.spans] == ["request"]
+    release.set()
+    thread.join()
+
+    child = next(x for x in exporter.spans if x.name == "child")
+    assert worker.parent_id == request.span_id
+    assert child.parent_id == worker.span_id
+    assert [x.name for x in exporter.spans] == ["request", "child", "worker"]
+
+
+def test_spans_are_written_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(JsonLinesExporter, "FLUSH_INTERVAL", 60.0)
+    path = tmp_path / "traces.jsonl"
+    exporter = JsonLinesExporter(str(path))
+    monkeypatch.setattr(Tracer, "_exporter", exporter)
+
+    with Tracer.span("root", trace_id="trace"):
+        with Tracer.span("stage"):
+            pass
+    assert not path.exists()
+
+    exporter.flush()
+    lines = [json.loads(x) for x in path.read_text().splitlines()]
+    assert [x["name"] for x in lines] == ["stage", "root"]
@@ -0,0 +1,119 @@
+from bson.objectid import ObjectId
+
+import pytest
+
+from benchmarks.offline_app import load_app
+
+
+@pytest.fixture(scope="module")
+def connection():
+    return load_app("mongomock", {"FAKE_EMBEDDING_LATENCY": 0}).MongoDBConnection
+
+
+@pytest.fixture
+def statistics(connection, monkeypatch):
+    from app.background_writer import BackgroundWriter
+    from app.usage_statistics import UsageStatistics
+
+    # NOTE: mongomock doesn't support $regexMatch, the answers of these tests never contain UNKNOWN_ANSWER
+    get_counter_pipeline = UsageStatistics.get_counter_pipeline.__func__
+
+    def _get_counter_pipeline(cls):
+        pipeline = get_counter_pipeline(cls)
+        pipeline[1]["$project"]["unknown_answers"] = {"$literal": 0}
+        return pipeline
+
+    monkeypatch.setattr(UsageStatistics, "get_counter_pipeline", classmethod(_get_counter_pipeline))
+    # NOTE: Usage of earlier tests may still be pending in the background writer
+    BackgroundWriter.flush()
+    connection.chat_history.delete_many({})
+    connection.usage_rollup.delete_many({})
+    connection.job.delete_many({})
+    return UsageStatistics
+
+
+# NOTE: The counted rollups leave out counters which were never increased
+def rollups(connection) -> dict:
+    from app.background_writer import BackgroundWriter
+    from app.usage_statistics import UsageStatistics
+
+    BackgroundWriter.flush()
+    return {x["_id"]: dict({key: 0 for key in UsageStatistics.COUNTERS}, **x) for x in connection.usage_rollup.find()}
+
+
+def turn(connection, history_id: str, subject_ids: list, source_ids: list, response: str = "Antwort") -> int:
+    idx = connection.add_chat_history_message(history_id, "Frage", "", connection.NEUTRAL_MSG_TAG, [])
+    connection.update_chat_history(history_id, idx, None, subject_ids, response, source_ids)
+    return idx
+
+
+def test_counted_rollups_match_the_rebuild(connection, statistics):
+    math, physics = ObjectId(), ObjectId()
+
+    first = str(connection.create_chat_history("Moin!"))
+    turn(connection, first, [], ["a"])
+    reviewed = turn(connection, first, [math], ["a", "b"])
+    turn(connection, first, [math, physics], ["b"])
+    connection.set_message_tag(first, reviewed, connection.MARK_FOR_REVIEW_MSG_TAG)
+    connection.set_message_tag(first, reviewed, connection.REVIEWED_MSG_TAG)
+
+    second = str(connection.create_chat_history("Moin!"))
+    turn(connection, second, [physics], ["c"])
+    connection.add_chat_history_message(second, "Frage ohne Antwort", "", connection.NEUTRAL_MSG_TAG, [])
+
+    str(connection.create_chat_history("Moin!"))
+
+    counted = rollups(connection)
+    assert statistics.rebuild() == 3
+    rebuilt = rollups(connection)
+    assert counted == rebuilt
+
+    total = next(x for x in rebuilt.values() if x["subject_id"] is None)
+    assert {key: total[key] for key in statistics.COUNTERS} == {
+        "sessions": 3,
+        "turns": 4,
+        "reviews": 1,
+        "unknown_answers": 0,
+    }
+    assert total["sources"] == {"a": 2, "b": 2, "c": 1}
+    assert [rebuilt[x]["sessions"] for x in sorted(rebuilt) if rebuilt[x]["subject_id"] == physics] == [2]
+
+
+def test_lost_updates_trigger_a_rebuild(connection, statistics, monkeypatch):
+    from app.background_writer import BackgroundWriter
+
+    history_id = str(connection.create_chat_history("Moin!"))
+    turn(connection, history_id, [ObjectId()], ["a"])
+    rollups(connection)
+
+    monkeypatch.setattr(BackgroundWriter, "_lost_callbacks", {})
+    BackgroundWriter.on_lost(connection.usage_rollup, statistics.on_lost)
+    monkeypatch.setattr(BackgroundWriter, "MAX_PENDING", 0)
+    turn(connection, history_id, [], ["b"])
+    rollups(connection)
+
+    statistics.lock.acquire(timeout=5).release()
+    job = connection.get_last_job(statistics.JOB_TYPE)
+    assert job["phase"] == "done"
+    assert connection.get_usage_dirty() is None
+    total = next(x for x in rollups(connection).values() if x["subject_id"] is None)
+    assert (total["turns"], total["sources"]) == (2, {"a": 1, "b": 1})
+
+
+def test_teacher_rows_leave_out_the_sessions(connection, statistics):
+    from app.subject_directory import SubjectDirectory
+
+    teacher_id = connection.user.insert_one({"username": "lehrerin"}).inserted_id
+    subject_ids = connection.subject.insert_many(
+        [{"subject": name, "course": "10a", "teacher_id": teacher_id} for name in ("Mathe", "Physik")]
+    ).inserted_ids
+    SubjectDirectory.invalidate()
+
+    history_id = str(connection.create_chat_history("Moin!"))
+    turn(connection, history_id, subject_ids, ["a"])
+    rollups(connection)
+
+    dashboard = statistics.get_dashboard(1)
+    assert dashboard["total"]["sessions"] == 1
+    assert [counts["sessions"] for _, counts in dashboard["subjects"]] == [1, 1]
+    assert dashboard["teachers"] == [("lehrerin", {"turns": 2, "reviews": 0, "unknown_answers": 0})]
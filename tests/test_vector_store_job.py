@@ -0,0 +1,14 @@
+import pytest
+
+from benchmarks.offline_app import load_app
+
+
+@pytest.fixture(scope="module")
+def client():
+    return load_app("mongomock", {"FAKE_EMBEDDING_LATENCY": 0}).app.test_client()
+
+
+@pytest.mark.parametrize("job_id", ["000000000000000000000000", "not-a-job-id", "1234"])
+def test_unknown_jobs_are_not_found(client, job_id):
+    response = client.get(f"/vector_store_job/{job_id}", headers={"CREF_TOKEN": "benchmark-cref-token"})
+    assert response.status_code == 404
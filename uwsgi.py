@@ -1,5 +1,15 @@
 # ./uwsgi.py
-from app.main import app as application
+from app.main import app as application, preload, warm_up
+
+# NOTE: The master imports the heavy modules once, the forked workers connect to the databases themselves
+preload()
+
+try:
+    from uwsgidecorators import postfork
+
+    postfork(warm_up)
+except ImportError:
+    warm_up()
 
 if __name__ == '__main__':
-    application.run(debug=True, port=5000, host='0.0.0.0')
\ No newline at end of file
+    application.run(debug=True, port=5000, host='0.0.0.0')